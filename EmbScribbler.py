@@ -40,6 +40,7 @@ class EmbScribbler(pyglet.window.Window):
 		self.file_name = "scribble.exp"
 		self.clear_data()
 		self.jump = False
+		self.optimize = False
 		glClearColor(1, 1, 1, 1)
 	
 	def clear_data(self):
@@ -51,6 +52,8 @@ class EmbScribbler(pyglet.window.Window):
 		if len(self.points) > 0:
 			self.emb.translate_to_origin()
 			self.emb.scale(10.0/pixels_per_millimeter)
+			if self.optimize:
+				self.emb.optimize_jumps()
 			self.emb.flatten()	
 			#self.emb.to_triple_stitches()
 			self.emb.add_endstitches_to_jumps()
@@ -94,6 +97,10 @@ class EmbScribbler(pyglet.window.Window):
 			self.save()
 		elif symbol == pyglet.window.key.J:
 			self.jump = True			
+		elif symbol == pyglet.window.key.O:
+			# reorder the jump separated parts when saving
+			self.optimize = not self.optimize
+			print("optimize jumps on save: %s" % (self.optimize and "on" or "off"))
 		elif symbol == pyglet.window.key.ESCAPE:
 			exit() 	
 						
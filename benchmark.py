@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+
+# ------------------------------------------------------------------
+# benchmark suite: importers, exporters, transforms and renderers
+# on synthetic designs, results as JSON, regression check
+# ------------------------------------------------------------------
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+# ------------------------------------------------------------------
+
+import stitchcode
+import getopt
+import gc
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+def usage():
+	print """
+usage: benchmark.py [options] [run]
+       benchmark.py [options] compare OLD.json NEW.json
+
+run: times every benchmark on every design and size and writes the
+results (best time and peak memory) as JSON. Each benchmark runs in a
+process of its own, so the memory peaks do not mix.
+compare: lists the benchmarks that got slower or need more memory
+than the threshold allows, exits with status 1 if there are any.
+Time differences below the noise floor are never counted.
+
+options:
+    -h, --help              print usage
+    -n, --stitches=COUNTS   comma separated design sizes
+                            (default: 1000,10000,100000,1000000,5000000)
+    -d, --designs=NAMES     comma separated designs (default: all)
+                            %s
+    -b, --benchmarks=NAMES  comma separated benchmarks (default: all)
+                            %s
+    -r, --repeat=COUNT      runs per benchmark, best time is reported (default: 3)
+    -o, --output=FILE       result file (default: benchmark-results.json)
+    -t, --threshold=PERCENT allowed slowdown for compare (default: 10)
+    --noise=SECONDS         noise floor for compare (default: 0.001)
+""" % (format_names(design_names), format_names(benchmark_names))
+
+def format_names(names):
+	lines = [""]
+	for name in names:
+		if len(lines[-1]) + len(name) > 50:
+			lines.append("")
+		lines[-1] += name + " "
+	return ("\n" + " " * 28).join(line.strip() for line in lines)
+
+sizes = [1000, 10000, 100000, 1000000, 5000000]
+designs = None
+benchmarks = None
+repeat = 3
+output = "benchmark-results.json"
+threshold = 10.0
+noise = 0.001
+
+############################################
+#### SYNTHETIC DESIGNS
+############################################
+
+class HilbertDesign(stitchcode.Hilbert):
+	# a Hilbert curve without writing hilbert%d.exp
+	def __init__(self, level):
+		stitchcode.Turtle.__init__(self)
+		self.size = 10.0
+		self.hilbert(level, 90.0)
+
+class KochDesign(stitchcode.Koch):
+	# a Koch snowflake without writing koch%d.exp
+	def __init__(self, depth):
+		stitchcode.Turtle.__init__(self)
+		for i in range(3):
+			self.edge(depth, 750.0)
+			self.turn(120.0)
+
+def clamped_forward(t, d, stmax):
+	# forward() of the generate-* scripts: one stitch every stmax units
+	while d > 0:
+		t.forward(min(d, stmax))
+		d -= stmax
+
+def spiral():
+	# generate-spiral.py
+	t = stitchcode.Turtle()
+	dist = .01
+	for i in range(150):
+		clamped_forward(t, dist * 600, 30)
+		t.right(89.5)
+		dist += .01
+	return t.emb
+
+def spirograph():
+	# generate-spirograph.py
+	t = stitchcode.Turtle()
+	for i in range(30):
+		for j in range(40):
+			clamped_forward(t, 50, 25)
+			t.right(360 / 40)
+		t.right(12)
+	return t.emb
+
+def random_walk():
+	# generate-random-walk.py with a fixed seed
+	rnd = random.Random(1)
+	emb = stitchcode.Embroidery()
+	(x, y) = (0, 0)
+	for i in range(4000):
+		sx = rnd.gauss(0, 1) * 30
+		sy = rnd.gauss(0, 1) * 30
+		if x + sx < 0 or x + sx > 800:
+			sx *= -1
+		if y + sy < 0 or y + sy > 600:
+			sy *= -1
+		(x, y) = (x + sx, y + sy)
+		emb.addStitch(stitchcode.Point(x, y))
+	return emb
+
+design_names = ["hilbert", "koch", "spiral", "spirograph", "random-walk"]
+base_designs = {
+	"hilbert": lambda: HilbertDesign(6).emb,
+	"koch": lambda: KochDesign(5).emb,
+	"spiral": spiral,
+	"spirograph": spirograph,
+	"random-walk": random_walk,
+}
+
+def make_design(name, count):
+	"""the base design of name repeated (slightly shifted, joined by
+	jumps) until it has count stitches
+	"""
+	base = base_designs[name]()
+	base.translate_to_origin()
+	points = [(int(round(p.x)), int(round(p.y))) for p in base.coords]
+	emb = stitchcode.Embroidery()
+	k = 0
+	while len(emb) < count:
+		(ox, oy) = ((k * 7) % 50, (k * 13) % 50)
+		n = min(len(points), count - len(emb))
+		if stitchcode.numpy is not None:
+			x = stitchcode.numpy.array([p[0] + ox for p in points[:n]], float)
+			y = stitchcode.numpy.array([p[1] + oy for p in points[:n]], float)
+			flags = stitchcode.numpy.zeros(n, stitchcode.numpy.uint8)
+			flags[0] = k and stitchcode.JUMP
+			emb.addStitches(x, y, flags)
+		else:
+			for (i, p) in enumerate(points[:n]):
+				emb.addStitch(stitchcode.Point(p[0] + ox, p[1] + oy, k and i == 0))
+		k += 1
+	return emb
+
+############################################
+#### BENCHMARKS
+############################################
+
+class NullWriter:
+	def write(self, data):
+		pass
+
+def load(files):
+	emb = stitchcode.Embroidery()
+	emb.import_tajima(files["dst"])
+	return emb
+
+def load_points(files):
+	# the stitches of the design as Points, to time building a design
+	return load(files).coords
+
+def add_stitches(points, files):
+	emb = stitchcode.Embroidery()
+	for p in points:
+		emb.addStitch(p)
+
+def importer(method, ext, columnar=None):
+	# reads files[ext] into a new design and touches the stitches (the
+	# native reader only maps them) - columnar=False for the point list
+	def run(emb, files):
+		emb = stitchcode.Embroidery(columnar=columnar)
+		getattr(emb, method)(files[ext])
+		emb.getExtents()
+	return run
+
+def import_melco_bytewise(emb, files):
+	# the EXP reader as it was before the bulk decoder: one f.read(1) 
+	# per byte - the reference for import-exp
+	emb = stitchcode.Embroidery(columnar=False)
+	(lastx, lasty) = (0, 0)
+	emb.addStitch(stitchcode.Point(lastx, lasty, False))
+	jump = False
+	f = open(files["exp"], "rb")
+	byte = " "
+	while byte:
+		byte = f.read(1)
+		if byte != "" and len(byte) > 0:
+			if byte == chr(0x80):
+				byte = f.read(1)
+				if byte == chr(0x04) or byte == chr(0x02)  or byte == chr(0x00):
+					jump = True
+				byte = f.read(1)
+			dx = ord(byte)
+			if dx > 127:
+				dx = dx - 256
+			byte = f.read(1)
+			if byte != "":
+				dy = ord(byte)
+				if dy > 127:
+					dy = dy - 256
+				lastx = lastx + dx
+				lasty = lasty + dy
+				if dx != 0 or dy != 0:
+					emb.addStitch(stitchcode.Point(lastx, lasty, jump))
+				jump = False
+	f.close()
+	emb.translate_to_origin()
+
+def transformed(func):
+	# transforms may be lazy - include applying them in the time, by
+	# reading the stitches like a caller would
+	def run(emb, files):
+		func(emb)
+		if emb.columnar:
+			emb.columns()
+		else:
+			emb.coords
+	return run
+
+benchmark_list = [
+	("import-exp", None, importer("import_melco", "exp")),
+	("import-dst", None, importer("import_tajima", "dst")),
+	("import-pes", None, importer("import_pes", "pes")),
+	("import-native", None, importer("load_native", "stc")),
+	("import-svg", None, importer("import_svg", "svg")),
+	("import-exp-python", None, importer("import_melco", "exp", False)),
+	("import-dst-python", None, importer("import_tajima", "dst", False)),
+	("import-native-python", None, importer("load_native", "stc", False)),
+	("import-exp-bytewise", None, import_melco_bytewise),
+	("export-exp", load, lambda emb, files: emb.write(NullWriter(), "exp")),
+	("export-dst", load, lambda emb, files: emb.write(NullWriter(), "dst")),
+	("export-ksm", load, lambda emb, files: emb.write(NullWriter(), "ksm")),
+	("export-pes", load, lambda emb, files: emb.write(NullWriter(), "pes")),
+	("export-svg", load, lambda emb, files: emb.export_svg()),
+	("save-png", load, lambda emb, files: emb.save_as_png(files["png"])),
+	("save-tiles", load, lambda emb, files: emb.save_tiles(files["tiles"], workers=1)),
+	("scale", load, transformed(lambda emb: emb.scale(1.5))),
+	("rotate", load, transformed(lambda emb: emb.rotate(30))),
+	("mirror", load, transformed(lambda emb: emb.mirror())),
+	("translate-to-origin", load, transformed(lambda emb: emb.translate_to_origin())),
+	("flatten", load, lambda emb, files: emb.flatten(30)),
+	("simplify", load, lambda emb, files: emb.simplify()),
+	("triple-stitches", load, lambda emb, files: emb.to_triple_stitches()),
+	("red-work", load, lambda emb, files: emb.to_red_work()),
+	("optimize-jumps", load, lambda emb, files: emb.optimize_jumps()),
+	("add-stitch", load_points, add_stitches),
+]
+benchmark_names = [b[0] for b in benchmark_list]
+
+def memory_kb(field):
+	# VmRSS/VmHWM of this process in kB, None without /proc
+	try:
+		for line in open("/proc/self/status"):
+			if line.startswith(field + ":"):
+				return int(line.split()[1])
+	except IOError:
+		pass
+	return None
+
+def reset_peak():
+	# resets VmHWM (linux) - returns False if not possible
+	try:
+		f = open("/proc/self/clear_refs", "w")
+		f.write("5")
+		f.close()
+		return True
+	except IOError:
+		return False
+
+def run_benchmark(name, files):
+	"""runs benchmark name and returns (best time, peak memory in kB)
+	- the peak is the memory used on top of what was used before,
+	the setup (loading the design) is not timed
+	"""
+	(setup, func) = [(b[1], b[2]) for b in benchmark_list if b[0] == name][0]
+	(best, peak) = (None, 0)
+	for i in range(repeat):
+		emb = None
+		if setup is not None:
+			emb = setup(files)
+		gc.collect()
+		if reset_peak():
+			before = memory_kb("VmRSS")
+		else:
+			before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		start = time.time()
+		func(emb, files)
+		t = time.time() - start
+		high = memory_kb("VmHWM") or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		if best is None or t < best:
+			best = t
+		peak = max(peak, high - before)
+		emb = None
+	return (best, peak)
+
+def run_worker(args):
+	# child process: benchmark.py --worker NAME DIRECTORY
+	(name, directory) = args
+	files = dict((ext, os.path.join(directory, "design." + ext))
+		for ext in ("exp", "dst", "pes", "stc", "svg", "png"))
+	files["tiles"] = os.path.join(directory, "tiles")
+	try:
+		(t, peak) = run_benchmark(name, files)
+		print json.dumps({"time": t, "peak_kb": peak})
+	except Exception, err:
+		print json.dumps({"error": "%s: %s" % (err.__class__.__name__, err)})
+
+def run():
+	selected_designs = designs or design_names
+	selected = benchmarks or benchmark_names
+	results = []
+	directory = tempfile.mkdtemp()
+	try:
+		for name in selected_designs:
+			for count in sizes:
+				emb = make_design(name, count)
+				emb.save_as_exp(os.path.join(directory, "design.exp"))
+				emb.save_as_dst(os.path.join(directory, "design.dst"))
+				emb.save_as_pes(os.path.join(directory, "design.pes"))
+				emb.save_native(os.path.join(directory, "design.stc"))
+				emb.save_as_svg(os.path.join(directory, "design.svg"))
+				emb = None
+				for bench in selected:
+					child = subprocess.Popen([sys.executable, sys.argv[0], "--worker",
+						"--repeat=%d" % repeat, bench, directory], stdout=subprocess.PIPE)
+					out = child.communicate()[0]
+					try:
+						result = json.loads(out.strip().splitlines()[-1])
+					except (ValueError, IndexError):
+						result = {"error": "benchmark process failed"}
+					result.update({"design": name, "stitches": count, "benchmark": bench})
+					results.append(result)
+					if "error" in result:
+						print "%-12s %8d  %-20s %s" % (name, count, bench, result["error"])
+					else:
+						print "%-12s %8d  %-20s %9.4fs %9.1fMB" % (name, count, bench,
+							result["time"], result["peak_kb"] / 1024.0)
+					sys.stdout.flush()
+	finally:
+		shutil.rmtree(directory, True)
+
+	f = open(output, "w")
+	json.dump({"python": platform.python_version(), "platform": platform.platform(),
+		"numpy": stitchcode.numpy is not None and stitchcode.numpy.__version__ or None,
+		"date": time.strftime("%Y-%m-%d %H:%M:%S"), "repeat": repeat,
+		"results": results}, f, indent=1)
+	f.close()
+	print "results written to %s" % output
+
+def compare(old_file, new_file):
+	"""prints the changes between two result files
+	Returns:
+		number of regressions
+	"""
+	def results(filename):
+		data = json.load(open(filename))
+		return dict(((r["design"], r["stitches"], r["benchmark"]), r)
+			for r in data["results"] if "error" not in r)
+	(old, new) = (results(old_file), results(new_file))
+	limit = 1 + threshold / 100.0
+	regressions = 0
+	for key in sorted(set(old) & set(new)):
+		(a, b) = (old[key], new[key])
+		time_ratio = b["time"] / max(a["time"], 1e-9)
+		memory_ratio = (b["peak_kb"] + 1024.0) / (a["peak_kb"] + 1024.0)
+		if abs(b["time"] - a["time"]) < noise:
+			time_ratio = 1.0
+		flag = ""
+		if time_ratio > limit or memory_ratio > limit:
+			flag = "REGRESSION"
+			regressions += 1
+		elif time_ratio < 1 / limit:
+			flag = "faster"
+		print "%-12s %8d  %-20s %9.4fs -> %9.4fs %6.2fx %8.1fMB -> %8.1fMB  %s" % (
+			key + (a["time"], b["time"], a["time"] / max(b["time"], 1e-9),
+			a["peak_kb"] / 1024.0, b["peak_kb"] / 1024.0, flag))
+	for key in sorted(set(old) ^ set(new)):
+		print "%-12s %8d  %-20s only in %s" % (key + (key in old and old_file or new_file,))
+	print "%d regressions beyond %g%%" % (regressions, threshold)
+	return regressions
+
+def process_args():
+	global sizes, designs, benchmarks, repeat, output, threshold, noise
+	try:
+		opts, args = getopt.gnu_getopt(sys.argv[1:], "hn:d:b:r:o:t:",
+			["help", "stitches=", "designs=", "benchmarks=", "repeat=",
+			"output=", "threshold=", "noise=", "worker"])
+	except getopt.GetoptError, err:
+		print str(err)
+		usage()
+		sys.exit(2)
+
+	worker = False
+	for o, a in opts:
+		if o in ("-h", "--help"):
+			usage()
+			sys.exit()
+		elif o in ("-n", "--stitches"):
+			sizes = [int(float(v)) for v in a.split(",")]
+		elif o in ("-d", "--designs"):
+			designs = a.split(",")
+		elif o in ("-b", "--benchmarks"):
+			benchmarks = a.split(",")
+		elif o in ("-r", "--repeat"):
+			repeat = int(a)
+		elif o in ("-o", "--output"):
+			output = a
+		elif o in ("-t", "--threshold"):
+			threshold = float(a)
+		elif o == "--noise":
+			noise = float(a)
+		elif o == "--worker":
+			worker = True
+
+	for (names, known) in ((designs, design_names), (benchmarks, benchmark_names)):
+		for name in names or []:
+			if name not in known:
+				print "unknown name: %s" % name
+				usage()
+				sys.exit(2)
+	return (worker, args)
+
+if __name__ == "__main__":
+	(worker, args) = process_args()
+	stitchcode.set_sink(stitchcode.NullSink())
+	if worker:
+		run_worker(args)
+	elif args[:1] == ["compare"] and len(args) == 3:
+		sys.exit(compare(args[1], args[2]) and 1 or 0)
+	elif args in ([], ["run"]):
+		run()
+	else:
+		usage()
+		sys.exit(2)
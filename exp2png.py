@@ -27,19 +27,23 @@ options:
     -o, --output=FILE       output PNG file
     -z, --zoom=FACTOR       zoom in/out
     -s, --show-stitches     show stitches    
+    -j, --show-jumps        show jump stitches
+    -c, --cache=DIR         reuse earlier conversions stored in DIR
 """
 
 infile = "";
 outfile = "";
 zoom = 1
 show_stitches = False
+show_jumps = False
+cache_dir = ""
 
 def process_args():
-	global infile, outfile, zoom, show_stitches
+	global infile, outfile, zoom, show_stitches, show_jumps, cache_dir
 	
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], "hi:o:z:s",
-			["help", "input=","output=","zoom=","show-stiches"])
+		opts, args = getopt.getopt(sys.argv[1:], "hi:o:z:sjc:",
+			["help", "input=","output=","zoom=","show-stiches","show-jumps","cache="])
 	except getopt.GetoptError, err:
 		# print help information and exit:
 		print str(err) # will print something like "option -a not recognized"
@@ -58,6 +62,10 @@ def process_args():
 			zoom = float(a)
 		elif o in ("-s", "--show-stitch"):
 			show_stitches = True	
+		elif o in ("-j", "--show-jumps"):
+			show_jumps = True
+		elif o in ("-c", "--cache"):
+			cache_dir = a
 		else:
 			usage()
 			sys.exit()
@@ -74,7 +82,18 @@ if __name__ == '__main__':
 	if not outfile:
 		outfile = "%s.png" % infile[:-4] 
 
+	cache = None
+	if cache_dir:
+		cache = stitchcode.ConversionCache(cache_dir)
+		key = cache.key(cache.input_hash(infile), "png", {"zoom": zoom, 
+			"show_stitches": show_stitches, "show_jumps": show_jumps,
+			"pixels_per_millimeter": stitchcode.pixels_per_millimeter})
+		if cache.fetch(key, outfile):
+			sys.exit()
+
 	emb = stitchcode.Embroidery()
 	emb.import_melco(infile)
 	emb.scale(zoom)
-	emb.save_as_png(outfile, show_stitches)
+	emb.save_as_png(outfile, show_stitches, show_jumps)
+	if cache:
+		cache.store(key, outfile)
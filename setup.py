@@ -17,5 +17,5 @@ setup(	name="stitchcode",
 		#	'exp2svg.py',
 		#	'stitchconv.py']
 		#)]
-		scripts=['stitchconv.py'],
+		scripts=['stitchconv.py', 'stitchcatalog.py'],
      )
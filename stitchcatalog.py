@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+#######################################
+#
+# index a library of embroidery files in a SQLite catalog
+#
+# author:(c) Michael Aschauer <m AT ash.to>
+# www: http:/m.ash.to
+# licenced under: GPL v3
+# see: http://www.gnu.org/licenses/gpl.html
+#
+#######################################
+
+import stitchcode
+import getopt
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+
+def usage():
+	print """
+usage: stitchcatalog.py [options] scan DIR|FILE...
+       stitchcatalog.py [options] query
+       stitchcatalog.py [options] thumbnail FILE OUTPUT.png
+
+scan: indexes the designs in the directories (recursively) and files.
+Only new and changed files are parsed again, files that are gone are
+dropped from the catalog.
+query: lists the designs matching the query options.
+thumbnail: writes the stored thumbnail of an indexed design.
+
+options:
+    -h, --help              print usage
+    -d, --database=FILE     catalog file (default: catalog.db)
+    -w, --workers=COUNT     number of parsing processes (default: cpus)
+    -T, --no-thumbnails     scan without rendering thumbnails (only the
+                            file headers are read then)
+    -f, --fits=WxH          designs fitting a hoop of W x H mm, turned or not
+    -s, --max-stitches=N    designs with at most N stitches
+    -c, --max-colors=N      designs with at most N colors
+    -F, --format=EXT        designs of this format
+    -n, --limit=COUNT       list at most COUNT designs
+    -v, --verbose           be verbose
+"""
+
+database = "catalog.db"
+workers = 0
+thumbnails = True
+fits = None
+max_stitches = None
+max_colors = None
+file_format = None
+limit = None
+verbose = False
+
+catalog_formats = ("exp", "dst", "pes", "stc", "svg")
+hash_block_size = 1 << 20
+
+############################################
+#### CATALOG
+############################################
+
+catalog_schema = """
+CREATE TABLE IF NOT EXISTS designs (
+	path TEXT PRIMARY KEY,
+	mtime REAL,
+	size INTEGER,
+	hash TEXT,
+	format TEXT,
+	stitches INTEGER,
+	jumps INTEGER,
+	colors INTEGER,
+	width REAL,
+	height REAL,
+	error TEXT,
+	indexed REAL,
+	thumbnail BLOB
+);
+CREATE INDEX IF NOT EXISTS designs_size ON designs (width, height);
+CREATE INDEX IF NOT EXISTS designs_stitches ON designs (stitches);
+CREATE INDEX IF NOT EXISTS designs_colors ON designs (colors);
+CREATE INDEX IF NOT EXISTS designs_hash ON designs (hash);
+"""
+
+# the columns describing the content of a file - the same for all
+# files with the same hash
+content_columns = ("format", "stitches", "jumps", "colors", "width",
+	"height", "error", "thumbnail")
+
+def file_hash(path):
+	# sha1 of the file contents, read block by block
+	h = hashlib.sha1()
+	f = open(path, "rb")
+	while True:
+		block = f.read(hash_block_size)
+		if not block:
+			break
+		h.update(block)
+	f.close()
+	return h.hexdigest()
+
+def catalog_init():
+	# messages of many workers would only slow the scan down
+	stitchcode.set_sink(stitchcode.NullSink())
+
+def catalog_hash(path):
+	# runs in a worker: (path, hash or None if unreadable)
+	try:
+		return (path, file_hash(path))
+	except (IOError, OSError):
+		return (path, None)
+
+def catalog_parse(job):
+	# runs in a worker: returns the content columns of a file
+	(path, with_thumbnail) = job
+	row = dict.fromkeys(content_columns)
+	row["format"] = path[-3:].lower()
+	try:
+		info = stitchcode.probe(path)
+		row.update((k, info[k]) for k in ("stitches", "jumps", "colors"))
+		# sizes in mm
+		if info["width"] is not None:
+			(row["width"], row["height"]) = (info["width"] / 10.0, info["height"] / 10.0)
+		if with_thumbnail:
+			emb = stitchcode.Embroidery()
+			emb.load(path)
+			if row["width"] is None:
+				(minx, miny, maxx, maxy) = emb.getExtents()
+				(row["width"], row["height"]) = ((maxx - minx) / 10.0, (maxy - miny) / 10.0)
+			try:
+				row["thumbnail"] = emb.thumbnail()
+			except ImportError:
+				pass
+	except Exception, err:
+		row["error"] = "%s: %s" % (err.__class__.__name__, err)
+	return (path, row)
+
+class DesignCatalog:
+	"""SQLite index of design files - metadata and a thumbnail per file.
+	Rescans are incremental: files with unchanged mtime and size are
+	skipped, changed ones are hashed and only parsed again if their
+	content is new to the catalog.
+	"""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.db = sqlite3.connect(filename)
+		self.db.row_factory = sqlite3.Row
+		self.db.text_factory = str
+		self.db.executescript(catalog_schema)
+
+	def close(self):
+		self.db.close()
+
+	def scan(self, roots, workers=None, thumbnails=True):
+		"""indexes the design files in roots (directories are scanned
+		recursively) and drops the files under roots that are gone
+
+		Args:
+			roots: list of directories and files
+			workers: number of worker processes (default = cpus)
+			thumbnails: render thumbnails - the designs are loaded then,
+				otherwise only their headers are read (default = True)
+		Returns:
+			dict with the number of files unchanged, added, updated,
+			reused (content known from another file), removed and failed
+		"""
+		stats = dict.fromkeys(("unchanged", "added", "updated", "reused",
+			"removed", "failed"), 0)
+		files = self._find(roots)
+		known = dict((row["path"], row) for row in
+			self.db.execute("SELECT path, mtime, size, hash FROM designs"))
+
+		# drop the files that are gone
+		roots = [os.path.abspath(root) for root in roots]
+		gone = [path for path in known if path not in files and
+			[root for root in roots if path == root or path.startswith(root.rstrip(os.sep) + os.sep)]]
+		self.db.executemany("DELETE FROM designs WHERE path = ?", [(p,) for p in gone])
+		stats["removed"] = len(gone)
+
+		changed = []
+		for (path, (mtime, size)) in sorted(files.iteritems()):
+			row = known.get(path)
+			if row and row["mtime"] == mtime and row["size"] == size:
+				stats["unchanged"] += 1
+			else:
+				changed.append(path)
+		if not changed:
+			self.db.commit()
+			return stats
+
+		pool = multiprocessing.Pool(workers or None, catalog_init)
+		try:
+			# hash the changed files - content already in the catalog
+			# (a touched or copied file) needs no parsing
+			hashes = {}
+			copies = {}
+			parse = []
+			for (path, digest) in pool.imap_unordered(catalog_hash, changed, 16):
+				if digest is None:
+					stats["failed"] += 1
+					continue
+				(mtime, size) = files[path]
+				row = known.get(path)
+				if row and row["hash"] == digest:
+					self.db.execute("UPDATE designs SET mtime = ?, size = ? WHERE path = ?",
+						(mtime, size, path))
+					stats["unchanged"] += 1
+					continue
+				same = self.db.execute("SELECT * FROM designs WHERE hash = ? AND error IS NULL"
+					" AND (thumbnail IS NOT NULL OR NOT ?) LIMIT 1", (digest, thumbnails)).fetchone()
+				if same:
+					self._store(path, mtime, size, digest, dict((k, same[k]) for k in content_columns))
+					stats["reused"] += 1
+				elif digest in copies:
+					# parsed once for all files of the scan with this content
+					copies[digest].append(path)
+				else:
+					copies[digest] = []
+					hashes[path] = digest
+					parse.append((path, thumbnails))
+
+			jobs = 0
+			for (path, row) in pool.imap_unordered(catalog_parse, parse, 4):
+				digest = hashes[path]
+				for (n, path) in enumerate([path] + copies[digest]):
+					(mtime, size) = files[path]
+					self._store(path, mtime, size, digest, row)
+					if row["error"]:
+						stats["failed"] += 1
+					elif n:
+						stats["reused"] += 1
+					elif path in known:
+						stats["updated"] += 1
+					else:
+						stats["added"] += 1
+				jobs += 1
+				if jobs % 500 == 0:
+					self.db.commit()
+			pool.close()
+		except KeyboardInterrupt:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+			self.db.commit()
+		return stats
+
+	def _find(self, roots):
+		# design files in roots -> {absolute path: (mtime, size)}
+		files = {}
+		def add(path):
+			if path[-3:].lower() in catalog_formats:
+				try:
+					st = os.stat(path)
+				except OSError:
+					return
+				files[os.path.abspath(path)] = (st.st_mtime, st.st_size)
+		for root in roots:
+			if os.path.isdir(root):
+				for (directory, dirs, names) in os.walk(root):
+					for name in names:
+						add(os.path.join(directory, name))
+			elif os.path.isfile(root):
+				add(root)
+			else:
+				print "not found: %s" % root
+		return files
+
+	def _store(self, path, mtime, size, digest, row):
+		columns = ("path", "mtime", "size", "hash", "indexed") + content_columns
+		values = (path, mtime, size, digest, time.time()) + tuple(
+			row[k] is not None and k == "thumbnail" and sqlite3.Binary(row[k]) or row[k]
+			for k in content_columns)
+		self.db.execute("INSERT OR REPLACE INTO designs (%s) VALUES (%s)" % (
+			", ".join(columns), ", ".join("?" * len(columns))), values)
+
+	def query(self, fits=None, max_stitches=None, max_colors=None, format=None,
+			limit=None):
+		"""finds designs - all conditions given must match
+
+		Args:
+			fits: (width, height) of a hoop in mm, designs fitting it
+				straight or turned by 90 degrees
+			max_stitches: largest stitch count
+			max_colors: largest number of colors
+			format: file extension
+			limit: largest number of designs returned
+		Returns:
+			list of dicts with path, format, stitches, jumps, colors,
+			width and height (in mm), smallest designs first
+		"""
+		where = ["error IS NULL"]
+		args = []
+		if fits:
+			(w, h) = fits
+			where.append("((width <= ? AND height <= ?) OR (width <= ? AND height <= ?))")
+			args += [w, h, h, w]
+		if max_stitches is not None:
+			where.append("stitches <= ?")
+			args.append(max_stitches)
+		if max_colors is not None:
+			where.append("colors <= ?")
+			args.append(max_colors)
+		if format:
+			where.append("format = ?")
+			args.append(format.lower().lstrip("."))
+		sql = ("SELECT path, format, stitches, jumps, colors, width, height FROM designs"
+			" WHERE %s ORDER BY stitches, path" % " AND ".join(where))
+		if limit:
+			sql += " LIMIT %d" % limit
+		return [dict(row) for row in self.db.execute(sql, args)]
+
+	def thumbnail(self, path):
+		"""returns the stored thumbnail of a design (PNG data) or None"""
+		row = self.db.execute("SELECT thumbnail FROM designs WHERE path = ?",
+			(os.path.abspath(path),)).fetchone()
+		return row and row["thumbnail"] and str(row["thumbnail"]) or None
+
+	def failed(self):
+		"""returns [(path, error)] of the files that could not be read"""
+		return [(row["path"], row["error"]) for row in
+			self.db.execute("SELECT path, error FROM designs WHERE error IS NOT NULL ORDER BY path")]
+
+############################################
+#### COMMAND LINE
+############################################
+
+def process_args():
+	global database, workers, thumbnails, fits, max_stitches, max_colors
+	global file_format, limit, verbose
+	try:
+		opts, args = getopt.gnu_getopt(sys.argv[1:], "hd:w:Tf:s:c:F:n:v",
+			["help", "database=", "workers=", "no-thumbnails", "fits=",
+			"max-stitches=", "max-colors=", "format=", "limit=", "verbose"])
+	except getopt.GetoptError, err:
+		print str(err)
+		usage()
+		sys.exit(2)
+
+	for o, a in opts:
+		if o in ("-h", "--help"):
+			usage()
+			sys.exit()
+		elif o in ("-d", "--database"):
+			database = a
+		elif o in ("-w", "--workers"):
+			workers = int(a)
+		elif o in ("-T", "--no-thumbnails"):
+			thumbnails = False
+		elif o in ("-f", "--fits"):
+			try:
+				fits = tuple(float(v) for v in a.lower().split("x"))
+			except ValueError:
+				fits = ()
+			if len(fits) != 2:
+				print "hoop size must be WIDTHxHEIGHT: %s" % a
+				usage()
+				sys.exit(2)
+		elif o in ("-s", "--max-stitches"):
+			max_stitches = int(float(a))
+		elif o in ("-c", "--max-colors"):
+			max_colors = int(a)
+		elif o in ("-F", "--format"):
+			file_format = a
+		elif o in ("-n", "--limit"):
+			limit = int(a)
+		elif o in ("-v", "--verbose"):
+			verbose = True
+	return args
+
+def run_scan(catalog, roots):
+	start = time.time()
+	stats = catalog.scan(roots, workers, thumbnails)
+	print ("%(added)d added, %(updated)d updated, %(reused)d reused, %(unchanged)d unchanged, "
+		"%(removed)d removed, %(failed)d failed" % stats) + " in %.2fs" % (time.time() - start)
+	if verbose:
+		for (path, error) in catalog.failed():
+			print "FAILED %s: %s" % (path, error)
+
+def run_query(catalog):
+	def show(format, value):
+		# unknown values (not in the file header) as "?"
+		if value is None:
+			return "?".rjust(len(format % 0))
+		return format % value
+	designs = catalog.query(fits, max_stitches, max_colors, file_format, limit)
+	for d in designs:
+		print "%s stitches %s jumps %s colors %s x %s mm  %s" % (show("%8d", d["stitches"]),
+			show("%5d", d["jumps"]), show("%3d", d["colors"]), show("%7.1f", d["width"]),
+			show("%5.1f", d["height"]), d["path"])
+	if verbose:
+		print "%d designs" % len(designs)
+
+if __name__ == '__main__':
+	args = process_args()
+	catalog = DesignCatalog(database)
+	try:
+		if args[:1] == ["scan"] and len(args) > 1:
+			run_scan(catalog, args[1:])
+		elif args == ["query"]:
+			run_query(catalog)
+		elif args[:1] == ["thumbnail"] and len(args) == 3:
+			data = catalog.thumbnail(args[1])
+			if data is None:
+				print "no thumbnail of %s" % args[1]
+				sys.exit(1)
+			open(args[2], "wb").write(data)
+		else:
+			usage()
+			sys.exit(2)
+	finally:
+		catalog.close()
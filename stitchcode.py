@@ -24,21 +24,257 @@
 # Boston, MA 02111-1307, USA.
 
 
+import array
+import copy
+import imp
 import math
+import os
 import sys
-from struct import unpack,pack
-from PIL import Image, ImageDraw
+import time
+from struct import unpack,pack,calcsize
+from cStringIO import StringIO
+
+# modules only some functions need (json, hashlib, multiprocessing, 
+# PIL, ...) are imported by these functions, so "import stitchcode" 
+# stays cheap. numpy is optional and imported on first use.
+
+class _LazyModule(object):
+	"""stands in for a module until it is used - the first attribute
+	access imports the module and puts it in place of this one
+	"""
+	def __init__(self, name):
+		self._name = name
+
+	def __getattr__(self, attr):
+		module = __import__(self._name)
+		globals()[self._name] = module
+		return getattr(module, attr)
+
+try:
+	imp.find_module("numpy")
+	numpy = _LazyModule("numpy")
+except ImportError:
+	numpy = None
 dbg = sys.stderr
 
 pixels_per_millimeter = 5
+thumbnail_size = 64			# pixels of the longer side of a thumbnail
+tile_size = 256				# pixels per side of a tile
+tile_pixels_per_millimeter = 20	# resolution of the deepest tile level by default
+tile_mark_size = 2			# pixels from the center to the corner of a stitch mark
+png_line_color = (0, 0, 0)
+png_jump_color = (255, 0, 0)
+png_stitch_color = (0, 0, 255)
 max_stitch_len = 121 		# at least for DST files, EXP allows 127
+dst_max_move = 121			# 1+3+9+27+81 - largest move of one DST record
+stream_chunk_size = 65536	# stitches encoded at once by Embroidery.write
+append_block_size = 4096		# stitches added one by one, written to the columns at once
+stream_block_size = 65532	# bytes read at once by the lazy readers (a multiple of 2 and 3)
 density_max = 15
 
+# largest move of one record along each axis - (stitch, jump) - per format
+move_limits = {
+	"exp": (127, 127),
+	"ksm": (127, 127),
+	"dst": (dst_max_move, dst_max_move),
+	"pes": (63, 2047),		# short form for stitches, long form for jumps
+}
+
+# native format: header, then the columns x, y (float64), color (uint16)
+# and flags (uint8), all little endian
+native_magic = "STCN"
+native_version = 1
+native_header = "<4sHHQddddQdQ8x"	# magic, version, header size, stitches,
+									# extents, jumps, max. stitch length, too long
+
+# stitch flags as stored in the flags column of the columnar backend
+JUMP = 0x01
+TRIM = 0x02
+COLOR_CHANGE = 0x04
+
 def abs(x):	
 	if (x<0): return -x
 	return x
 
 
+############################################
+#### INSTRUMENTATION
+############################################
+
+# Progress messages and stage timings go to the sink. The default
+# writes messages to dbg like before and does not time stages; with a
+# NullSink stage() and log() return right away, so instrumentation 
+# costs next to nothing. Sinks with timed = False get no stages.
+
+class NullSink:
+	"""drops everything"""
+	enabled = False
+	timed = False
+
+	def message(self, text):
+		pass
+
+	def stage(self, name, seconds, counters):
+		pass
+
+class StreamSink:
+	"""writes messages and stage timings as text lines to stream
+	(default = dbg at the time of writing), the stage timings only 
+	if timed
+	"""
+	enabled = True
+
+	def __init__(self, stream=None, timed=True):
+		self.stream = stream
+		self.timed = timed
+
+	def message(self, text):
+		(self.stream or dbg).write(text)
+
+	def stage(self, name, seconds, counters):
+		self.message("%s: %0.4fs%s\n" % (name, seconds, 
+			"".join(", %s: %d" % c for c in sorted(counters.items()))))
+
+class JSONLinesSink:
+	"""writes messages and stage timings as one JSON object per line"""
+	enabled = True
+	timed = True
+
+	def __init__(self, stream):
+		self.stream = stream
+
+	def message(self, text):
+		import json
+		self.stream.write(json.dumps({"type": "message", "text": text.strip()}) + "\n")
+
+	def stage(self, name, seconds, counters):
+		import json
+		self.stream.write(json.dumps({"type": "stage", "name": name,
+			"seconds": seconds, "counters": counters}) + "\n")
+
+class ProfileSink:
+	"""sums up time and counters per stage, passes everything on to
+	sink (if given)
+	"""
+	enabled = True
+	timed = True
+
+	def __init__(self, sink=None):
+		self.sink = sink
+		self.stages = {}
+
+	def message(self, text):
+		if self.sink is not None:
+			self.sink.message(text)
+
+	def stage(self, name, seconds, counters):
+		self._add(name, 1, seconds, counters)
+		if self.sink is not None:
+			self.sink.stage(name, seconds, counters)
+
+	def _add(self, name, calls, seconds, counters):
+		entry = self.stages.setdefault(name, [0, 0.0, {}])
+		entry[0] += calls
+		entry[1] += seconds
+		for (k, n) in counters.iteritems():
+			entry[2][k] = entry[2].get(k, 0) + n
+
+	def merge(self, stages):
+		"""adds the stages of another ProfileSink (e.g. from a worker process)"""
+		for (name, (calls, seconds, counters)) in stages.iteritems():
+			self._add(name, calls, seconds, counters)
+
+	def report(self):
+		"""stage breakdown as text, slowest stage first. Stages can
+		contain others (an effect inside to_triple_stitches), so the
+		percentages may add up to more than 100.
+		"""
+		total = sum(e[1] for e in self.stages.itervalues()) or 1
+		lines = ["%-24s %6s %10s %6s  %s" % ("stage", "calls", "seconds", "%", "counters")]
+		for (name, (calls, seconds, counters)) in sorted(self.stages.items(), 
+				key=lambda s: -s[1][1]):
+			lines.append("%-24s %6d %10.4f %6.1f  %s" % (name, calls, seconds,
+				100.0 * seconds / total, ", ".join("%s: %d" % c for c in sorted(counters.items()))))
+		return "\n".join(lines) + "\n"
+
+sink = StreamSink(timed=False)
+
+def set_sink(new_sink):
+	"""sets where messages and stage timings go - returns the old sink"""
+	global sink
+	old = sink
+	sink = new_sink
+	return old
+
+class _Stage(object):
+	__slots__ = ("name", "counters", "start")
+
+	def __init__(self, name):
+		self.name = name
+		self.counters = {}
+		self.start = time.time()
+
+	def __enter__(self):
+		_stages.append(self)
+		return self
+
+	def __exit__(self, *exc):
+		_stages.pop()
+		sink.stage(self.name, time.time() - self.start, self.counters)
+
+	def count(self, name, n=1):
+		self.counters[name] = self.counters.get(name, 0) + n
+
+class _NoStage(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		pass
+
+	def count(self, name, n=1):
+		pass
+
+_no_stage = _NoStage()
+_stages = []
+
+def stage(name):
+	"""times a stage - use as "with stage(name) as s:", s.count(counter, n)
+	adds to a counter of the stage
+	"""
+	if not sink.timed:
+		return _no_stage
+	return _Stage(name)
+
+def count(name, n=1):
+	"""adds n to a counter of the innermost running stage"""
+	if _stages:
+		_stages[-1].count(name, n)
+
+def staged(name):
+	"""decorator for Embroidery methods - times them as stage name and
+	counts the stitches before and after
+	"""
+	def decorate(method):
+		def run(self, *args, **kwargs):
+			if not sink.timed:
+				return method(self, *args, **kwargs)
+			with stage(name) as st:
+				st.count("stitches in", len(self))
+				result = method(self, *args, **kwargs)
+				st.count("stitches out", len(self))
+			return result
+		run.__name__ = method.__name__
+		run.__doc__ = method.__doc__
+		return run
+	return decorate
+
+def log(text, *args):
+	"""progress message - formatted with args only if it is used"""
+	if sink.enabled:
+		sink.message(args and text % args or text)
+
+
 ############################################
 #### POINT CLASS
 ############################################
@@ -47,7 +283,7 @@ class Point:
 	def __init__(self, x, y, jump=False, color=0):
 		self.x = x
 		self.y = y
-		self.color = 0
+		self.color = color
 		self.jump = jump
 		
 	def __add__(self, other):
@@ -77,53 +313,591 @@ class Point:
 	def toString(self):
 		return "%dx%d" % (self.x, self.y)
 
+############################################
+#### COLUMNAR STITCH STORAGE
+############################################
+
+class StitchArray:
+	"""columnar stitch storage - contiguous numpy arrays for x, y,
+	a flags column (JUMP, TRIM, COLOR_CHANGE) and a color index.
+	The arrays grow geometrically, so appending stays amortized O(1).
+	Single stitches are collected in python lists first and written
+	to the arrays in blocks - storing numpy scalars one by one is slow.
+	"""
+	def __init__(self, capacity=1024):
+		capacity = max(capacity, 1)
+		self.x = numpy.zeros(capacity, numpy.float64)
+		self.y = numpy.zeros(capacity, numpy.float64)
+		self.flags = numpy.zeros(capacity, numpy.uint8)
+		self.color = numpy.zeros(capacity, numpy.uint16)
+		self.count = 0
+		self._pending = ([], [], [], [])
+
+	def __len__(self):
+		return self.count + len(self._pending[0])
+
+	def flush(self):
+		"""writes the appended stitches still in the lists to the arrays"""
+		(x, y, flags, color) = self._pending
+		if x:
+			self._pending = ([], [], [], [])
+			self.extend(x, y, flags, color)
+
+	def last(self):
+		"""returns (x, y) of the last stitch as python numbers, None if empty"""
+		if self._pending[0]:
+			return (self._pending[0][-1], self._pending[1][-1])
+		if self.count:
+			n = self.count - 1
+			return (float(self.x[n]), float(self.y[n]))
+		return None
+
+	def reserve(self, capacity):
+		if capacity <= len(self.x):
+			return
+		capacity = max(capacity, 2 * len(self.x))
+		for name in ("x", "y", "flags", "color"):
+			old = getattr(self, name)
+			new = numpy.zeros(capacity, old.dtype)
+			new[:self.count] = old[:self.count]
+			setattr(self, name, new)
+
+	def append(self, x, y, flags=0, color=0):
+		pending = self._pending
+		pending[0].append(x)
+		pending[1].append(y)
+		pending[2].append(flags)
+		pending[3].append(color)
+		if len(pending[0]) >= append_block_size:
+			self.flush()
+
+	def extend(self, x, y, flags=0, color=0):
+		if self._pending[0]:
+			self.flush()
+		n = self.count
+		m = len(x)
+		self.reserve(n + m)
+		self.x[n:n+m] = x
+		self.y[n:n+m] = y
+		self.flags[n:n+m] = flags
+		self.color[n:n+m] = color
+		self.count = n + m
+
+	def columns(self):
+		"""returns views (x, y, flags, color) on the used part of the arrays"""
+		self.flush()
+		n = self.count
+		return (self.x[:n], self.y[:n], self.flags[:n], self.color[:n])
+
+	@staticmethod
+	def from_columns(x, y, flags=0, color=0):
+		s = StitchArray(len(x))
+		s.extend(x, y, flags, color)
+		return s
+
+	@staticmethod
+	def from_points(points):
+		n = len(points)
+		s = StitchArray(n)
+		s.x[:n] = [p.x for p in points]
+		s.y[:n] = [p.y for p in points]
+		s.flags[:n] = [JUMP if p.jump else 0 for p in points]
+		s.color[:n] = [p.color for p in points]
+		s.count = n
+		return s
+
+	def to_points(self):
+		return points_from_columns(*self.columns())
+
+
+def _as_list(values):
+	# python list of a sequence or numpy array (numpy scalars converted)
+	if hasattr(values, "tolist"):
+		return values.tolist()
+	return list(values)
+
+def points_from_columns(x, y, flags, color):
+	"""builds a list of Points from stitch column arrays"""
+	jumps = (flags & JUMP).astype(bool).tolist()
+	return [Point(px, py, pj, pc) for (px, py, pj, pc) in 
+		zip(x.tolist(), y.tolist(), jumps, color.tolist())]
+
+
+############################################
+#### STITCH DENSITY
+############################################
+
+DENSITY_KEY_BITS = 31
+DENSITY_KEY_OFFSET = 1 << (DENSITY_KEY_BITS - 1)
+
+class DensityGrid:
+	"""sparse grid counting needle penetrations per cell.
+
+	Cells are cell_size units (0.1 mm) wide. Each cell is stored under 
+	a packed integer key, so no strings are built per stitch.
+	"""
+	def __init__(self, cell_size=1):
+		self.cell_size = cell_size
+		self.cells = dict()
+		self.maxCount = 0
+
+	def __len__(self):
+		return len(self.cells)
+
+	def key(self, x, y):
+		"""packed integer key of the cell containing x, y"""
+		cx = int(x // self.cell_size) + DENSITY_KEY_OFFSET
+		cy = int(y // self.cell_size) + DENSITY_KEY_OFFSET
+		return (cx << DENSITY_KEY_BITS) | cy
+
+	def cell(self, key):
+		"""returns the origin (x, y) of the cell stored under key"""
+		cx = (key >> DENSITY_KEY_BITS) - DENSITY_KEY_OFFSET
+		cy = (key & ((1 << DENSITY_KEY_BITS) - 1)) - DENSITY_KEY_OFFSET
+		return (cx * self.cell_size, cy * self.cell_size)
+
+	def add(self, x, y):
+		k = self.key(x, y)
+		n = self.cells.get(k, 0) + 1
+		self.cells[k] = n
+		if n > self.maxCount:
+			self.maxCount = n
+
+	def add_columns(self, x, y):
+		"""counts all points of two coordinate arrays in one pass"""
+		if len(x) == 0:
+			return
+		cx = numpy.floor(numpy.asarray(x) / self.cell_size).astype(numpy.int64)
+		cy = numpy.floor(numpy.asarray(y) / self.cell_size).astype(numpy.int64)
+		keys = ((cx + DENSITY_KEY_OFFSET) << DENSITY_KEY_BITS) | (cy + DENSITY_KEY_OFFSET)
+		(keys, counts) = numpy.unique(keys, return_counts=True)
+		cells = self.cells
+		if not cells:
+			cells.update(zip(keys.tolist(), counts.tolist()))
+		else:
+			for (k, n) in zip(keys.tolist(), counts.tolist()):
+				cells[k] = cells.get(k, 0) + n
+		self.maxCount = max(cells.itervalues())
+
+	def count(self, x, y):
+		"""number of stitches in the cell containing x, y"""
+		return self.cells.get(self.key(x, y), 0)
+
+	def max(self):
+		"""highest stitch count of any cell"""
+		return self.maxCount
+
+	def counts(self):
+		"""returns a list of (x, y, count) for every occupied cell"""
+		return [self.cell(k) + (n,) for (k, n) in self.cells.iteritems()]
+
+	def hotspots(self, threshold=density_max):
+		"""cells with more than threshold stitches
+
+		Returns:
+			list of (x, y, count), densest first
+		"""
+		if self.maxCount <= threshold:
+			return []
+		spots = [self.cell(k) + (n,) for (k, n) in self.cells.iteritems() 
+			if n > threshold]
+		spots.sort(key=lambda s: -s[2])
+		return spots
+
+
+def round_half_away(a):
+	"""vectorized int(round(x)) - python 2 rounds halves away from zero,
+	numpy.round rounds them to even"""
+	return (numpy.sign(a) * numpy.floor(numpy.absolute(a) + 0.5)).astype(numpy.int64)
+
+
 ############################################
 #### MAIN EMBROIDERY CLASS
 ############################################
 
-class Embroidery:
-	def __init__(self):
-		self.coords = []
+class Embroidery(object):
+	def __init__(self, columnar=None, track_density=True):
+		"""create an empty design
+
+		Args:
+			columnar: keep stitches in numpy arrays instead of a list of 
+				Points (default = None, use numpy if it is installed)
+			track_density: count stitch density on every addStitch, 
+				otherwise it is computed in one pass when needed (default = True)
+		"""
+		if columnar is None:
+			columnar = numpy is not None
+		if columnar and numpy is None:
+			raise ImportError("columnar stitch storage requires numpy")
+		self.columnar = columnar
+		if columnar:
+			self._stitches = StitchArray()
+			self._points = None
+		else:
+			self._stitches = None
+			self._points = []
 		self.clamp = max_stitch_len
-		self.minx = 0
-		self.maxx = 0
-		self.miny = 0
-		self.maxy = 0
+		self._shared = False
+		self._matrix = None
+		self._matrix_base = None
+		self._reset_stats()
 		self.tooLong = 0
-		self.densityWarning = False
-		self.density = dict()
-		
+		self._track_density = track_density
+		self._density = DensityGrid()
+		self._density_valid = track_density
+
+	@property
+	def coords(self):
+		"""list of Points - built lazily from the stitch columns.
+		The list is handed out for modification, so it stays the 
+		authoritative storage until a vectorized operation needs 
+		the columns again. Extents, statistics and density are 
+		recomputed once after each access; changes made through a 
+		list kept from an earlier access need invalidateStats().
+		"""
+		self._apply_transform()
+		if self._points is None:
+			self._points = self._stitches.to_points()
+			self._stitches = None
+		self._shared = True
+		self._stats_valid = False
+		self._density_valid = False
+		return self._points
+
+	@coords.setter
+	def coords(self, coords):
+		self._points = coords
+		self._stitches = None
+		self._matrix = None
+		self._shared = True
+		self._stats_valid = False
+		self._density_valid = False
+
+	def _set_points(self, points):
+		# replace the stitches with a list of Points built internally
+		self._points = points
+		self._stitches = None
+		self._matrix = None
+		self._shared = False
+		self._stats_valid = False
+		self._density_valid = False
+
+	def _set_columns(self, x, y, flags, color):
+		# replace the stitches with new column arrays
+		self._set_stitches(StitchArray.from_columns(x, y, flags, color))
+
+	def _set_stitches(self, stitches):
+		# replace the stitches with a StitchArray
+		self._stitches = stitches
+		self._points = None
+		self._matrix = None
+		self._shared = False
+		self._stats_valid = False
+		self._density_valid = False
+
+	def _store(self):
+		# the StitchArray, converted back from Points if necessary - only
+		# for operations that change the design, a coords list held by 
+		# a caller is detached from it
+		self._apply_transform()
+		if self._stitches is None:
+			self._stitches = StitchArray.from_points(self._points)
+			self._points = None
+			self._shared = False
+		return self._stitches
+
+	def _point_list(self):
+		# Points for read-only loops, without handing out ownership
+		self._apply_transform()
+		if self._points is not None:
+			return self._points
+		return self._stitches.to_points()
+
+	def _columns(self):
+		# stitch columns for read-only passes, without taking ownership:
+		# built from the Points for the time of the pass if they are 
+		# the storage
+		self._apply_transform()
+		if self._stitches is not None:
+			return self._stitches.columns()
+		return StitchArray.from_points(self._points).columns()
+
+	def columns(self):
+		"""returns the stitch columns (x, y, flags, color) as numpy arrays.
+		These are views - changing them changes the design.
+		"""
+		if not self.columnar:
+			raise ImportError("columnar stitch storage requires numpy")
+		self._stats_valid = False
+		self._density_valid = False
+		return self._store().columns()
+
+	def __len__(self):
+		if self._points is not None:
+			return len(self._points)
+		return len(self._stitches)
+
+	def content_hash(self):
+		"""hex digest of the stitches (positions, flags and colors) -
+		equal for equal designs, e.g. to key cached outputs
+		"""
+		import hashlib
+		h = hashlib.sha1()
+		if numpy is not None:
+			for column in self._columns():
+				h.update(numpy.ascontiguousarray(column).tobytes())
+		else:
+			for p in self._point_list():
+				h.update("%r %r %d %d;" % (p.x, p.y, p.jump and JUMP or 0, p.color))
+		return h.hexdigest()
+
+	def copy(self):
+		"""returns an independent copy of the design - changing one of
+		them (transforms, flatten, effects, ...) leaves the other as it is
+		"""
+		other = copy.copy(self)
+		if self._stitches is not None:
+			other._stitches = StitchArray.from_columns(*self._stitches.columns())
+		if self._points is not None:
+			other._points = [Point(p.x, p.y, p.jump, p.color) for p in self._points]
+		other._shared = False
+		other._density = DensityGrid(self._density.cell_size)
+		other._density.cells = dict(self._density.cells)
+		other._density.maxCount = self._density.maxCount
+		return other
+
+	def _last_stitch(self):
+		# (x, y) of the last stitch, None if there is none
+		if self._points is not None:
+			if self._points:
+				p = self._points[-1]
+				return (p.x, p.y)
+			return None
+		return self._stitches.last()
+
 	def setMaxStitchLength(self, clamp=max_stitch_len):
 		self.clamp = clamp
 
 	def addStitch(self, coord):
-		self.coords.append(coord)
-		
-		# calculate density on given points
-		if self.density.has_key(coord.toString()):
-			self.density[coord.toString()] += 1
-			if self.density[coord.toString()] > density_max:
-				self.densityWarning = True
+		if self._matrix is not None:
+			self._apply_transform()
+		last = self._last_stitch()
+		(x, y) = (coord.x, coord.y)
+		if self._points is not None:
+			self._points.append(coord)
 		else:
-			self.density[coord.toString()] = 1
-			
+			self._stitches.append(x, y, coord.jump and JUMP or 0, coord.color)
+
 		# calculate length warnings:
-		if len(self.coords) > 1:
-			delta = coord - self.coords[-2]		
-			dmax = max(abs(delta.x), abs(delta.y))
+		if last is not None:
+			dmax = max(abs(x - last[0]), abs(y - last[1]))
 			if dmax > max_stitch_len:
 				self.tooLong += 1
 
+		# keep extents and statistics up to date
+		if self._stats_valid:
+			if last is None:
+				(self.minx, self.maxx) = (x, x)
+				(self.miny, self.maxy) = (y, y)
+			else:
+				if x < self.minx: self.minx = x
+				elif x > self.maxx: self.maxx = x
+				if y < self.miny: self.miny = y
+				elif y > self.maxy: self.maxy = y
+				if dmax > self.maxStitchLength:
+					self.maxStitchLength = dmax
+			if coord.jump:
+				self.jumpCount += 1
 		
-	def getSize(self):
-		(self.maxx, self.maxy) = (self.coords[0].x, self.coords[0].y)
-		(self.minx, self.miny) = (self.coords[0].x, self.coords[0].y)
-		for p in self.coords:
-			self.minx = min(self.minx, p.x)
-			self.miny = min(self.miny, p.y)
-			self.maxx = max(self.maxx, p.x)
-			self.maxy = max(self.maxy, p.y)
+		# count stitch density
+		if self._density_valid:
+			if self._track_density:
+				self._density.add(x, y)
+			else:
+				self._density_valid = False
+
+	def addStitches(self, x, y, flags=0, color=0):
+		"""append many stitches at once from coordinate columns
+
+		Args:
+			x, y: sequences/arrays of absolute coordinates
+			flags: JUMP/TRIM/COLOR_CHANGE flags, array or scalar (default = 0)
+			color: color index, array or scalar (default = 0)
+		"""
+		if self._points is not None:
+			# the Points stay the storage - a caller may hold them
+			(x, y) = (_as_list(x), _as_list(y))
+			if not hasattr(flags, "__len__"):
+				flags = [flags] * len(x)
+			if not hasattr(color, "__len__"):
+				color = [color] * len(x)
+			for (px, py, pf, pc) in zip(x, y, _as_list(flags), _as_list(color)):
+				self.addStitch(Point(px, py, bool(pf & JUMP), pc))
+			return
+		x = numpy.asarray(x, numpy.float64)
+		y = numpy.asarray(y, numpy.float64)
+		if len(x) == 0:
+			return
+		flags = numpy.broadcast_to(numpy.asarray(flags, numpy.uint8), x.shape)
+		s = self._store()
+		first = len(s) == 0
+		if not first:
+			(px, py) = (s.x[len(s)-1], s.y[len(s)-1])
+		else:
+			(px, py) = (x[0], y[0])
+		s.extend(x, y, flags, color)
+		dmax = numpy.maximum(
+			numpy.absolute(numpy.diff(x, prepend=px)),
+			numpy.absolute(numpy.diff(y, prepend=py)))
+		self.tooLong += int(numpy.count_nonzero(dmax > max_stitch_len))
+
+		if self._stats_valid:
+			(minx, maxx) = (x.min().item(), x.max().item())
+			(miny, maxy) = (y.min().item(), y.max().item())
+			if first:
+				(self.minx, self.maxx, self.miny, self.maxy) = (minx, maxx, miny, maxy)
+			else:
+				(self.minx, self.maxx) = (min(self.minx, minx), max(self.maxx, maxx))
+				(self.miny, self.maxy) = (min(self.miny, miny), max(self.maxy, maxy))
+			self.maxStitchLength = max(self.maxStitchLength, dmax.max().item())
+			self.jumpCount += int(numpy.count_nonzero(flags & JUMP))
+
+		if self._density_valid:
+			if self._track_density:
+				self._density.add_columns(x, y)
+			else:
+				self._density_valid = False
+
+	############################################
+	#### EXTENTS AND STATISTICS
+	############################################
+
+	def _reset_stats(self):
+		(self.minx, self.maxx) = (0, 0)
+		(self.miny, self.maxy) = (0, 0)
+		self.jumpCount = 0
+		self.maxStitchLength = 0
+		self._stats_valid = True
+
+	def invalidateStats(self):
+		"""mark cached extents, statistics and density as stale - call this 
+		after changing Points in place; they are recomputed on next use
+		"""
+		self._stats_valid = False
+		self._density_valid = False
+
+	def _update_stats(self):
+		# recompute extents and statistics if the cache is stale - after
+		# each coords access, as the caller may change the Points
+		if self._stats_valid:
+			return
+		self._apply_transform()
+		self._reset_stats()
+		if len(self) == 0:
+			return
+		if self._points is None:
+			(x, y, flags, color) = self._stitches.columns()
+			(self.minx, self.maxx) = (x.min().item(), x.max().item())
+			(self.miny, self.maxy) = (y.min().item(), y.max().item())
+			self.jumpCount = int(numpy.count_nonzero(flags & JUMP))
+			if len(x) > 1:
+				self.maxStitchLength = numpy.maximum(
+					numpy.absolute(numpy.diff(x)),
+					numpy.absolute(numpy.diff(y))).max().item()
+		else:
+			last = self._points[0]
+			(self.minx, self.maxx) = (last.x, last.x)
+			(self.miny, self.maxy) = (last.y, last.y)
+			for p in self._points:
+				self.minx = min(self.minx, p.x)
+				self.miny = min(self.miny, p.y)
+				self.maxx = max(self.maxx, p.x)
+				self.maxy = max(self.maxy, p.y)
+				self.maxStitchLength = max(self.maxStitchLength, 
+					abs(p.x - last.x), abs(p.y - last.y))
+				if p.jump:
+					self.jumpCount += 1
+				last = p
+		self._stats_valid = True
+
+	def getExtents(self):
+		"""returns the bounding box as (minx, miny, maxx, maxy)"""
+		self._update_stats()
+		return (self.minx, self.miny, self.maxx, self.maxy)
+
+	def getStats(self):
+		"""returns cached design statistics
+
+		Returns:
+			dict with stitches, jumps, minx, miny, maxx, maxy and 
+			max_stitch_length (largest move along one axis)
+		"""
+		self._update_stats()
+		return {
+			"stitches": len(self),
+			"jumps": self.jumpCount,
+			"minx": self.minx,
+			"miny": self.miny,
+			"maxx": self.maxx,
+			"maxy": self.maxy,
+			"max_stitch_length": self.maxStitchLength,
+		}
+
+	############################################
+	#### DENSITY
+	############################################
+
+	def setDensityTracking(self, enabled=True, cell_size=None):
+		"""turn counting of stitch density on every addStitch on or off.
+		Turn it off for bulk imports - density is then computed in one 
+		pass when it is queried.
+
+		Args:
+			enabled: boolean
+			cell_size: size of the density cells in 0.1mm units (default = unchanged)
+		"""
+		self._track_density = enabled
+		if cell_size is not None and cell_size != self._density.cell_size:
+			self._density = DensityGrid(cell_size)
+			self._density_valid = False
+		if not enabled:
+			self._density_valid = False
+
+	def computeDensity(self, cell_size=None):
+		"""count stitch density over the whole design in one pass
+
+		Args:
+			cell_size: size of the density cells in 0.1mm units (default = unchanged)
+		Returns:
+			DensityGrid
+		"""
+		if cell_size is None:
+			cell_size = self._density.cell_size
+		grid = DensityGrid(cell_size)
+		self._apply_transform()
+		if self._points is None:
+			(x, y, flags, color) = self._stitches.columns()
+			grid.add_columns(x, y)
+		else:
+			for p in self._points:
+				grid.add(p.x, p.y)
+		self._density = grid
+		self._density_valid = True
+		return grid
+
+	@property
+	def density(self):
+		"""DensityGrid of the current design - recomputed if stale"""
+		if not self._density_valid:
+			self.computeDensity()
+		return self._density
+
+	@property
+	def densityWarning(self):
+		return self.density.max() > density_max
 
+	def getSize(self):
+		self._update_stats()
 		sx = int( self.maxx - self.minx )
 		sy = int( self.maxy - self.miny )
 		return (sx,sy)
@@ -138,33 +912,103 @@ class Embroidery:
 		
 	def info(self):
 		info_str = "";
-		info_str = "stitchcount: %d\n" % (len(self.coords))
+		info_str = "stitchcount: %d\n" % (len(self))
 		info_str = info_str + "size: %0.2f x %0.2f mm\n" % (self.getMetricWidth(), self.getMetricHeight())
-		if self.densityWarning:
-			info_str += "DENSITY WARNING!\n"
+		density = self.density
+		if density.max() > density_max:
+			info_str += "DENSITY WARNING! (%d hotspots, up to %d stitches)\n" % (
+				len(density.hotspots()), density.max())
 		return info_str
 		
+	############################################
+	#### TRANSFORMS
+	############################################
+
+	def transform(self, a, b, c, d, e, f):
+		"""apply an affine transform x' = a*x + b*y + c, y' = d*x + e*y + f.
+		Transforms are composed and applied to the stitches in one pass 
+		when they are read next (export, rendering, coords, ...).
+		"""
+		if self._matrix is None:
+			# (tx, ty, a, b, d, e, cx, cy): x' = a*(x+tx) + b*(y+ty) + cx, ...
+			# a translation before the first linear step stays in tx, ty,
+			# so translate, scale, translate rounds like doing it step by step
+			self._matrix = (0, 0, 1, 0, 0, 1, 0, 0)
+			self._matrix_base = None
+			if self._stats_valid:
+				self._matrix_base = (self.minx, self.maxx, self.miny, self.maxy, self.maxStitchLength)
+		(tx, ty, ma, mb, md, me, cx, cy) = self._matrix
+		identity = (ma, mb, md, me) == (1, 0, 0, 1)
+		if (a, b, d, e) == (1, 0, 0, 1):
+			if identity:
+				(tx, ty) = (tx + c, ty + f)
+			else:
+				(cx, cy) = (cx + c, cy + f)
+		else:
+			(ma, mb, md, me, cx, cy) = (a * ma + b * md, a * mb + b * me,
+				d * ma + e * md, d * mb + e * me, a * cx + b * cy + c, d * cx + e * cy + f)
+		self._matrix = (tx, ty, ma, mb, md, me, cx, cy)
+		self._density_valid = False
+		# extents follow exactly as long as axes stay axes
+		if self._matrix_base is None or mb != 0 or md != 0 or abs(ma) != abs(me):
+			self._stats_valid = False
+		else:
+			(minx, maxx, miny, maxy, length) = self._matrix_base
+			(self.minx, self.maxx) = sorted(((minx + tx) * ma + cx, (maxx + tx) * ma + cx))
+			(self.miny, self.maxy) = sorted(((miny + ty) * me + cy, (maxy + ty) * me + cy))
+			self.maxStitchLength = length * abs(ma)
+			self._stats_valid = True
+		if self._shared:
+			# somebody holds the Points, do not keep them waiting
+			self._apply_transform()
+
+	def _apply_transform(self):
+		# apply the pending transform to the stitches - one vectorized pass
+		if self._matrix is None:
+			return
+		(tx, ty, a, b, d, e, cx, cy) = self._matrix
+		self._matrix = None
+		self._matrix_base = None
+		with stage("apply_transform") as st:
+			st.count("stitches", len(self))
+			if self._points is None:
+				(x, y, flags, color) = self._stitches.columns()
+				x += tx
+				y += ty
+				if b == 0 and d == 0:
+					x *= a
+					x += cx
+					y *= e
+					y += cy
+				else:
+					(x[:], y[:]) = (x * a + y * b + cx, x * d + y * e + cy)
+			elif b == 0 and d == 0:
+				for p in self._points:
+					p.x = (p.x + tx) * a + cx
+					p.y = (p.y + ty) * e + cy
+			else:
+				for p in self._points:
+					(u, v) = (p.x + tx, p.y + ty)
+					(p.x, p.y) = (u * a + v * b + cx, u * d + v * e + cy)
+
+	def translate(self, dx, dy):
+		"""moves the design
+
+		Args:
+			dx, dy: offset
+		"""
+		self.transform(1, 0, dx, 0, 1, dy)
+
 	def translate_to_origin(self):
 		"""translates embroidery to origin
 
 		Args: none
 		"""
-		(self.minx, self.maxx) = (self.coords[0].x, self.coords[0].x)
-		(self.miny, self.maxy) = (self.coords[0].y, self.coords[0].y)
-		if (len(self.coords)==0):
+		if (len(self)==0):
 			return
-		for p in self.coords:
-			self.minx = min(self.minx, p.x)
-			self.miny = min(self.miny, p.y)
-			self.maxx = max(self.maxx, p.x)
-			self.maxy = max(self.maxy, p.y)
-		sx = self.maxx - self.minx
-		sy = self.maxy - self.miny
-	
-		for p in self.coords:
-			p.x -= self.minx
-			p.y -= self.miny
-		dbg.write("translated to origin. resulting field size: %0.2fmm x %0.2fmm\n" % (sx/10, sy/10))
+		(sx, sy) = self.getSize()
+		self.translate(-self.minx, -self.miny)
+		log("translated to origin. resulting field size: %0.2fmm x %0.2fmm\n", sx/10.0, sy/10.0)
 
 	def scale(self, factor):
 		"""scales embroidery design
@@ -172,11 +1016,154 @@ class Embroidery:
 		Args:
 			factor: multiplication factor (1 means no scaling)
 		"""		
-		dbg.write("scale to %d%%\n" % (factor * 100))
-		for p in self.coords:
-			p.x *= factor
-			p.y *= factor
+		log("scale to %d%%\n", factor * 100)
+		self.transform(factor, 0, 0, 0, factor, 0)
+
+	def rotate(self, angle):
+		"""rotates the design counter-clockwise around the origin -
+		use translate_to_origin afterwards to move it back
+
+		Args:
+			angle: in degrees
+		"""
+		log("rotate by %s degrees\n", angle)
+		# exact values for right angles
+		right = {0: (1, 0), 90: (0, 1), 180: (-1, 0), 270: (0, -1)}
+		if angle % 360 in right:
+			(cos, sin) = right[angle % 360]
+		else:
+			(cos, sin) = (math.cos(math.radians(angle)), math.sin(math.radians(angle)))
+		self.transform(cos, -sin, 0, sin, cos, 0)
+
+	def mirror(self, horizontal=True, vertical=False):
+		"""mirrors the design at the y axis (horizontal) and/or the 
+		x axis (vertical) - use translate_to_origin afterwards to move 
+		it back
 
+		Args:
+			horizontal: flip left and right (default = True)
+			vertical: flip top and bottom (default = False)
+		"""
+		self.transform(horizontal and -1 or 1, 0, 0, 0, vertical and -1 or 1, 0)
+
+	@staged("apply_effect")
+	def apply_effect(self, effect):
+		"""expand the design with a stitch effect - see triple_effect
+		and the other effects for the format
+
+		Args:
+			effect: list of (condition, point templates)
+		"""
+		n = len(self)
+		if n == 0:
+			return
+		self._apply_transform()
+		if not self.columnar:
+			self._apply_effect_points(effect)
+			return
+		(x, y, flags, color) = self._store().columns()
+		ix = round_half_away(x)
+		iy = round_half_away(y)
+		dx = numpy.diff(ix, prepend=ix[0])
+		dy = numpy.diff(iy, prepend=iy[0])
+		length = numpy.sqrt(dx.astype(numpy.float64) ** 2 + dy.astype(numpy.float64) ** 2)
+		def shift(a, segment):
+			# a[i + segment], zero outside the design
+			out = numpy.zeros_like(a)
+			if segment < 0:
+				out[-segment:] = a[:segment]
+			elif segment > 0:
+				out[:-segment] = a[segment:]
+			else:
+				out[:] = a
+			return out
+		context = EffectContext(index=numpy.arange(n), count=n,
+			jump=flags & JUMP, dmax=numpy.maximum(numpy.absolute(dx), numpy.absolute(dy)),
+			length=length, last_length=shift(length, -1), next_length=shift(length, 1))
+
+		# which groups each stitch emits - the first stitch is kept as it is
+		masks = []
+		count = numpy.zeros(n, numpy.int64)
+		for (condition, points) in effect:
+			if condition is None:
+				mask = numpy.ones(n, bool)
+			else:
+				mask = numpy.broadcast_to(condition(context), (n,)).copy()
+			mask[0] = False
+			masks.append(mask)
+			count += mask * len(points)
+		count[0] = 1
+
+		# emit all stitches into preallocated columns
+		pos = numpy.cumsum(count) - count
+		m = int(pos[-1] + count[-1])
+		nx = numpy.empty(m, numpy.float64)
+		ny = numpy.empty(m, numpy.float64)
+		nflags = numpy.zeros(m, numpy.uint8)
+		ncolor = numpy.empty(m, numpy.uint16)
+		(nx[0], ny[0], nflags[0], ncolor[0]) = (x[0], y[0], flags[0], color[0])
+		for ((condition, points), mask) in zip(effect, masks):
+			i = numpy.flatnonzero(mask)
+			p = pos[i]
+			for point in points:
+				if point[0] in ("stitch", "last"):
+					j = i if point[0] == "stitch" else i - 1
+					(nx[p], ny[p], nflags[p], ncolor[p]) = (x[j], y[j], flags[j], color[j])
+				else:
+					j = i if point[0] == "here" else i - 1
+					ncolor[p] = color[i]
+					(px, py) = (ix[j], iy[j])
+					if len(point) > 1:
+						(coef, segment, direction) = point[1:]
+						k = i + segment
+						(ux, uy) = (dx[k], dy[k])
+						if direction == NORMAL:
+							(ux, uy) = (-uy, ux)
+						px = px + coef * ux / length[k]
+						py = py + coef * uy / length[k]
+					(nx[p], ny[p]) = (px, py)
+				p = p + 1
+			pos[i] = p
+		self._set_columns(nx, ny, nflags, ncolor)
+
+	def _apply_effect_points(self, effect):
+		# apply_effect for the list backend - one pass over the Points
+		coords = self._points
+		n = len(coords)
+		ints = [p.as_int() for p in coords]
+		moves = [Point(0, 0)] + [b - a for (a, b) in zip(ints, ints[1:])]
+		lengths = [d.length() for d in moves] + [0]
+		new_coords = [coords[0]]
+		context = EffectContext(count=n)
+		for i in range(1, n):
+			stitch = coords[i]
+			context.index = i
+			context.jump = stitch.jump and JUMP or 0
+			context.dmax = max(abs(moves[i].x), abs(moves[i].y))
+			(context.last_length, context.length, context.next_length) = lengths[i-1:i+2]
+			for (condition, points) in effect:
+				if condition is not None and not condition(context):
+					continue
+				for point in points:
+					if point[0] == "stitch":
+						new_coords.append(stitch)
+					elif point[0] == "last":
+						new_coords.append(coords[i-1])
+					else:
+						p = ints[i] if point[0] == "here" else ints[i-1]
+						if len(point) == 1:
+							new_coords.append(Point(p.x, p.y, False, stitch.color))
+							continue
+						(coef, segment, direction) = point[1:]
+						d = moves[i + segment]
+						(ux, uy) = (d.x, d.y)
+						if direction == NORMAL:
+							(ux, uy) = (-uy, ux)
+						new_coords.append(Point(p.x + coef * ux / lengths[i + segment],
+							p.y + coef * uy / lengths[i + segment], False, stitch.color))
+		self._set_points(new_coords)
+
+	@staged("add_endstitches")
 	def add_endstitches(self, length=10, max_stitch_length=max_stitch_len):
 		"""adds endstitches before and after stitches that are too long
 
@@ -184,166 +1171,274 @@ class Embroidery:
 			length: length of end stitches (default = 10)
 			max_stitch_length: max. length for stitches (default = max_stitch_len = 121)
 		"""				
-		dbg.write("add endstitches BEGIN - stitch count: %d\n" % len(self.coords))
-		self.pos = self.coords[0]
-		new_coords = []
-		new_coords.append(self.coords[0])
-		for stitch in self.coords[1:]:		
-			new_int = stitch.as_int()
-			old_int = self.pos.as_int()
-			delta = new_int - old_int		
-			dmax = max(abs(delta.x), abs(delta.y))
-
-			if dmax <= max_stitch_length:
-				new_coords.append(stitch)				
-			else:
-				x2 = length * delta.x / delta.length()
-				y2 = length * delta.y / delta.length()
-				new_coords.append(Point(old_int.x+x2, old_int.y+y2))
-				new_coords.append(self.pos)
-				new_coords.append(stitch)			
-				new_coords.append(Point(new_int.x-x2, new_int.y-y2))
-				new_coords.append(stitch)						
-			self.pos = stitch
-		self.coords = new_coords
-		dbg.write("add endstitches END - stitch count: %d\n" % len(self.coords))
+		self.apply_effect(endstitch_effect(length, max_stitch_length))
 	
 	
+	@staged("add_endstitches_to_jumps")
 	def add_endstitches_to_jumps(self, length=10):		
 		"""adds endstitches before and after jumps.	
 
 		Args:
 			length: length of end stitches (default = 10)
 		"""				
-		dbg.write("add endstitches BEGIN - stitch count: %d\n" % len(self.coords))
-		self.pos = self.coords[0]
-		new_coords = []
-		new_coords.append(self.pos)
-
-		for j in range(1, len(self.coords)):
-			stitch = self.coords[j]		
-			if stitch.jump == True:
-				if j > 2:
-					l1_int = self.coords[j-1].as_int()
-					l2_int = self.coords[j-2].as_int()
-					delta = l1_int - l2_int
-					if delta.length() != 0:				
-						dx = length * delta.x / delta.length()
-						dy = length * delta.y / delta.length()					
-						new_coords.append(Point(l1_int.x - dx, l1_int.y - dy))
-						new_coords.append(self.coords[j-1])			
-				new_coords.append(stitch)				
-				#and after jump	
-				if j+1 < len(self.coords):
-					l3_int = self.coords[j].as_int()
-					l4_int = self.coords[j+1].as_int()
-					delta = l4_int - l3_int
-					if delta.length() != 0:				
-						dx = length * delta.x / delta.length()
-						dy = length * delta.y / delta.length()
-						new_coords.append(Point(l3_int.x + dx, l3_int.y + dy))
-						new_coords.append(Point(l3_int.x, l3_int.y))
-			else:
-				new_coords.append(stitch)
-								
-			self.pos = stitch
-		self.coords = new_coords
-		dbg.write("add endstitches END - stitch count: %d\n" % len(self.coords))		
+		self.apply_effect(jump_endstitch_effect(length))
 
+	@staged("to_triple_stitches")
 	def to_triple_stitches(self, length=2):
 		"""convert desgin to triple stitches
 
 		Args:
 			length: length/offset of triple (default = 2)
 		"""			
-		dbg.write("to_triple_stitches BEGIN - stitch count: %d\n" % len(self.coords))
-		self.pos = self.coords[0]
-		new_coords = []
-		new_coords.append(self.coords[0])
-		for stitch in self.coords[1:]:		
-			if not stitch.jump:
-				new_stitch = stitch.as_int()
-				last_stitch = self.pos.as_int()
-				delta = new_stitch - last_stitch	
-				if delta.length() != 0:
-					nx = length * -delta.y / delta.length()
-					ny = length * delta.x / delta.length()			
-					new_coords.append(Point(new_stitch.x - nx, new_stitch.y - ny))
-					new_coords.append(Point(last_stitch.x - nx, last_stitch.y - ny))
-			new_coords.append(stitch)				
-			self.pos = stitch
-		self.coords = new_coords
-		dbg.write("to_triple_stitches END - stitch count: %d\n" % len(self.coords))
+		self.apply_effect(triple_effect(length))
 
+	@staged("to_red_work")
 	def to_red_work(self, length=3):
 		"""convert desgin to red work stitches
 
 		Args:
 			length: length/offset of triple (default = 3)
 		"""					
-		dbg.write("to_triple_stitches BEGIN - stitch count: %d\n" % len(self.coords))
-		self.pos = self.coords[0]
-		new_coords = []
-		new_coords.append(self.coords[0])
-		for stitch in self.coords[1:]:		
-			if not stitch.jump:
-				new_stitch = stitch.as_int()
-				last_stitch = self.pos.as_int()
-				delta = new_stitch - last_stitch
-				if delta.length() != 0:				
-					nx = length * -delta.y / delta.length()
-					ny = length * delta.x / delta.length()			
-					new_coords.append(Point(new_stitch.x - nx, new_stitch.y - ny))
-					new_coords.append(Point(last_stitch.x - nx, last_stitch.y - ny))
-					new_coords.append(Point(new_stitch.x + nx, new_stitch.y + ny))
-					new_coords.append(Point(last_stitch.x + nx, last_stitch.y + ny))
-			new_coords.append(stitch)				
-			self.pos = stitch
-		self.coords = new_coords
-		dbg.write("to_triple_stitches END - stitch count: %d\n" % len(self.coords))
+		self.apply_effect(red_work_effect(length))
+
+	@staged("to_bean_stitches")
+	def to_bean_stitches(self):
+		"""convert design to bean stitches - every stitch is sewn 
+		three times, back and forth
+		"""
+		self.apply_effect(bean_effect())
 		
+	@staged("flatten")
 	def flatten(self, max_length=max_stitch_len):
-		"""flatten file - interpolate stitches that are too long
+		"""flatten file - interpolate stitches that are too long.
+		Zero length moves are dropped, so is the first stitch if it is 
+		a jump. Long jumps are kept as they are.
 
 		Args:
 			max_length: maximum stitch length (default = 121 for dst, exp could do 127)
 		"""					
-		dbg.write("flatten BEGIN - stitch count: %d\n" % len(self.coords))
-		self.pos = self.coords[0]
-		new_coords = []
-		## ignore first if its a jump
-		if not self.coords[0].jump:
-			new_coords.append(self.coords[0])
-		for stitch in self.coords[1:]:		
-			new_stitch = stitch.as_int()
-			last_stitch = self.pos.as_int()
-			delta = new_stitch - last_stitch
-			if delta.length:	
-				#do several interpolated steps if too long			
+		if (len(self)==0):
+			return
+		self._apply_transform()
+		if self.columnar:
+			(x, y, flags, color) = self._store().columns()
+			ix = round_half_away(x)
+			iy = round_half_away(y)
+			dx = numpy.diff(ix, prepend=ix[0])
+			dy = numpy.diff(iy, prepend=iy[0])
+			dmax = numpy.maximum(numpy.absolute(dx), numpy.absolute(dy))
+			split = (dmax > max_length) & ((flags & JUMP) == 0)
+
+			# number of output stitches per input stitch - all at once
+			steps = numpy.where(split, (dmax + max_length - 1) // max_length, 1)
+			steps[dmax == 0] = 0
+			steps[0] = not flags[0] & JUMP
+			index = numpy.repeat(numpy.arange(len(x)), steps)
+			(nx, ny, nflags, ncolor) = (x[index], y[index], flags[index], color[index])
+
+			# do several interpolated steps if too long
+			inner = split[index]
+			if inner.any():
+				src = index[inner]
+				i = (numpy.arange(len(index)) - (numpy.cumsum(steps) - steps)[index])[inner]
+				k = steps[src]
+				nx[inner] = ix[src - 1] + (i + 1) * dx[src] // k
+				ny[inner] = iy[src - 1] + (i + 1) * dy[src] // k
+				nflags[inner] = numpy.where(i + 1 == k, flags[src], 0)
+				count("stitches split", int((steps > 1).sum()))
+			self._set_columns(nx, ny, nflags, ncolor)
+		else:
+			coords = self._points
+			new_coords = []
+			## ignore first if its a jump
+			if not coords[0].jump:
+				new_coords.append(coords[0])
+			last_stitch = coords[0].as_int()
+			for stitch in coords[1:]:		
+				new_stitch = stitch.as_int()
+				delta = new_stitch - last_stitch
 				dmax = max(abs(delta.x), abs(delta.y))
-				dsteps = abs(dmax / max_length) + 1
-				if dmax > max_length and not stitch.jump:
-					for i in range(0, dsteps):					
-						x =  last_stitch.x + (i+1) * delta.x/dsteps					
-						y = last_stitch.y +  (i+1) * delta.y/dsteps
-						new_coords.append(Point(x, y))			
-				else:
-					new_coords.append(stitch)
-				self.pos = stitch
-		self.coords = new_coords
-		dbg.write("flatten END - stitch count: %d\n" % len(self.coords))
+				if dmax:	
+					#do several interpolated steps if too long			
+					if dmax > max_length and not stitch.jump:
+						dsteps = (dmax + max_length - 1) / max_length
+						count("stitches split")
+						for i in range(0, dsteps):					
+							x = last_stitch.x + (i+1) * delta.x/dsteps					
+							y = last_stitch.y + (i+1) * delta.y/dsteps
+							new_coords.append(Point(x, y, False, stitch.color))
+					else:
+						new_coords.append(stitch)
+					last_stitch = new_stitch
+			self._set_points(new_coords)
+
+	@staged("simplify")
+	def simplify(self, tolerance=2, min_length=0, max_length=max_stitch_len):
+		"""drops stitches that hardly change the path (Ramer-Douglas-Peucker
+		on every jump free part) and merges stitches shorter than
+		min_length. Jumps, color changes and trims are kept.
+
+		Args:
+			tolerance: max. distance of a dropped stitch from the new path (default = 2)
+			min_length: merge shorter stitches, 0 to keep them (default = 0)
+			max_length: no new stitch gets longer than this (default = 121)
+		"""
+		n = len(self)
+		if n < 3:
+			return
+		self._apply_transform()
+		min_length = min(min_length, max_length / 2.0)
+		if self.columnar:
+			(x, y, flags, color) = self._store().columns()
+			(fx, fy) = (x.astype(numpy.float64), y.astype(numpy.float64))
+			# the ends of the jump free parts stay
+			fixed = (flags & (JUMP | TRIM | COLOR_CHANGE)) != 0
+			fixed[:-1] |= (flags[1:] & JUMP) != 0
+			fixed[1:] |= color[1:] != color[:-1]
+			fixed[:-1] |= color[1:] != color[:-1]
+			fixed[0] = fixed[-1] = True
+			keep = simplify_keep(fx, fy, fixed, tolerance, max_length)
+			if min_length > 0:
+				index = numpy.flatnonzero(keep)
+				keep[index] = merge_keep(fx[index], fy[index], fixed[index], min_length)
+			self._set_columns(x[keep], y[keep], flags[keep], color[keep])
+		else:
+			coords = self._points
+			(xs, ys) = ([float(p.x) for p in coords], [float(p.y) for p in coords])
+			fixed = [i == 0 or i == n - 1 or bool(coords[i].jump) or bool(coords[i+1].jump)
+				or coords[i].color != coords[i-1].color or coords[i].color != coords[i+1].color
+				for i in range(n)]
+			keep = simplify_keep_points(xs, ys, fixed, tolerance, max_length)
+			if min_length > 0:
+				index = [i for i in range(n) if keep[i]]
+				merged = merge_keep_points([xs[i] for i in index], [ys[i] for i in index],
+					[fixed[i] for i in index], min_length)
+				for (i, k) in zip(index, merged):
+					keep[i] = k
+			self._set_points([coords[i] for i in range(n) if keep[i]])
+
+	@staged("optimize_jumps")
+	def optimize_jumps(self, reverse=True, passes=10):
+		"""reorders the parts of the design between jumps to shorten
+		the jumps - nearest neighbour order improved by 2-opt moves.
+		Color blocks keep their order and the first part stays first.
+		Runs of jumps become one direct jump.
+
+		Args:
+			reverse: parts may be sewn backwards (default = True)
+			passes: max. number of 2-opt passes (default = 10)
+		Returns:
+			(before, after) - total jump distance
+		"""
+		n = len(self)
+		if n == 0:
+			return (0, 0)
+		self._apply_transform()
+		if self.columnar:
+			(x, y, flags, color) = self._columns()
+			jump = ((flags & JUMP) != 0).tolist()
+			(xs, ys, colors) = (x.tolist(), y.tolist(), color.tolist())
+		else:
+			coords = self._points
+			jump = [bool(p.jump) for p in coords]
+			(xs, ys, colors) = ([p.x for p in coords], [p.y for p in coords], [p.color for p in coords])
+		def distance(i, j):
+			return math.hypot(xs[i] - xs[j], ys[i] - ys[j])
+		before = sum(distance(i - 1, i) for i in range(1, n) if jump[i])
+		count("jumps", sum(jump))
+
+		# split into segments at jumps (the last one of a run of jumps)
+		# and at color changes
+		segments = []
+		for i in range(n):
+			if jump[i] and i + 1 < n and jump[i+1]:
+				continue
+			if not segments or jump[i] or colors[i] != colors[segments[-1][-1]]:
+				segments.append([i])
+			else:
+				segments[-1].append(i)
+
+		# order the segments of each color block, starting where the
+		# block before ends
+		tour = [(0, False)]
+		k = 1
+		while k < len(segments):
+			block = [k]
+			k += 1
+			while k < len(segments) and colors[segments[k][0]] == colors[segments[block[0]][0]]:
+				block.append(k)
+				k += 1
+			(s, r) = tour[-1]
+			last = segments[s][r and 0 or -1]
+			heads = [(xs[segments[b][0]], ys[segments[b][0]]) for b in block]
+			tails = [(xs[segments[b][-1]], ys[segments[b][-1]]) for b in block]
+			tour += [(block[b], r) for (b, r) in
+				order_segments(heads, tails, (xs[last], ys[last]), reverse, passes)]
+
+		# sew the segments in the new order - a segment starts with a 
+		# jump unless it still follows the stitch it followed before
+		index = []
+		new_jump = []
+		for (s, r) in tour:
+			points = r and segments[s][::-1] or segments[s]
+			if not index:
+				new_jump.append(jump[points[0]])
+			else:
+				follows = not r and points[0] == index[-1] + 1 and not jump[points[0]]
+				new_jump.append(not follows)
+			new_jump += [False] * (len(points) - 1)
+			index += points
+		after = sum(distance(index[i-1], index[i]) for i in range(1, len(index)) if new_jump[i])
+		if after >= before:
+			log("optimize jumps: %d parts, jump distance %0.1fmm - kept\n",
+				len(segments), before / 10.0)
+			return (before, before)
+
+		if self.columnar:
+			index = numpy.array(index, numpy.int64)
+			new_flags = flags[index] & numpy.uint8(0xFF ^ JUMP)
+			new_flags[numpy.array(new_jump, bool)] |= JUMP
+			new_color = color[index]
+			if (flags & COLOR_CHANGE).any():
+				# color changes stay at the start of the color blocks
+				new_flags &= numpy.uint8(0xFF ^ COLOR_CHANGE)
+				new_flags[1:][new_color[1:] != new_color[:-1]] |= COLOR_CHANGE
+			self._set_columns(x[index], y[index], new_flags, new_color)
+		else:
+			new_coords = []
+			for (i, j) in zip(index, new_jump):
+				p = coords[i]
+				if bool(p.jump) != j:
+					p = Point(p.x, p.y, j, p.color)
+				new_coords.append(p)
+			self._set_points(new_coords)
+		log("optimize jumps: %d parts, jump distance %0.1fmm -> %0.1fmm\n",
+			len(segments), before / 10.0, after / 10.0)
+		return (before, after)
 
 	############################################
 	#### FILE IMPORT AND EXPORT
 	############################################
 
-	def save(self, filename):
+	def save(self, filename, cache=None):
 		"""save design as file - a wrapper that figures out which format
 			funtion to use by filename extension
 		Args:
 			filename
+			cache: ConversionCache - an output saved before from the same
+				stitches in the same format is copied from there (default = None)
 		"""					
 		ext = (filename[-3:]).lower()
+		key = None
+		if cache is not None:
+			options = {}
+			if ext == "png":
+				options = {"pixels_per_millimeter": pixels_per_millimeter,
+					"line_color": png_line_color}
+			key = cache.key(self.content_hash(), ext, options)
+			if cache.fetch(key, filename):
+				log("copied from cache: %s\n", filename)
+				return
 		if ext == "exp":
 			self.save_as_exp(filename)
 		elif ext == "png":
@@ -356,29 +1451,164 @@ class Embroidery:
 			self.save_as_ksm(filename)
 		elif ext == "dst":
 			self.save_as_dst(filename)
+		elif ext == "stc":
+			self.save_native(filename)
 		else:
-			dbg.write("error saving file: unknown file extension: %s\n" % (filename))
-			
+			log("error saving file: unknown file extension: %s\n", filename)
+			return
+		if key is not None:
+			cache.store(key, filename)
 			
-	def load(self, filename):
+	def load(self, filename, cache=None):
 		"""import design from file - a wrapper that figures out which format
 			funtion to use by filename extension
 		Args:
 			filename
+			cache: ConversionCache - the decoded design is kept there in the
+				native format and read from it without decoding next time 
+				(default = None)
 		"""					
 		ext = (filename[-3:]).lower()
+		key = None
+		if cache is not None and ext != "stc" and len(self) == 0:
+			key = cache.key(cache.input_hash(filename), "stc", {})
+			path = cache.lookup(key)
+			if path is not None:
+				try:
+					self.load_native(path)
+					return
+				except IOError:
+					# evicted by another process meanwhile
+					pass
 		if ext == "exp":
 			self.import_melco(filename)
-		if ext == "dst":
+		elif ext == "dst":
 			self.import_tajima(filename)
 		elif ext == "pes":
 			self.import_pes(filename)
 		elif ext == "svg":
 			self.import_svg(filename)
+		elif ext == "stc":
+			self.load_native(filename)
 		else:
-			dbg.write("error loading file: unknown input file extension: %s\n" % (filename))
+			log("error loading file: unknown input file extension: %s\n", filename)
+			return
+		if key is not None:
+			cache.store_design(key, self)
 			
 
+	############################################
+	#### STREAMING EXPORT
+	############################################
+
+	def write(self, fileobj, format, chunk_size=None):
+		"""writes the design to a file-like object chunk by chunk, 
+		without building the whole output in memory (works for files,
+		sockets via makefile(), gzip streams, ...)
+
+		Args:
+			fileobj: anything with a write method
+			format: "exp", "dst", "ksm", "pes" or "svg"
+			chunk_size: number of stitches encoded per chunk (default = stream_chunk_size)
+		"""
+		encoders = {
+			"exp": self._melco_chunks,
+			"dst": self._tajima_chunks,
+			"ksm": self._ksm_chunks,
+			"pes": self._pes_chunks,
+			"svg": self._svg_chunks,
+		}
+		format = format.lower()
+		if format not in encoders:
+			raise ValueError("can not write format: %s" % format)
+		with stage("write " + format) as st:
+			st.count("stitches", len(self))
+			for data in encoders[format](chunk_size or stream_chunk_size):
+				fileobj.write(data)
+				st.count("bytes written", len(data))
+
+	def _export(self, format):
+		# the whole output as one string
+		out = StringIO()
+		self.write(out, format)
+		return out.getvalue()
+
+	def _point_chunks(self, chunk_size):
+		# Points in slices of chunk_size, without building the whole list
+		self._apply_transform()
+		if self._points is not None:
+			for i in range(0, len(self._points), chunk_size):
+				yield self._points[i:i+chunk_size]
+		else:
+			(x, y, flags, color) = self._stitches.columns()
+			for i in range(0, len(x), chunk_size):
+				j = i + chunk_size
+				yield points_from_columns(x[i:j], y[i:j], flags[i:j], color[i:j])
+
+	def _record_chunks(self, format, chunk_size, start=None, counted=True, columns=None):
+		"""the moves between the rounded stitch positions, split into the
+		fewest records within the move limits of a machine format
+
+		Args:
+			format: "exp", "dst", "ksm" or "pes" (see move_limits)
+			chunk_size: number of stitches planned at once
+			start: (x, y) the first move starts from (default = first stitch)
+			counted: add the records to the "records" counter of the stage
+				(off for passes that only size the output)
+			columns: the stitch columns, if the caller already has them 
+				(default = None, columnar backend only)
+		Returns:
+			generator of (rx, ry, flags) - arrays with the columnar backend,
+			lists of records otherwise. flags holds JUMP, and COLOR_CHANGE
+			on all records of a stitch whose color differs from the one before
+		"""
+		(limit, jump_limit) = move_limits[format]
+		if self.columnar:
+			(x, y, flags, color) = columns or self._columns()
+			if len(x) == 0:
+				return
+			if start is None:
+				start = (round_half_away(x[:1])[0], round_half_away(y[:1])[0])
+			(x0, y0) = start
+			c0 = color[0]
+			for i in range(0, len(x), chunk_size):
+				j = i + chunk_size
+				cx = round_half_away(x[i:j])
+				cy = round_half_away(y[i:j])
+				f = flags[i:j] & JUMP
+				f[numpy.diff(color[i:j], prepend=c0) != 0] |= COLOR_CHANGE
+				(rx, ry, index) = plan_moves(numpy.diff(cx, prepend=x0),
+					numpy.diff(cy, prepend=y0), limit, jump_limit, (f & JUMP) != 0)
+				if counted:
+					count("records", len(rx))
+				yield (rx, ry, f[index])
+				(x0, y0, c0) = (cx[-1], cy[-1], color[i:j][-1])
+			return
+
+		old_int = start and Point(start[0], start[1]) or None
+		lastColor = None
+		for points in self._point_chunks(chunk_size):
+			if old_int is None:
+				old_int = points[0].as_int()
+			rx = []
+			ry = []
+			rflags = []
+			for stitch in points:
+				new_int = stitch.as_int()
+				delta = new_int - old_int
+				f = stitch.jump and JUMP or 0
+				if lastColor != None and stitch.color != lastColor:
+					f |= COLOR_CHANGE
+				lastColor = stitch.color
+				for (dx, dy) in plan_move(delta.x, delta.y, stitch.jump and jump_limit or limit):
+					rx.append(dx)
+					ry.append(dy)
+					rflags.append(f)
+				old_int = new_int
+			if counted:
+				count("records", len(rx))
+			yield (rx, ry, rflags)
+
 	############################################
 	#### PFAFF / KSM
 	############################################
@@ -390,9 +1620,9 @@ class Embroidery:
 			filename
 		"""			
 		f = open(filename, "wb")
-		f.write(self.export_ksm())		
+		self.write(f, "ksm")
 		f.close()
-		dbg.write("saved to file: %s\n" % (filename))
+		log("saved to file: %s\n", filename)
 
 
 	def export_ksm(self):
@@ -401,57 +1631,25 @@ class Embroidery:
 		Returns:
 			string (KSM/Pfaff)
 		"""			
-		
-		self.string = ""
-		self.mode_byte = 0x80
-		
-		#write empty header
-		for i in range(0, 512):
-			self.string += chr(0x00)		
-		
-		def move(x,y):
-			self.string+=chr(abs(y))
-			self.string+=chr(abs(x))
-			if (y<0):
-				self.mode_byte |= 0x20
-			if (x<0):
-				self.mode_byte |= 0x40
-			self.string+=chr(self.mode_byte)
-	
-								
-		
-		self.pos = Point(0,0)
-		lastColor = None
-		for stitch in self.coords:
-			if (lastColor!=None and stitch.color!=lastColor):
-				self.mode_byte = 0x99
-				#dbg.write("Color change!\n")
-			else:
-				self.mode_byte = 0x80
-				#dbg.write("color still %s\n" % stitch.color)
-			lastColor = stitch.color
-			new_int = stitch.as_int()
-			old_int = self.pos.as_int()
-			delta = new_int - old_int
-			
-			sum_x = 0
-			sum_y = 0
-			dmax = max(abs(delta.x), abs(delta.y))
-			dsteps = abs(dmax / 127) + 1
-			if dsteps == 1:
-				move(delta.x, delta.y)
-			else:
-				for i in range(0,dsteps):
-					if i < dsteps -1:
-						move(delta.x/dsteps, delta.y/dsteps)
-						sum_x += delta.x/dsteps
-						sum_y += delta.y/dsteps
-					else:
-						move(delta.x - sum_x, delta.y - sum_y)			
-						
-
-			self.pos = stitch
-		return self.string
+		return self._export("ksm")
+
+	def _ksm_chunks(self, chunk_size):
+		yield str(bytearray(512))	# empty header
+		for (rx, ry, flags) in self._record_chunks("ksm", chunk_size, (0, 0)):
+			if self.columnar:
+				yield encode_ksm(rx, ry, flags).tobytes()
+				continue
+			buf = bytearray()
+			for (x, y, f) in zip(rx, ry, flags):
+				mode_byte = f & COLOR_CHANGE and 0x99 or 0x80
+				if (y<0):
+					mode_byte |= 0x20
+				if (x<0):
+					mode_byte |= 0x40
+				buf.append(abs(y))
+				buf.append(abs(x))
+				buf.append(mode_byte)
+			yield str(buf)
 
 						
 	############################################
@@ -466,9 +1664,9 @@ class Embroidery:
 			filename
 		"""			
 		f = open(filename, "wb")
-		f.write(self.export_melco())		
+		self.write(f, "exp")
 		f.close()
-		dbg.write("saved to file: %s\n" % (filename))		
+		log("saved to file: %s\n", filename)		
 				
 		
 	def export_melco(self):
@@ -477,53 +1675,25 @@ class Embroidery:
 		Returns:
 			string (EXP/Melco)
 		"""				
-		self.string = ""
-		self.pos = self.coords[0]
-		dbg.write("export - stitch count: %d\n" % len(self.coords))
-		
-		for stitch in self.coords[0:]:		
-			new_int = stitch.as_int()
-			old_int = self.pos.as_int()
-			delta = new_int - old_int	
-							
-			def move(x, y):
-				if (x<0): x = x + 256
-				self.string += chr(x)
-				if (y<0): y = y + 256
-				self.string += chr(y)
-				
-			#do several interpolated steps if too long	
-			#dbg.write("delta: %d, %d\n" % (delta.x,delta.y))
-			sum_x = 0
-			sum_y = 0
-			dmax = max(abs(delta.x), abs(delta.y))
-			dsteps = abs(dmax / 127) + 1
-			if dsteps == 1:
-				if stitch.jump:
-					self.string += chr(0x80)
-					self.string += chr(0x04)
-				#dbg.write("move: %d, %d\n" % (delta.x, delta.y))				
-				move(delta.x, delta.y)
-			else:
-				for i in range(0,dsteps):
-					if stitch.jump:
-						self.string += chr(0x80)
-						self.string += chr(0x04)
-					if i < dsteps -1:
-						#dbg.write("move: %d, %d\n" % (delta.x/dsteps, delta.y/dsteps))
-						move(delta.x/dsteps, delta.y/dsteps)
-						sum_x += delta.x/dsteps
-						sum_y += delta.y/dsteps
-					else:
-						#dbg.write("move: %d, %d\n" % (delta.x - sum_x, delta.y - sum_y))
-						move(delta.x - sum_x, delta.y - sum_y)
-						
-			self.pos = stitch
-			#dbg.write("sum: %d, %d\n" % (sum_x,sum_y))
-			
-		return self.string
+		return self._export("exp")
+
+	def _melco_chunks(self, chunk_size):
+		log("export - stitch count: %d\n", len(self))
+		for (rx, ry, flags) in self._record_chunks("exp", chunk_size):
+			if self.columnar:
+				yield encode_melco(rx, ry, flags).tobytes()
+				continue
+			buf = bytearray()
+			for (x, y, f) in zip(rx, ry, flags):
+				if f & JUMP:
+					buf.append(0x80)
+					buf.append(0x04)
+				buf.append(x & 0xFF)
+				buf.append(y & 0xFF)
+			yield str(buf)
 	
 			
+	@staged("import_melco")
 	def import_melco(self, filename):
 		"""read an EXP/Melco file
 
@@ -532,41 +1702,43 @@ class Embroidery:
 		"""				
 		# read in an EXP/Melco file
 		(lastx, lasty) = (0, 0)
-		(self.maxx, self.maxy) = (0, 0)
-		(self.minx, self.miny) = (0, 0)
+		# bulk import - density is counted in one pass when needed
+		self._density_valid = False
 		
 		# add Stitch at origin or not?
 		self.addStitch(Point(lastx, lasty, False))
 		
-		jump = False
 		f = open(filename, "rb")
-		byte = " "
-		while byte:			
-			byte = f.read(1)
-			if byte != "" and len(byte) > 0:
-				if byte == chr(0x80):
-					byte = f.read(1)
-					if byte == chr(0x04) or byte == chr(0x02)  or byte == chr(0x00):					
-						jump = True
-					elif byte == chr(0x01) or byte == chr(0x02):
-						dbg.write("reading EXP: ignore color change")
-					byte = f.read(1)
-				dx = ord(byte)
-				if dx > 127:
-					dx = dx - 256
-				byte = f.read(1)
-				if byte != "":
-					dy = ord(byte)					
-					if dy > 127:
-						dy = dy - 256
-					lastx = lastx + dx
-					lasty = lasty + dy	
-					if dx != 0 or dy != 0:
-						self.addStitch(Point(lastx, lasty, jump))
-					jump = False				
+		if self.columnar:
+			data = numpy.fromfile(f, numpy.uint8)
+		else:
+			data = f.read()
 		f.close()
-		dbg.write("reading EXP: loaded from file: %s\n" % (filename))
-		dbg.write("reading EXP: number of stitches: %d\n" % len(self.coords))
+
+		if self.columnar:
+			(dx, dy, flags, colors) = decode_melco(data)
+			count("records decoded", len(dx))
+			x = numpy.cumsum(dx)
+			y = numpy.cumsum(dy)
+			# zero moves are dropped (and so is their jump flag)
+			keep = (dx != 0) | (dy != 0)
+			self.addStitches(x[keep], y[keep], flags[keep] & JUMP)
+		else:
+			(colors, records) = (0, 0)
+			for (dx, dy, flags) in melco_records(data):
+				records += 1
+				if flags & COLOR_CHANGE:
+					colors += 1
+				lastx = lastx + dx
+				lasty = lasty + dy	
+				if dx != 0 or dy != 0:
+					self.addStitch(Point(lastx, lasty, bool(flags & JUMP)))
+			count("records decoded", records)
+		count("bytes read", len(data))
+		if colors:
+			log("reading EXP: ignored %d color changes\n", colors)
+		log("reading EXP: loaded from file: %s\n", filename)
+		log("reading EXP: number of stitches: %d\n", len(self))
 		self.translate_to_origin()
 
 
@@ -584,305 +1756,145 @@ class Embroidery:
 			filename
 		"""			
 		f = open(filename, "wb")
-		f.write(self.export_tajima())		
+		self.write(f, "dst")
 		f.close()
-		dbg.write("saved to file: %s\n" % (filename))		
+		log("saved to file: %s\n", filename)		
 
 	def DecodeTajimaStitch(self, b1, b2, b3):       
-		
-		x = 0
-		y = 0
-		        
-		if b1 & 0x01:
-				x += 1
-				
-		if b1 & 0x02:
-				x -= 1
-				
-		if b1 & 0x04:
-				x += 9
-				
-		if b1 & 0x08:
-				x -= 9
-				
-		if b1 & 0x80:
-				y += 1
-				
-		if b1 & 0x40:
-				y -= 1
-				
-		if b1 & 0x20:
-				y += 9
-				
-		if b1 & 0x10:
-				y -= 9
-				
-		if b2 & 0x01:
-				x += 3
-				
-		if b2 & 0x02:
-				x -= 3
-				
-		if b2 & 0x04:
-				x += 27
-				
-		if b2 & 0x08:
-				x -= 27
-				
-		if b2 & 0x80:
-				y += 3
-
-		if b2 & 0x40:
-				y -= 3
-				
-		if b2 & 0x20:
-				y += 27
-				
-		if b2 & 0x10:
-				y -= 27
-				
-		if b3 & 0x04:
-				x += 81
-				
-		if b3 & 0x08:
-				x -= 81
-				
-		if b3 & 0x20:
-				y += 81
-				
-		if b3 & 0x10:
-				y -= 81
-
-		# Color change
-		#if b3 & 0x80 and b3 & 0x40:
-		#		self.ColorsRead += 1
-		#		if self.ColorsRead > len(self.Colors):
-		#				self.Colors.append( self.RandomColor() )
-		#		
-		#		self.ColorChanges.append( self.CurrentStitch ) 
-		#		return [self.ColorsRead - 1, 0, self.COLOR]
-
-
-		# Jump stitch
-		if b3 & 0x80:
-			return (x, y, True)
-		else:
-			return (x, y, False)
-
-				
-	def EncodeTajimaStitch(self, dx, dy, jump=False):
-		b1 = 0
-		b2 = 0
-		b3 = 0
-
-		if dx > 40:
-				b3 |= 0x04
-				dx -= 81
-
-		if dx < -40:
-				b3 |= 0x08
-				dx += 81
-				
-		if dy > 40:
-				b3 |= 0x20
-				dy -= 81
-
-		if dy < -40:
-				b3 |= 0x10
-				dy += 81
-
-		if dx > 13:
-				b2 |= 0x04
-				dx -= 27
+		"""decodes one 3 byte DST record (table lookup)
 
-		if dx < -13:
-				b2 |= 0x08
-				dx += 27
-				
-		if dy > 13:
-				b2 |= 0x20
-				dy -= 27
-
-		if dy < -13:
-				b2 |= 0x10
-				dy += 27
-
-		if dx > 4:
-				b1 |= 0x04
-				dx -= 9
-
-		if dx < -4:
-				b1 |= 0x08
-				dx += 9
-				
-		if dy > 4:
-				b1 |= 0x20
-				dy -= 9
-
-		if dy < -4:
-				b1 |= 0x10
-				dy += 9
-				
-		if dx > 1:
-				b2 |= 0x01
-				dx -= 3
-
-		if dx < -1:
-				b2 |= 0x02
-				dx += 3
-				
-		if dy > 1:
-				b2 |= 0x80
-				dy -= 3
-
-		if dy < -1:
-				b2 |= 0x40
-				dy += 3
+		Returns:
+			(dx, dy, jump) - jump is also set for color changes
+		"""
+		x = DST_DX_TABLE[0][b1] + DST_DX_TABLE[1][b2] + DST_DX_TABLE[2][b3]
+		y = DST_DY_TABLE[0][b1] + DST_DY_TABLE[1][b2] + DST_DY_TABLE[2][b3]
+		return (x, y, bool(b3 & 0x80))
 
-		if dx > 0:
-				b1 |= 0x01
-				dx -= 1
 
-		if dx < 0:
-				b1 |= 0x02
-				dx += 1
-				
-		if dy > 0:
-				b1 |= 0x80 
-				dy -= 1
+	def EncodeTajimaStitch(self, dx, dy, jump=False):
+		"""encodes one move of at most 121 in each direction as a 
+		3 byte DST record (table lookup)"""
+		if dx < -dst_max_move or dx > dst_max_move or dy < -dst_max_move or dy > dst_max_move:
+			raise ValueError("DST move out of range: %d, %d" % (dx, dy))
+		(x1, x2, x3) = DST_X_TABLE[dx + dst_max_move]
+		(y1, y2, y3) = DST_Y_TABLE[dy + dst_max_move]
+		b3 = x3 | y3 | 0x03
+		if jump:
+			b3 |= 0x80
+		return chr(x1 | y1) + chr(x2 | y2) + chr(b3)
 
-		if dy < 0:
-				b1 |= 0x40
-				dy += 1
+	def _tajima_header(self, records, start, end):
+		"""builds the 512 byte DST header
 
-		s = chr(b1)
-		s += chr(b2)
-		if jump:
-			s += chr(b3 | 0x83)
-		else:
-			s += chr(b3 | 0x03)
-		
-		return s
+		Args:
+			records: number of stitch records
+			start, end: first and last needle position (as ints)
+		"""
+		(minx, miny, maxx, maxy) = self.getExtents()
+		def sign(v):
+			return v < 0 and "-" or "+"
+		ax = end[0] - start[0]
+		ay = end[1] - start[1]
+		header = "LA:%-16s\r" % "turtlestitch"
+		header += "ST:%7d\r" % records
+		header += "CO:%3d\r" % 0
+		header += "+X:%5d\r" % max(int(round(maxx)) - start[0], 0)
+		header += "-X:%5d\r" % max(start[0] - int(round(minx)), 0)
+		header += "+Y:%5d\r" % max(int(round(maxy)) - start[1], 0)
+		header += "-Y:%5d\r" % max(start[1] - int(round(miny)), 0)
+		header += "AX:%s%5d\r" % (sign(ax), abs(ax))
+		header += "AY:%s%5d\r" % (sign(ay), abs(ay))
+		header += "MX:+%5d\r" % 0
+		header += "MY:+%5d\r" % 0
+		header += "PD:******\r"
+		header += chr(0x1A)
+		return header + " " * (512 - len(header))
 
-		
 	def export_tajima(self):
 		"""converts design to DST/Tajima  format
 
 		Returns:
 			string (DST/Tajima )
 		"""				
-		self.string = ""
-		self.pos = self.coords[0]
-		dbg.write("export - stitch count: %d\n" % len(self.coords))
-
-
-		def writeHeader(str, length, padWithSpace=False):
-			for i in range (0,length-2):
-				if i < len(str):
-					self.string += str[i];
-				else:
-					if padWithSpace:
-						self.string += chr(0x20)
-					else:
-						self.string += chr(0x00);				
-			self.string += chr(0x0A);
-			self.string += chr(0x1A);		
-
-		writeHeader("LA:turtlestitch", 20, True)
-		writeHeader("ST:%s" % (len(self.coords)), 11)
-		writeHeader("CO:1", 7)
-		writeHeader("+X:%s" % (self.maxx), 9)
-		writeHeader("-X:%s" % (self.minx), 9)
-		writeHeader("+Y:%s" % (self.maxy), 9)
-		writeHeader("-Y:%s" % (self.miny), 9)
-		writeHeader("AX:%s" % self.coords[len(self.coords)-1].as_int().x, 10)
-		writeHeader("AY:%s" % self.coords[len(self.coords)-1].as_int().x, 10)
-		writeHeader("MX:0", 10)
-		writeHeader("MY:0", 10)
-		writeHeader("PD:******", 10)
-
-		self.string += chr(0x1a);
-		self.string += chr(0x00);
-		self.string += chr(0x00);
-		self.string += chr(0x00);
-			
-		#write empty header
-		for i in range(0, 384):
-			self.string += chr(0x00)
-		
-		for stitch in self.coords[0:]:		
-			new_int = stitch.as_int()
-			old_int = self.pos.as_int()
-			delta = new_int - old_int	
-							
-			#do several interpolated steps if too long	
-			sum_x = 0
-			sum_y = 0
-			dmax = max(abs(delta.x), abs(delta.y))
-			dsteps = abs(dmax / 121) + 1
-			if dsteps == 1:
-				self.string += self.EncodeTajimaStitch(delta.x, delta.y, stitch.jump)				
-			else:
-				for i in range(0,dsteps):
-					if i < dsteps -1:
-						self.string += self.EncodeTajimaStitch(delta.x/dsteps, delta.y/dsteps, stitch.jump, )
-						sum_x += delta.x/dsteps
-						sum_y += delta.y/dsteps
-					else:
-						self.string += self.EncodeTajimaStitch(delta.x - sum_x, delta.y - sum_y, stitch.jump)					
-			self.pos = stitch		
+		return self._export("dst")
 
-		self.string += chr(0x00)
-		self.string += chr(0x00)
-		self.string += chr(0xF3)
-			
-		return self.string
+	def _tajima_chunks(self, chunk_size):
+		log("export - stitch count: %d\n", len(self))
+		if len(self) == 0:
+			yield self._tajima_header(0, (0, 0), (0, 0)) + chr(0x00) + chr(0x00) + chr(0xF3)
+			return
+		self._apply_transform()
+
+		columns = None
+		if self.columnar:
+			# built once for both passes if the Points are the storage
+			columns = self._columns()
+			(x, y) = columns[:2]
+			start = (int(round_half_away(x[:1])[0]), int(round_half_away(y[:1])[0]))
+			end = (int(round_half_away(x[-1:])[0]), int(round_half_away(y[-1:])[0]))
+		else:
+			start = self._points[0].as_int()
+			end = self._points[-1].as_int()
+			(start, end) = ((start.x, start.y), (end.x, end.y))
+
+		# the header needs the record count - one planning pass
+		records = 0
+		for (rx, ry, flags) in self._record_chunks("dst", chunk_size, 
+				counted=False, columns=columns):
+			records += len(rx)
+		yield self._tajima_header(records, start, end)
+
+		for (rx, ry, flags) in self._record_chunks("dst", chunk_size, columns=columns):
+			if self.columnar:
+				yield encode_tajima(rx, ry, flags).tobytes()
+				continue
+			buf = bytearray()
+			for (x, y, f) in zip(rx, ry, flags):
+				buf += self.EncodeTajimaStitch(x, y, f & JUMP)
+			yield str(buf)
+		yield chr(0x00) + chr(0x00) + chr(0xF3)
 	
 			
+	@staged("import_tajima")
 	def import_tajima(self, filename):
-		"""read an EXP/Melco file
+		"""read a DST/Tajima file - color changes are kept as 
+		COLOR_CHANGE (and JUMP) flags and advance the color index
 
 		Args:
 			filename
 		"""			
-		
-		# TODO!!!
-		
-		# read in an EXP/Melco file
 		(lastx, lasty) = (0, 0)
-		(self.maxx, self.maxy) = (0, 0)
-		(self.minx, self.miny) = (0, 0)
+		# bulk import - density is counted in one pass when needed
+		self._density_valid = False
 		
 		# add Stitch at origin or not?
 		#self.addStitch(Point(lastx, lasty, False))
 		
-		jump = False
 		f = open(filename, "rb")
 		header = f.read(512)
-
-		while True:
-			rec = f.read(3)
-
-			# Bad record or end of file
-			if len(rec) < 3:
-					break
-
-			b1 = ord(rec[0])
-			b2 = ord(rec[1])
-			b3 = ord(rec[2])
-
-			# End of file
-			if b3 == 0xF3:
-					break
-
-			(dx, dy, jump) = self.DecodeTajimaStitch(b1, b2, b3)
-			lastx = lastx + dx
-			lasty = lasty + dy			
-			self.addStitch(Point(lastx, lasty, jump))
-			
+		if self.columnar:
+			data = numpy.fromfile(f, numpy.uint8)
+		else:
+			data = f.read()
 		f.close()
-		dbg.write("reading DST: loaded from file: %s\n" % (filename))
-		dbg.write("reading DST: number of stitches: %d\n" % len(self.coords))
+
+		if self.columnar:
+			(dx, dy, flags) = decode_tajima(data)
+			count("records decoded", len(dx))
+			color = numpy.cumsum((flags & COLOR_CHANGE) != 0)
+			self.addStitches(numpy.cumsum(dx), numpy.cumsum(dy), flags, color)
+		else:
+			color = 0
+			for (dx, dy, flags) in tajima_records(data):
+				if flags & COLOR_CHANGE:
+					color += 1
+				lastx = lastx + dx
+				lasty = lasty + dy			
+				self.addStitch(Point(lastx, lasty, bool(flags & JUMP), color))
+			count("records decoded", len(data) // 3)
+		count("bytes read", len(data))
+		log("reading DST: loaded from file: %s\n", filename)
+		log("reading DST: number of stitches: %d\n", len(self))
 		self.translate_to_origin()
 
 
@@ -893,156 +1905,78 @@ class Embroidery:
 	
 			
 	def save_as_pes(self, filename):
-		"""converts stitches to EXP/Melco format
+		"""save design as PES/Brother formated file - the design itself
+		is not changed, long moves are split by the move planner
 
-		Returns:
-			string (EXP/Melco)
+		Args:
+			filename
 		"""		
 	
-		dbg.write("Warning: PES export is still experimental!")	
-		# PES has maximum value of 64 for stitch lengt p direction
-		
-		self.flatten(max_length=63)
-		
-		(self.minx, self.maxx) = (self.coords[0].x, self.coords[0].x)
-		(self.miny, self.maxy) = (self.coords[0].y, self.coords[0].y)
-		if (len(self.coords)==0):
+		log("Warning: PES export is still experimental!\n")
+		if (len(self)==0):
 			return
-		for p in self.coords:
-			self.minx = min(self.minx, p.x)
-			self.miny = min(self.miny, p.y)
-			self.maxx = max(self.maxx, p.x)
-			self.maxy = max(self.maxy, p.y)
-		sx = self.maxx - self.minx
-		sy = self.maxy - self.miny
-
-		# helper functions
-		def writeInt32(f,i):
-			f.write(pack('<I', i))
+		f = open(filename, "wb")
+		self.write(f, "pes")
+		f.close()
+		log("saved to file: %s\n", filename)
 
-		def writeInt16(f,i):
-			f.write(pack('H', i))
-					
-		def writeInt8(f,i):
-			f.write(pack('B', i))	
-							
-		
-		self.pos = self.coords[0]
-		dbg.write("export - stitch count: %d\n" % len(self.coords))
-		
-		f = open(filename,"w")
+	def _pes_header(self):
+		# PES block, CEmbOne and CSewSeg blocks and the PEC block up to the stitch data
+		(sx, sy) = self.getSize()
 		
 		# PES Block v1		
-		f.write("#PES0001")		
-		
-		writeInt32(f,0) # pecblock pointer	
-			
-		writeInt16(f,0) #  a value of 1 here seems to indicate design data is over 100KB long, or 0 for less than 100KB
-		writeInt16(f,1)
-		writeInt16(f,1)
-		writeInt16(f,0xFFFF)
-		writeInt16(f,0)
+		header = "#PES0001"
+		header += pack('<I', 0) # pecblock pointer
+		# a value of 1 here seems to indicate design data is over 100KB long, or 0 for less than 100KB
+		header += pack('<HHHHH', 0, 1, 1, 0xFFFF, 0)
 		
 		# CEmbOne Block v1
-		writeInt16(f,7)
-		f.write("CEmbOne")
-		
-		writeInt16(f,0) # min x?
-		writeInt16(f,0) # min y?
-		writeInt16(f,0) # max x?
-		writeInt16(f,0) # max y?	
-		
-		writeInt16(f,0) # min x?
-		writeInt16(f,0) # min y?
-		writeInt16(f,0) # max x?
-		writeInt16(f,0) # max y?	
+		header += pack('<H', 7) + "CEmbOne"
+		header += pack('<HHHH', 0, 0, 0, 0) # min x, min y, max x, max y?
+		header += pack('<HHHH', 0, 0, 0, 0) # min x, min y, max x, max y?
+		header += pack('<IIIIII', 0, 0, 0, 0, 0, 0)
+		header += pack('<HHH', 1, 0, 0)
+		header += pack('<HH', sx, sy) # width, height
+		header += pack('<HHHHHHH', 0, 0, 0, 0, 0, 0, 0)
 		
-		writeInt32(f,0)
-		writeInt32(f,0)
-		writeInt32(f,0)
-		writeInt32(f,0)	
-		writeInt32(f,0)	
-		writeInt32(f,0)	
-		
-		writeInt16(f,1)		
-		writeInt16(f,0)
-		writeInt16(f,0)
-		writeInt16(f,0)
-		writeInt16(f,0)	
-		writeInt16(f,0)
-		writeInt16(f,0)
-		writeInt16(f,0)
-		writeInt16(f,0)
-		writeInt16(f,0)
-		writeInt16(f,0)
-		writeInt16(f,0)
-
-		# CEmbOne Block v1
-		writeInt16(f,7)
-		f.write("CSewSeq")
-		
-		#CSewSeg Stitch Data
-		writeInt32(f,0)
-	
-		
-		#PEC Code Block Stitch Data
-		pecstart = f.tell() 			
-		for i in range(0,550):
-			writeInt8(f,0)
-
-		f.seek(8)
-		writeInt32(f,pecstart)
-		f.seek(77)
-		writeInt16(f,sx) # width
-		writeInt16(f,sy) # height
-		f.seek(pecstart+49)
-		writeInt8(f,0) # num colors
-		f.seek(pecstart+532)
+		# CSewSeq Block v1
+		header += pack('<H', 7) + "CSewSeq"
+		header += pack('<I', 0) #CSewSeg Stitch Data
 		
-		for stitch in self.coords[0:]:		
-			new_int = stitch.as_int()
-			old_int = self.pos.as_int()
-			delta = new_int - old_int	
-							
-			if stitch.jump:
-				dbg.write("export to PES: ignore jump stitches!!!!!\n")
-
-				x = abs(delta.x) & 0x7FF
-				if x < 0:
-					x =  (x + 0x1000 & 0x7FF) | 0x800
-				
-				x = ((x >> 8) & 0x0F) | 0x80
-				writeInt8(f,x)
-				writeInt8(f,(x & 0xFF))	
-				
-				y= abs(delta.y) & 0x7FF
-				if y < 0:
-					y =  (y + 0x1000 & 0x7FF) | 0x800
-				
-				y= ((y >> 8) & 0x0F) | 0x80
-				writeInt8(f,y)		
-				writeInt8(f,(y & 0xFF))		
-
+		#PEC Code Block Stitch Data - num colors at +49 is 0
+		pecstart = len(header)
+		header = header[:8] + pack('<I', pecstart) + header[12:]
+		return header + chr(0) * 532
+
+	def _pes_chunks(self, chunk_size):
+		log("export - stitch count: %d\n", len(self))
+		header = self._pes_header()
+		yield header
+		length = len(header)
+		for (rx, ry, flags) in self._record_chunks("pes", chunk_size):
+			if self.columnar:
+				data = encode_pes(rx, ry, flags).tobytes()
 			else:
-				if delta.x >= 0:
-					writeInt8(f,delta.x)
-				else:
-					writeInt8(f,delta.x + 128)
-				
-				delta.y *= -1	
-				if delta.y >= 0:
-					writeInt8(f,delta.y)
-				else:
-					writeInt8(f,delta.y+128)
-												
-			self.pos = stitch		
-		
-		writeInt8(f,0xFF)
-		writeInt8(f,0x00)
-		
-		f.close()
+				buf = bytearray()
+				for (x, y, f) in zip(rx, ry, flags):
+					y = -y
+					if f & JUMP:
+						buf.append(0x80 | ((x >> 8) & 0x0F))
+						buf.append(x & 0xFF)
+						buf.append(0x80 | ((y >> 8) & 0x0F))
+						buf.append(y & 0xFF)
+					else:
+						buf.append(x & 0x7F)
+						buf.append(y & 0x7F)
+				data = str(buf)
+			length += len(data)
+			yield data
+		end = chr(0xFF) + chr(0x00)
+		# the PEC block is at least 550 bytes
+		yield end + chr(0) * (len(header) + 18 - length - len(end))
 
 	
+	@staged("import_pes")
 	def import_pes(self, filename):
 		"""read a PES Brother file
 
@@ -1064,157 +1998,265 @@ class Embroidery:
 			return data		
 					
 		(lastx, lasty) = (0, 0)
-		(self.maxx, self.maxy) = (0, 0)
-		(self.minx, self.miny) = (0, 0)
+		# bulk import - density is counted in one pass when needed
+		self._density_valid = False
 		jump = False
 		f = open(filename, "rb")
 
 		# read PES header signature
 		sig = f.read(4)
 		if not sig == "#PES":
-			dbg.write("error reading PES: not a PES file!");
-			exit()
-		dbg.write("reading PES file: header found - version ")
+			f.close()
+			raise IOError("not a PES file: %s" % filename)
 		version = f.read(4)
-		dbg.write(version)
-		dbg.write("\n")
+		log("reading PES file: header found - version %s\n", version)
 		
 		pecstart = readInt32(f)	
 		f.seek(77)
 		width =  readInt16(f)
 		height =  readInt16(f)
-		dbg.write("reading PES: dimension is %d x %d mm\n" % (width/10.0, height/10.0))
+		log("reading PES: dimension is %d x %d mm\n", width/10.0, height/10.0)
 		
 		# No. of colors in file
 		f.seek(pecstart + 48)
 		numColors = readInt8(f) + 1
-		dbg.write("reading PES:  %d colors - but ignoring colors for now\n" % numColors)
+		log("reading PES:  %d colors - but ignoring colors for now\n", numColors)
 
-		# derived from stitchloader.py
 		# Beginning of stitch data
 		f.seek(pecstart + 532)
-		while 1:
-			val1 = readInt8(f)
-			val2 = readInt8(f)
+		for (x, y, flags) in pes_records(f):
+			lastx = lastx + x
+			lasty = lasty + y	
+			self.addStitch(Point(lastx, lasty, bool(flags & JUMP)))
+		count("records decoded", len(self))
+		f.close()
 			
-			if val1 is None or val2 is None:
-				break
-			elif val1 == 255 and val2 == 0:
-				break
-			elif val1 == 254 and val2 == 176:
-				nn = readInt8(f)
-				dbg.write("reading PES: ignoring color change\n")
+
+	############################################
+	#### NATIVE FORMAT
+	############################################
+
+	def save_native(self, filename):
+		"""save design in the native format - the stitch columns as they
+		are in memory plus the statistics, so load_native needs no decoding
+
+		Args:
+			filename
+		"""
+		self._apply_transform()
+		self._update_stats()
+		n = len(self)
+		if self._points is None:
+			(x, y, flags, color) = self._stitches.columns()
+		else:
+			points = self._points
+			x = array.array("d", [p.x for p in points])
+			y = array.array("d", [p.y for p in points])
+			flags = array.array("B", [p.jump and JUMP or 0 for p in points])
+			color = array.array("H", [p.color for p in points])
+		f = open(filename, "wb")
+		f.write(pack(native_header, native_magic, native_version, 
+			calcsize(native_header), n, self.minx, self.miny, self.maxx, self.maxy,
+			self.jumpCount, self.maxStitchLength, self.tooLong))
+		# columns in the order of their alignment: x, y, color, flags
+		for (column, code) in ((x, "<f8"), (y, "<f8"), (color, "<u2"), (flags, "u1")):
+			if self._points is None:
+				column.astype(code).tofile(f)
 			else:
-				if val1 & 128 == 128: # 0x80
-					#this is a jump stitch
-					jump = True
-					x = ((val1 & 15) * 256) + val2
-					if x & 2048 == 2048: # 0x0800
-						x = x - 4096
-					#read next byte for Y value
-					val2 = readInt8(f)
-				else:
-					#normal stitch
-					jump = False
-					x = val1
-					if x > 63:
-						x = x - 128
-				
-				if val2 & 128 == 128: # 0x80
-					#this is a jump stitch
-					jump = True
-					val3 = readInt8(f)
-					y = ((val2 & 15) * 256) + val3
-					if y & 2048 == 2048: # 0x0800
-						y = y - 4096
-				else:
-					#normal stitch
-					jump = False
-					y = val2
-					if y > 63:
-						y = y - 128
-				#flip vertical coordinate 
-				x, y = x, -y
-
-				lastx = lastx + x
-				lasty = lasty + y	
-				self.addStitch(Point(lastx, lasty, jump))
-			
+				if sys.byteorder == "big":
+					column.byteswap()
+				column.tofile(f)
+		f.close()
+		log("saved to file: %s\n", filename)
+
+	@staged("load_native")
+	def load_native(self, filename):
+		"""read a design saved by save_native. With numpy the columns 
+		are mapped from the file (copy on write), not read
+
+		Args:
+			filename
+		"""
+		f = open(filename, "rb")
+		size = calcsize(native_header)
+		head = f.read(size)
+		if len(head) < size or head[:4] != native_magic:
+			f.close()
+			raise IOError("not a native stitchcode file: %s" % filename)
+		(magic, version, offset, n, minx, miny, maxx, maxy, jumps, longest, 
+			too_long) = unpack(native_header, head)
+		if version > native_version:
+			f.close()
+			raise IOError("native file version %d not supported: %s" % (version, filename))
+		count("bytes read", offset + 19 * n)
+		if self.columnar:
+			f.close()
+			data = numpy.memmap(filename, numpy.uint8, "c", 0, (offset + 19 * n,))
+			x = data[offset:offset + 8*n].view("<f8")
+			y = data[offset + 8*n:offset + 16*n].view("<f8")
+			color = data[offset + 16*n:offset + 18*n].view("<u2")
+			flags = data[offset + 18*n:offset + 19*n]
+		else:
+			f.seek(offset)
+			columns = []
+			for code in ("d", "d", "H", "B"):
+				column = array.array(code)
+				column.fromfile(f, n)
+				if sys.byteorder == "big":
+					column.byteswap()
+				columns.append(column)
+			f.close()
+			(x, y, color, flags) = columns
+		if len(self) > 0:
+			self.addStitches(x, y, flags, color)
+		elif self.columnar:
+			# use the mapped arrays as they are
+			s = StitchArray(0)
+			(s.x, s.y, s.flags, s.color, s.count) = (x, y, flags, color, n)
+			self._set_stitches(s)
+		else:
+			self._set_points([Point(px, py, bool(pf & JUMP), pc)
+				for (px, py, pf, pc) in zip(x, y, flags, color)])
+		if n and len(self) == n:
+			(self.minx, self.miny, self.maxx, self.maxy) = (minx, miny, maxx, maxy)
+			(self.jumpCount, self.maxStitchLength, self.tooLong) = (jumps, longest, too_long)
+			self._stats_valid = True
+		log("reading native: %d stitches from file: %s\n", n, filename)
 
 	############################################
 	#### PNG
 	############################################
 	
 	
+	@staged("save_as_png")
 	def save_as_png(self, filename, mark_stitch=False, mark_jump=False):	
-		"""save design as PNG image
+		"""save design as PNG image - the stitches between jumps are 
+		drawn as one polyline, the stitch marks in one go below them
 		
 		Args:
 			filename
-			mark_stitches: boolean (mark stitches with "X")
+			mark_stitch: boolean (mark stitches with "X")
+			mark_jump: boolean (draw jumps in red)
 		"""			
 		border = 5
 		stc = 2
-		stitch_color = (0, 0, 255, 0)
-		line_color = (0, 0, 0, 0)
 		
-		self.scale(pixels_per_millimeter/10.0)
-
-		(self.maxx, self.maxy) = (self.coords[0].x, self.coords[0].y)
-		(self.minx, self.miny) = (self.coords[0].x, self.coords[0].y)
-		for p in self.coords:
-			self.minx = min(self.minx, p.x)
-			self.miny = min(self.miny, p.y)
-			self.maxx = max(self.maxx, p.x)
-			self.maxy = max(self.maxy, p.y)
-
-		sx = int( self.maxx - self.minx + 2*border )
-		sy = int( self.maxy - self.miny + 2*border )
-
-		dbg.write("creating PNG image with size %d x %d\n" % (sx,sy))
+		factor = pixels_per_millimeter/10.0
+		(minx, miny, maxx, maxy) = [v * factor for v in self.getExtents()]
+		sx = int( maxx - minx + 2*border )
+		sy = int( maxy - miny + 2*border )
+
+		# PIL is only loaded when PNG output is needed
+		from PIL import Image, ImageDraw
+		log("creating PNG image with size %d x %d\n", sx, sy)
 		img = Image.new("RGB", (sx, sy), (255, 255, 255))
 		draw  =  ImageDraw.Draw(img)	
-		last = self.coords[0]
-				
-		def mark_point(point):
-			draw.line(
-				(point.x + border - stc, self.maxy - point.y + border - stc, 
-				 point.x + border + stc, self.maxy - point.y + border + stc), 
-				 fill=stitch_color)
-			draw.line(
-				(point.x + border + stc, self.maxy - point.y + border - stc, 
-				 point.x + border - stc, self.maxy - point.y + border + stc), 
-				 fill=stitch_color)			
-		
-		if(mark_stitch and not last.jump):
-			mark_point(last)
-					 		
-		for stitch in self.coords[0:]:
-			
-			if stitch.jump:
-				line_color = (255, 0, 0, 0)
-				stitch_color = (0, 0, 255, 0)
-			else:
-				line_color = (0,0,0,0)
-				stitch_color = (0,0,255,0)
-				
-			p = stitch.as_int()
-			
-			if not stitch.jump or (stitch.jump and mark_jump):
-				draw.line(
-					(last.x + border, self.maxy - last.y + border, 
-					 p.x + border , self.maxy - p.y + border), 
-					fill=line_color)
-			
-			if(mark_stitch and not stitch.jump):
-				mark_point(p)
-					 
-			if(mark_stitch and not stitch.jump and last.jump):
-				mark_point(last)
-								
-			last = p		
+
+		# vertices: the first stitch unrounded, then all stitches rounded
+		# to pixels - segment i ends at vertex i+1, in stitch i
+		self._apply_transform()
+		if not len(self):
+			pass
+		elif self._points is None:
+			(x, y, flags, color) = self._stitches.columns()
+			(x, y) = (x * factor, y * factor)
+			vx = numpy.concatenate(([x[0]], round_half_away(x))) + border
+			vy = (maxy - numpy.concatenate(([y[0]], round_half_away(y)))) + border
+			jumps = (flags & JUMP) != 0
+			if mark_stitch:
+				marked = numpy.concatenate(([not jumps[0]], ~jumps))
+				draw_markers(draw, vx[marked], vy[marked], png_stitch_color, stc)
+			draw_polylines(draw, numpy.column_stack((vx, vy)).ravel().tolist(), 
+				jumps, mark_jump)
+		else:
+			points = self._points
+			vx = [points[0].x * factor + border]
+			vx += [int(round(p.x * factor)) + border for p in points]
+			vy = [maxy - points[0].y * factor + border]
+			vy += [maxy - int(round(p.y * factor)) + border for p in points]
+			jumps = [p.jump for p in points]
+			if mark_stitch:
+				marked = [not jumps[0]] + [not j for j in jumps]
+				draw_markers(draw, [v for (v, m) in zip(vx, marked) if m],
+					[v for (v, m) in zip(vy, marked) if m], png_stitch_color, stc)
+			xy = [v for pair in zip(vx, vy) for v in pair]
+			draw_polylines(draw, xy, jumps, mark_jump)
 		img.save(filename, "PNG")	
-		dbg.write("saving image to file: %s\n" % (filename))
+		log("saving image to file: %s\n", filename)
+
+	@staged("thumbnail")
+	def thumbnail(self, size=thumbnail_size):
+		"""renders a small preview - the stitch lines without jumps,
+		scaled to fit into size x size pixels
+
+		Args:
+			size: pixels of the longer side (default = thumbnail_size)
+		Returns:
+			PNG data (string), None for an empty design
+		"""
+		if not len(self):
+			return None
+		from PIL import Image, ImageDraw
+		(minx, miny, maxx, maxy) = self.getExtents()
+		scale = (size - 1) / float(max(maxx - minx, maxy - miny, 1))
+		img = Image.new("L", (int((maxx - minx) * scale) + 1, 
+			int((maxy - miny) * scale) + 1), 255)
+		draw = ImageDraw.Draw(img)
+		self._apply_transform()
+		if self._points is None:
+			(x, y, flags, color) = self._stitches.columns()
+			xy = numpy.column_stack(((x - minx) * scale, (maxy - y) * scale)).ravel().tolist()
+			jumps = (flags[1:] & JUMP) != 0
+		else:
+			xy = []
+			for p in self._points:
+				xy += [(p.x - minx) * scale, (maxy - p.y) * scale]
+			jumps = [p.jump for p in self._points[1:]]
+		draw_polylines(draw, xy, jumps, line_color=0)
+		buf = StringIO()
+		img.save(buf, "PNG")
+		return buf.getvalue()
+
+	@staged("save_tiles")
+	def save_tiles(self, directory, max_zoom=None, mark_stitch=None, mark_jump=None,
+			workers=None, tile_size=tile_size):
+		"""saves the design as a pyramid of PNG tiles directory/z/x/y.png 
+		for zooming viewers - tiles without stitches are left out
+
+		Args:
+			directory
+			max_zoom: deepest zoom level (default = the first level with 
+				at least tile_pixels_per_millimeter)
+			mark_stitch: zoom level from which on stitches are marked 
+				with "X", True for all levels, -1 for the deepest only
+				(default = None, no marks)
+			mark_jump: zoom level from which on jumps are drawn in red,
+				like mark_stitch (default = None, no jumps)
+			workers: number of processes rendering tiles (default = cpus)
+			tile_size: pixels per tile side
+		Returns:
+			number of tiles written
+		"""
+		import multiprocessing
+		renderer = TileRenderer(self, max_zoom, tile_size, mark_stitch, mark_jump)
+		tiles = renderer.tiles()
+		workers = min(workers or multiprocessing.cpu_count(), len(tiles))
+		if workers < 2 or multiprocessing.current_process().daemon:
+			written = sum(renderer.save(directory, *tile) for tile in tiles)
+		else:
+			pool = multiprocessing.Pool(workers, _tile_init, (renderer, directory))
+			try:
+				written = sum(pool.imap_unordered(_tile_save, tiles, 16))
+				pool.close()
+			except KeyboardInterrupt:
+				pool.terminate()
+				raise
+			finally:
+				pool.join()
+		count("tiles", written)
+		log("saved %d tiles of zoom levels 0 to %d to: %s\n", written, 
+			renderer.max_zoom, directory)
+		return written
 
 
 	############################################
@@ -1228,44 +2270,42 @@ class Embroidery:
 		Return:
 			string with SVG-data
 		"""					
-		(self.maxx, self.maxy) = (self.coords[0].x, self.coords[0].y)
-		(self.minx, self.miny) = (self.coords[0].x, self.coords[0].y)
-		for p in self.coords:
-			self.minx = min(self.minx, p.x)
-			self.miny = min(self.miny, p.y)
-			self.maxx = max(self.maxx, p.x)
-			self.maxy = max(self.maxy, p.y)
-
-		sx = int( self.maxx - self.minx)
-		sy = int( self.maxy - self.miny)
+		return self._export("svg")
+
+	def _svg_chunks(self, chunk_size):
+		(sx, sy) = self.getSize()
 		
 		# TODO convert to pixel
 		# conversion factor: 
 		# fact = 72.0 / 254
 				
-		self.str = """<?xml version="1.0" standalone="no"?>
+		head = """<?xml version="1.0" standalone="no"?>
 <!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" 
   "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">
 <svg width="%d" height="%d" viewBox="0 -%d %d 0"
      xmlns="http://www.w3.org/2000/svg" version="1.1">
   <title>Embroidery export</title>
   <path fill=\"none\" stroke=\"black\" d=\"""" % (sx, sy, sx, sy)
-		self.pos = self.coords[0]
 		last_jump = False
-		self.str += "M %d %d" % (self.pos.x, sy - self.pos.y )
-		for stitch in self.coords[0:]:			
-			if stitch.jump:
-				if not last_jump:
-					self.str += "\" />\n"
-				last_jump = True
+		first = True
+		for points in self._point_chunks(chunk_size):
+			if first:
+				parts = [head, "M %d %d" % (points[0].x, sy - points[0].y)]
+				first = False
 			else:
-				if last_jump:
-					#self.str += "  <path fill=\"none\" stroke=\"red\" d=\"M %d %d L %d %d\" />\n" % (last_x, sy-last_y, stitch.x,  sy-stitch.y)
-					self.str += "  <path fill=\"none\" stroke=\"black\" d=\"M %d %d" % (stitch.x,  sy - stitch.y)
-					last_jump = False
-				self.str += " L %d %d" % (stitch.x,  sy - stitch.y)
-		self.str += "\" />\n</svg>\n"
-		return self.str		
+				parts = []
+			for stitch in points:
+				if stitch.jump:
+					if not last_jump:
+						parts.append("\" />\n")
+					last_jump = True
+				else:
+					if last_jump:
+						parts.append("  <path fill=\"none\" stroke=\"black\" d=\"M %d %d" % (stitch.x,  sy - stitch.y))
+						last_jump = False
+					parts.append(" L %d %d" % (stitch.x,  sy - stitch.y))
+			yield "".join(parts)
+		yield "\" />\n</svg>\n"
 		
 	def save_as_svg(self, filename):
 		"""save design as SVG vector image
@@ -1274,19 +2314,21 @@ class Embroidery:
 			filename
 		"""					
 		f = open(filename, "wb")
-		f.write(self.export_svg())
+		self.write(f, "svg")
 		f.close()
-		dbg.write("saving SVG to file: %s\n" % (filename))		
+		log("saving SVG to file: %s\n", filename)		
 
+	@staged("import_svg")
 	def import_svg(self, filename):
 		"""read a SVG file (for now just what we have written ourselves)
 		
 		Args:
 			filename
 		"""			
-		dbg.write("loading SVG: %s\n" % (filename))	
-		dbg.write("Warning: SVG import is experimental!")	
+		log("loading SVG: %s\n", filename)	
+		log("Warning: SVG import is experimental!\n")	
 					
+		self._density_valid = False
 		first = True
 		jump = False
 		from xml.dom import minidom
@@ -1307,6 +2349,1500 @@ class Embroidery:
 
 
 
+############################################
+#### RASTERIZER
+############################################
+
+def polyline_runs(jumps, mark_jump=False, skip=None):
+	"""groups the segments of a path into runs of one kind, each drawn 
+	by a single line call - segment i ends in vertex i+1
+
+	Args:
+		jumps: per segment, True for a jump (list or numpy array)
+		mark_jump: keep the jumps, otherwise they are left out
+		skip: per segment, True to leave it out (default = None)
+	Returns:
+		list of (first, last, jump) - a run from vertex first to last
+	"""
+	n = len(jumps)
+	if not n:
+		return []
+	if numpy is not None:
+		kind = numpy.asarray(jumps, bool).astype(numpy.int8)
+		if not mark_jump:
+			kind[kind == 1] = -1
+		if skip is not None:
+			kind[numpy.asarray(skip, bool)] = -1
+		cut = numpy.flatnonzero(kind[1:] != kind[:-1]) + 1
+		first = numpy.concatenate(([0], cut))
+		last = numpy.concatenate((cut, [n]))
+		keep = kind[first] >= 0
+		return zip(first[keep].tolist(), last[keep].tolist(), 
+			(kind[first[keep]] == 1).tolist())
+	kind = [j and (mark_jump and 1 or -1) or 0 for j in jumps]
+	if skip is not None:
+		kind = [s and -1 or k for (k, s) in zip(kind, skip)]
+	runs = []
+	first = 0
+	for i in range(1, n + 1):
+		if i == n or kind[i] != kind[first]:
+			if kind[first] >= 0:
+				runs.append((first, i, kind[first] == 1))
+			first = i
+	return runs
+
+def draw_polylines(draw, xy, jumps, mark_jump=False, skip=None,
+		line_color=png_line_color, jump_color=png_jump_color):
+	"""draws a path with one line call per run of stitches or jumps
+
+	Args:
+		draw: PIL ImageDraw
+		xy: flat list of the vertices x0, y0, x1, y1, ...
+		jumps: per segment, True for a jump
+		mark_jump: draw the jumps too
+		skip: per segment, True to leave it out
+	"""
+	for (first, last, jump) in polyline_runs(jumps, mark_jump, skip):
+		draw.line(xy[2*first:2*last + 2], fill=jump and jump_color or line_color)
+
+def draw_markers(draw, x, y, color, size=2):
+	"""draws an "X" of 2*size+1 pixel diagonals at every point in one 
+	point call - the pixels a line call from (x-size, y-size) to 
+	(x+size, y+size) and its mirror would draw
+
+	Args:
+		draw: PIL ImageDraw
+		x, y: point coordinates (lists or numpy arrays)
+		color
+		size
+	"""
+	if numpy is not None:
+		x0 = numpy.trunc(numpy.asarray(x, numpy.float64) - size).astype(numpy.int64)
+		y0 = numpy.trunc(numpy.asarray(y, numpy.float64) - size).astype(numpy.int64)
+		i = numpy.arange(2 * size + 1)
+		px = numpy.concatenate(((x0[:,None] + i).ravel(), (x0[:,None] + 2 * size - i).ravel()))
+		py = numpy.concatenate(((y0[:,None] + i).ravel(), (y0[:,None] + i).ravel()))
+		points = numpy.column_stack((px, py)).ravel().tolist()
+	else:
+		points = []
+		for (px, py) in zip(x, y):
+			(x0, y0) = (int(px - size), int(py - size))
+			for i in range(2 * size + 1):
+				points += [x0 + i, y0 + i, x0 + 2 * size - i, y0 + i]
+	if points:
+		draw.point(points, fill=color)
+
+############################################
+#### TILES
+############################################
+
+class TileRenderer(object):
+	"""renders a design as a z/x/y pyramid of PNG tiles - zoom level 0 
+	is one tile with the whole design, every level doubles the tiles 
+	per side. Each level has a spatial index of the stitch segments, so
+	a tile draws only the segments crossing it.
+	"""
+
+	def __init__(self, emb, max_zoom=None, tile_size=tile_size, 
+			mark_stitch=None, mark_jump=None):
+		"""
+		Args:
+			emb: Embroidery
+			max_zoom: deepest level (default = the first level with at 
+				least tile_pixels_per_millimeter)
+			tile_size: pixels per tile side
+			mark_stitch, mark_jump: zoom level from which on stitches are 
+				marked and jumps drawn - True for all levels, None for none,
+				negative levels count from the deepest (-1)
+		"""
+		if numpy is None:
+			raise ImportError("tile rendering requires numpy")
+		emb._apply_transform()
+		if emb._points is None:
+			(x, y, flags, color) = emb._stitches.columns()
+			(self.x, self.y) = (x.astype(numpy.float64), y.astype(numpy.float64))
+			self.jumps = (flags & JUMP) != 0
+		else:
+			self.x = numpy.array([p.x for p in emb._points], numpy.float64)
+			self.y = numpy.array([p.y for p in emb._points], numpy.float64)
+			self.jumps = numpy.array([bool(p.jump) for p in emb._points], bool)
+		(minx, miny, maxx, maxy) = emb.getExtents()
+		# the pyramid covers a square from the top left corner
+		(self.left, self.top) = (minx, maxy)
+		self.world = float(max(maxx - minx, maxy - miny, 1))
+		self.tile_size = tile_size
+		if max_zoom is None:
+			pixels = self.world * tile_pixels_per_millimeter / 10.0
+			max_zoom = max(int(math.ceil(math.log(pixels / tile_size, 2))), 0)
+		self.max_zoom = max_zoom
+		def level(z):
+			if z is True:
+				return 0
+			if z is None or z is False:
+				return max_zoom + 1
+			if z < 0:
+				return max_zoom + 1 + z
+			return z
+		(self.mark_stitch, self.mark_jump) = (level(mark_stitch), level(mark_jump))
+		self.index = [self._build_index(z) for z in range(max_zoom + 1)]
+
+	def scale(self, z):
+		"""pixels per design unit on level z"""
+		return self.tile_size * 2 ** z / self.world
+
+	def _build_index(self, z):
+		# (tile keys, first, last, segment numbers) - the segments of 
+		# tile key = tx * tiles + ty are numbers[first[i]:last[i]]
+		tiles = 2 ** z
+		(size, scale) = (self.tile_size, self.scale(z))
+		# a margin of the marks' size, so they are not cut at the tile edge
+		margin = tile_mark_size + 1
+		seg = numpy.arange(len(self.x) - 1)
+		if z < self.mark_jump:
+			seg = seg[~self.jumps[1:]]
+		x0 = (self.x[seg] - self.left) * scale
+		x1 = (self.x[seg + 1] - self.left) * scale
+		y0 = (self.top - self.y[seg]) * scale
+		y1 = (self.top - self.y[seg + 1]) * scale
+		# the tile columns each segment crosses, then the rows within
+		# each column - a long segment touches only the tiles along it
+		(xmin, xmax) = (numpy.minimum(x0, x1), numpy.maximum(x0, x1))
+		c0 = numpy.clip(numpy.floor((xmin - margin) / size), 0, tiles - 1).astype(numpy.int64)
+		c1 = numpy.clip(numpy.floor((xmax + margin) / size), 0, tiles - 1).astype(numpy.int64)
+		(i, col) = expand_ranges(c0, c1)
+		lo = numpy.maximum(col * size - margin, xmin[i])
+		hi = numpy.minimum((col + 1) * size + margin, xmax[i])
+		dx = x1[i] - x0[i]
+		slope = numpy.where(dx != 0, (y1[i] - y0[i]) / numpy.where(dx != 0, dx, 1), 0)
+		ya = numpy.where(dx != 0, y0[i] + (lo - x0[i]) * slope, y0[i])
+		yb = numpy.where(dx != 0, y0[i] + (hi - x0[i]) * slope, y1[i])
+		r0 = numpy.clip(numpy.floor((numpy.minimum(ya, yb) - margin) / size), 0, tiles - 1).astype(numpy.int64)
+		r1 = numpy.clip(numpy.floor((numpy.maximum(ya, yb) + margin) / size), 0, tiles - 1).astype(numpy.int64)
+		(j, row) = expand_ranges(r0, r1)
+		keys = col[j] * tiles + row
+		order = numpy.argsort(keys, kind="mergesort")
+		(keys, numbers) = (keys[order], seg[i[j[order]]].astype(numpy.int32))
+		if not len(keys):
+			return (keys, keys, keys, numbers)
+		cut = numpy.flatnonzero(keys[1:] != keys[:-1]) + 1
+		first = numpy.concatenate(([0], cut)).astype(numpy.int64)
+		last = numpy.concatenate((cut, [len(keys)])).astype(numpy.int64)
+		return (keys[first], first, last, numbers)
+
+	def tiles(self):
+		"""returns [(z, x, y)] of all tiles with segments"""
+		result = []
+		for z in range(self.max_zoom + 1):
+			keys = self.index[z][0]
+			result += [(z, k // 2 ** z, k % 2 ** z) for k in keys.tolist()]
+		return result
+
+	def render(self, z, tx, ty):
+		"""renders one tile
+
+		Returns:
+			PIL image, None if nothing is drawn on it
+		"""
+		from PIL import Image, ImageDraw
+		(keys, first, last, numbers) = self.index[z]
+		k = numpy.searchsorted(keys, tx * 2 ** z + ty)
+		if k == len(keys) or keys[k] != tx * 2 ** z + ty:
+			return None
+		seg = numbers[first[k]:last[k]]
+		# a palette image - it is much faster to encode than RGB
+		img = Image.new("P", (self.tile_size, self.tile_size), 0)
+		img.putpalette((255, 255, 255) + png_line_color + png_jump_color + png_stitch_color)
+		draw = ImageDraw.Draw(img)
+		# the vertices of the runs of consecutive segments
+		cut = numpy.flatnonzero(numpy.diff(seg) != 1) + 1
+		(start, end) = (seg[numpy.concatenate(([0], cut))], seg[numpy.concatenate((cut, [len(seg)])) - 1] + 1)
+		(i, vertex) = expand_ranges(start, end)
+		# whole pixels of the level first - PIL truncates towards zero,
+		# which would move the ends of lines coming from the tiles left 
+		# of and above this one
+		scale = self.scale(z)
+		px = numpy.floor((self.x[vertex] - self.left) * scale) - tx * self.tile_size
+		py = numpy.floor((self.top - self.y[vertex]) * scale) - ty * self.tile_size
+		if z >= self.mark_stitch:
+			marked = ~self.jumps[vertex]
+			draw_markers(draw, px[marked], py[marked], 3, tile_mark_size)
+		# one path through all runs, the steps between them left out
+		draw_polylines(draw, numpy.column_stack((px, py)).ravel().tolist(),
+			self.jumps[vertex[1:]], z >= self.mark_jump, i[1:] != i[:-1], 1, 2)
+		if img.getextrema()[1] == 0:
+			return None
+		return img
+
+	def save(self, directory, z, tx, ty):
+		"""renders one tile to directory/z/x/y.png
+
+		Returns:
+			True if the tile was written, False if it is empty
+		"""
+		img = self.render(z, tx, ty)
+		if img is None:
+			return False
+		path = os.path.join(directory, str(z), str(tx))
+		if not os.path.isdir(path):
+			try:
+				os.makedirs(path)
+			except OSError:
+				# made by another worker meanwhile
+				pass
+		img.save(os.path.join(path, "%d.png" % ty), "PNG")
+		return True
+
+def expand_ranges(first, last):
+	"""expands the ranges first[i]..last[i] (inclusive)
+
+	Returns:
+		(i, value) arrays - the range number and value of every element
+	"""
+	n = numpy.maximum(last - first + 1, 0)
+	i = numpy.repeat(numpy.arange(len(n)), n)
+	value = first[i] + numpy.arange(len(i)) - numpy.repeat(numpy.cumsum(n) - n, n)
+	return (i, value)
+
+def _tile_init(renderer, directory):
+	global _tile_renderer, _tile_directory
+	(_tile_renderer, _tile_directory) = (renderer, directory)
+
+def _tile_save(tile):
+	return _tile_renderer.save(_tile_directory, *tile)
+
+
+############################################
+#### STITCH EFFECTS
+############################################
+
+# An effect is a list of groups (condition, points), emitted in order
+# for every stitch but the first one, which is kept as it is.
+#
+# condition is None (always) or a function of a context with the
+# attributes index, count, jump, dmax (largest move along one axis),
+# length, last_length and next_length (lengths of the move to this
+# stitch, the one before and the one after). They are arrays for the
+# columnar backend and plain numbers otherwise, so conditions may only
+# use comparisons and & (no and/or/not/~).
+#
+# points are templates:
+#	("stitch",)	this stitch (coordinates, jump flag and color)
+#	("last",)	the stitch before
+#	("here",), ("back",)	rounded position of this stitch / the one before
+#	("here", coef, segment, direction)	plus coef times the unit vector
+#		along (ALONG) or to the left of (NORMAL) a move: segment 0 is
+#		the move to this stitch, -1 the one before and 1 the one after
+
+ALONG = 0
+NORMAL = 1
+STITCH = ("stitch",)
+LAST = ("last",)
+
+def _drawn(s):
+	return (s.jump == 0) & (s.length != 0)
+
+def triple_effect(length):
+	# back, forth and back again, offset to the right
+	return [
+		(_drawn, [("here", -length, 0, NORMAL), ("back", -length, 0, NORMAL)]),
+		(None, [STITCH]),
+	]
+
+def red_work_effect(length):
+	# like triple, with an extra pass offset to the left
+	return [
+		(_drawn, [("here", -length, 0, NORMAL), ("back", -length, 0, NORMAL),
+			("here", length, 0, NORMAL), ("back", length, 0, NORMAL)]),
+		(None, [STITCH]),
+	]
+
+def bean_effect():
+	# back and forth along every stitch
+	return [
+		(_drawn, [STITCH, LAST]),
+		(None, [STITCH]),
+	]
+
+def endstitch_effect(length, max_stitch_length):
+	# lock stitches at both ends of moves that are too long
+	return [
+		(lambda s: s.dmax > max_stitch_length,
+			[("back", length, 0, ALONG), LAST, STITCH, ("here", -length, 0, ALONG)]),
+		(None, [STITCH]),
+	]
+
+def jump_endstitch_effect(length):
+	# lock stitches before and after jumps
+	return [
+		(lambda s: (s.jump != 0) & (s.index > 2) & (s.last_length != 0),
+			[("back", -length, -1, ALONG), LAST]),
+		(None, [STITCH]),
+		(lambda s: (s.jump != 0) & (s.index + 1 < s.count) & (s.next_length != 0),
+			[("here", length, 1, ALONG), ("here",)]),
+	]
+
+class EffectContext:
+	def __init__(self, **values):
+		self.__dict__.update(values)
+
+
+############################################
+#### PATH OPTIMIZER
+############################################
+
+class EndpointIndex:
+	"""uniform grid over the endpoints of segments for nearest
+	neighbour queries. Segments are removed once they are used.
+	"""
+	def __init__(self, points, cell_size):
+		"""
+		Args:
+			points: list of (x, y, segment, end)
+			cell_size: size of the grid cells
+		"""
+		self.cell_size = float(cell_size)
+		self.cells = {}
+		for point in points:
+			self.cells.setdefault(self.cell(point[0], point[1]), []).append(point)
+		self.removed = set()
+		self.remaining = len(set(point[2] for point in points))
+		cells = self.cells.keys() or [(0, 0)]
+		self.bounds = (min(c[0] for c in cells), min(c[1] for c in cells),
+			max(c[0] for c in cells), max(c[1] for c in cells))
+
+	def cell(self, x, y):
+		return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+	def remove(self, segment):
+		if segment not in self.removed:
+			self.removed.add(segment)
+			self.remaining -= 1
+
+	def nearest(self, x, y, count=1):
+		"""the count nearest endpoints of segments not removed yet
+
+		Returns:
+			list of (distance, (x, y, segment, end)), nearest first
+		"""
+		found = []
+		if self.remaining == 0:
+			return found
+		(cx, cy) = self.cell(x, y)
+		(x0, y0, x1, y1) = self.bounds
+		first = max(x0 - cx, cx - x1, y0 - cy, cy - y1, 0)
+		for r in range(first, max(cx - x0, x1 - cx, cy - y0, y1 - cy) + 1):
+			for (i, j) in self._ring(cx, cy, r):
+				points = self.cells.get((i, j))
+				if not points:
+					continue
+				for point in points:
+					if point[2] not in self.removed:
+						found.append((math.hypot(point[0] - x, point[1] - y), point))
+			# nothing outside ring r is nearer than r cells
+			if len(found) >= count:
+				found.sort()
+				if found[count-1][0] <= r * self.cell_size:
+					return found[:count]
+		found.sort()
+		return found[:count]
+
+	def _ring(self, cx, cy, r):
+		# cells at chebyshev distance r around cx, cy - inside the bounds
+		if r == 0:
+			return [(cx, cy)]
+		(x0, y0, x1, y1) = self.bounds
+		cells = []
+		for j in (cy - r, cy + r):
+			if y0 <= j <= y1:
+				cells += [(i, j) for i in range(max(cx - r, x0), min(cx + r, x1) + 1)]
+		for i in (cx - r, cx + r):
+			if x0 <= i <= x1:
+				cells += [(i, j) for j in range(max(cy - r + 1, y0), min(cy + r - 1, y1) + 1)]
+		return cells
+
+def order_segments(heads, tails, start, reverse=True, passes=10, neighbours=8):
+	"""orders segments to keep the jumps between them short: a nearest
+	neighbour tour from start, improved with 2-opt moves (only if
+	segments may be reversed, a 2-opt move sews a part backwards)
+
+	Args:
+		heads, tails: lists of (x, y) - first and last point of each segment
+		start: (x, y) the tour starts from
+		reverse: segments may be sewn backwards (default = True)
+		passes: max. number of 2-opt passes (default = 10)
+		neighbours: number of near segments tried by 2-opt (default = 8)
+	Returns:
+		list of (segment, reversed)
+	"""
+	m = len(heads)
+	if m == 0:
+		return []
+	def build(points):
+		# about two endpoints per cell
+		xs = [p[0] for p in points]
+		ys = [p[1] for p in points]
+		area = max(max(xs) - min(xs), 1) * max(max(ys) - min(ys), 1)
+		return EndpointIndex(points, max(math.sqrt(2.0 * area / len(points)), 1))
+
+	points = [(hx, hy, s, 0) for (s, (hx, hy)) in enumerate(heads)]
+	if reverse:
+		points += [(tx, ty, s, 1) for (s, (tx, ty)) in enumerate(tails)]
+	index = build(points)
+
+	# nearest neighbour tour - the index is rebuilt when it gets sparse
+	order = []
+	rev = []
+	(x, y) = start
+	size = m
+	while index.remaining:
+		if index.remaining * 4 < size:
+			used = set(order)
+			index = build([p for p in points if p[2] not in used])
+			size = index.remaining
+		(distance, (px, py, s, end)) = index.nearest(x, y)[0]
+		index.remove(s)
+		order.append(s)
+		rev.append(end == 1)
+		(x, y) = end and heads[s] or tails[s]
+	if not reverse or m < 3:
+		return zip(order, rev)
+
+	# 2-opt: reversing order[i:j+1] replaces the jumps into i and out of j
+	near = []
+	full = build(points)
+	for s in range(m):
+		found = full.nearest(heads[s][0], heads[s][1], neighbours)
+		found += full.nearest(tails[s][0], tails[s][1], neighbours)
+		near.append(set(point[2] for (d, point) in found) - set([s]))
+	pos = [0] * m
+	for (i, s) in enumerate(order):
+		pos[s] = i
+
+	def entry(i):
+		return rev[i] and tails[order[i]] or heads[order[i]]
+	def exit(i):
+		if i < 0:
+			return start
+		return rev[i] and heads[order[i]] or tails[order[i]]
+	def dist(a, b):
+		return math.hypot(a[0] - b[0], a[1] - b[1])
+
+	for p in range(passes):
+		improved = False
+		for i in range(m):
+			before = exit(i - 1)
+			candidates = set(pos[t] for t in near[order[i]])
+			if i > 0:
+				candidates |= set(pos[t] for t in near[order[i-1]])
+			candidates |= set(pos[t] - 1 for t in near[order[i]])
+			for j in candidates:
+				if j < i:
+					continue
+				old = dist(before, entry(i))
+				new = dist(before, exit(j))
+				if j + 1 < m:
+					old += dist(exit(j), entry(j + 1))
+					new += dist(entry(i), entry(j + 1))
+				if new < old - 1e-9:
+					order[i:j+1] = order[i:j+1][::-1]
+					rev[i:j+1] = [not r for r in rev[i:j+1][::-1]]
+					for k in range(i, j + 1):
+						pos[order[k]] = k
+					improved = True
+					before = exit(i - 1)
+		if not improved:
+			break
+	return zip(order, rev)
+
+
+############################################
+#### SIMPLIFICATION
+############################################
+
+# Both versions below choose the same points: the numpy one splits
+# all intervals of a level at once, the list one works through a stack.
+
+def simplify_keep(x, y, keep, tolerance, max_length):
+	"""Ramer-Douglas-Peucker over stitch arrays: between two kept points
+	the point farthest from the line between them is kept if it is
+	off by more than tolerance. Lines longer than max_length (along one
+	axis) are split in the middle.
+
+	Args:
+		x, y: coordinate arrays
+		keep: bool array - points that must stay (at least first and last)
+		tolerance: largest distance of a dropped point from the path
+		max_length: longest stitch made by dropping points
+	Returns:
+		bool array of the points to keep
+	"""
+	keep = keep.copy()
+	index = numpy.arange(len(x))
+	while True:
+		k = numpy.flatnonzero(keep)
+		gaps = numpy.flatnonzero(numpy.diff(k) > 1)
+		if len(gaps) == 0:
+			return keep
+		# the kept points before and after every point
+		a = k[numpy.searchsorted(k, index, "right") - 1]
+		b = k[numpy.minimum(numpy.searchsorted(k, index, "left"), len(k) - 1)]
+		d = segment_distance(x, y, x[a], y[a], x[b], y[b])
+		d[keep] = -1
+		# first farthest point of every interval with points inside
+		dmax = numpy.maximum.reduceat(d, k)
+		far = numpy.flatnonzero((d == numpy.repeat(dmax, numpy.diff(numpy.append(k, len(x))))) & ~keep)
+		far = far[numpy.unique(a[far], return_index=True)[1]]
+		(start, end) = (k[gaps], k[gaps + 1])
+		dmax = numpy.maximum(numpy.absolute(x[end] - x[start]), numpy.absolute(y[end] - y[start]))
+		split = numpy.where(d[far] > tolerance, far,
+			numpy.where(dmax > max_length, long_split(start, end,
+				numpy.maximum(dmax, max_length), max_length), -1))
+		split = split[split >= 0]
+		if len(split) == 0:
+			return keep
+		keep[split] = True
+
+def segment_distance(x, y, ax, ay, bx, by):
+	"""distance of the points x, y from the lines a-b (arrays or numbers)"""
+	(vx, vy) = (bx - ax, by - ay)
+	(px, py) = (x - ax, y - ay)
+	l2 = vx * vx + vy * vy
+	if numpy is not None and isinstance(l2, numpy.ndarray):
+		t = numpy.clip((px * vx + py * vy) / numpy.where(l2 > 0, l2, 1), 0, 1)
+	elif l2 > 0:
+		t = min(max((px * vx + py * vy) / l2, 0), 1)
+	else:
+		t = 0
+	(dx, dy) = (px - t * vx, py - t * vy)
+	if numpy is not None and isinstance(dx, numpy.ndarray):
+		return numpy.sqrt(dx * dx + dy * dy)
+	return math.sqrt(dx * dx + dy * dy)
+
+def long_split(a, b, dmax, max_length):
+	# where to split a line that is too long: after about half of the
+	# stitches it needs, assuming evenly spaced points
+	k = (dmax + max_length - 1) // max_length
+	split = a + ((b - a) * (k // 2) + k // 2) // k
+	if numpy is not None and isinstance(split, numpy.ndarray):
+		return numpy.clip(split, a + 1, b - 1).astype(numpy.int64)
+	return int(min(max(split, a + 1), b - 1))
+
+def simplify_keep_points(xs, ys, keep, tolerance, max_length):
+	"""simplify_keep for lists"""
+	keep = list(keep)
+	fixed = [i for i in range(len(keep)) if keep[i]]
+	stack = [(a, b) for (a, b) in zip(fixed, fixed[1:]) if b - a > 1]
+	while stack:
+		(a, b) = stack.pop()
+		(far, dmax) = (a + 1, -1)
+		for i in range(a + 1, b):
+			d = segment_distance(xs[i], ys[i], xs[a], ys[a], xs[b], ys[b])
+			if d > dmax:
+				(far, dmax) = (i, d)
+		if dmax > tolerance:
+			split = far
+		elif max(abs(xs[b] - xs[a]), abs(ys[b] - ys[a])) > max_length:
+			split = long_split(a, b, max(abs(xs[b] - xs[a]), abs(ys[b] - ys[a])), max_length)
+		else:
+			continue
+		keep[split] = True
+		stack += [(c, d) for (c, d) in ((a, split), (split, b)) if d - c > 1]
+	return keep
+
+def merge_keep(x, y, keep, min_length):
+	"""merges stitches shorter than min_length: of a row of short
+	stitches one point per min_length of path is kept. The stitches
+	made stay shorter than 2 * min_length.
+
+	Args:
+		x, y: coordinate arrays
+		keep: bool array - points that must stay (at least first and last)
+		min_length: shortest stitch worth sewing
+	Returns:
+		bool array of the points to keep
+	"""
+	length = numpy.hypot(numpy.diff(x), numpy.diff(y))
+	# path length since the last fixed point
+	s = numpy.concatenate(([0.0], numpy.cumsum(length)))
+	s -= s[numpy.maximum.accumulate(numpy.where(keep, numpy.arange(len(x)), 0))]
+	bucket = numpy.floor(s / min_length)
+	new_keep = keep.copy()
+	new_keep[1:] |= bucket[1:] != bucket[:-1]
+	new_keep[:-1] |= length >= min_length
+	new_keep[1:] |= length >= min_length
+	return new_keep
+
+def merge_keep_points(xs, ys, keep, min_length):
+	"""merge_keep for lists"""
+	new_keep = list(keep)
+	(total, start, bucket) = (0.0, 0.0, 0.0)
+	for i in range(1, len(xs)):
+		length = math.hypot(xs[i] - xs[i-1], ys[i] - ys[i-1])
+		total += length
+		if keep[i]:
+			start = total
+		new_bucket = math.floor((total - start) / min_length)
+		if new_bucket != bucket:
+			new_keep[i] = True
+		if length >= min_length:
+			new_keep[i-1] = new_keep[i] = True
+		bucket = new_bucket
+	return new_keep
+
+############################################
+#### MOVE PLANNER
+############################################
+
+
+def plan_move(dx, dy, limit):
+	"""splits one integer move into the fewest records of at most limit
+	along each axis - the pieces are spread evenly, so they differ by
+	at most one
+
+	Returns:
+		list of (dx, dy) records - a single (0, 0) for a zero move
+	"""
+	steps = max((max(abs(dx), abs(dy)) + limit - 1) // limit, 1)
+	return [((i + 1) * dx // steps - i * dx // steps,
+		(i + 1) * dy // steps - i * dy // steps) for i in range(steps)]
+
+def plan_moves(dx, dy, limit, jump_limit=None, jump=None):
+	"""vectorized plan_move over whole arrays of moves
+
+	Args:
+		dx, dy: integer arrays of moves
+		limit: largest move of one record along each axis
+		jump_limit, jump: limit for the moves where the bool array jump is set
+	Returns:
+		(rx, ry, index) - the records and the move each one belongs to
+	"""
+	if jump is not None and jump_limit is not None and jump_limit != limit:
+		limit = numpy.where(jump, jump_limit, limit)
+	dmax = numpy.maximum(numpy.absolute(dx), numpy.absolute(dy))
+	steps = numpy.maximum((dmax + limit - 1) // limit, 1)
+	if len(steps) and steps.max() == 1:
+		return (dx, dy, numpy.arange(len(dx)))
+	index = numpy.repeat(numpy.arange(len(dx)), steps)
+	i = numpy.arange(len(index)) - (numpy.cumsum(steps) - steps)[index]
+	k = steps[index]
+	dx = dx[index]
+	dy = dy[index]
+	rx = (i + 1) * dx // k - i * dx // k
+	ry = (i + 1) * dy // k - i * dy // k
+	return (rx, ry, index)
+
+
+############################################
+#### STITCH CODECS
+############################################
+
+def balanced_ternary(v, digits=5):
+	"""returns the balanced ternary digits (-1, 0, 1) of v, lowest first"""
+	result = []
+	for i in range(digits):
+		r = v % 3
+		if r == 2:
+			r = -1
+		result.append(r)
+		v = (v - r) // 3
+	return result
+
+# (byte, bit for +1, bit for -1) of each balanced ternary digit 
+# (weights 1, 3, 9, 27, 81) in a DST/Tajima record
+DST_X_BITS = ((0, 0x01, 0x02), (1, 0x01, 0x02), (0, 0x04, 0x08), (1, 0x04, 0x08), (2, 0x04, 0x08))
+DST_Y_BITS = ((0, 0x80, 0x40), (1, 0x80, 0x40), (0, 0x20, 0x10), (1, 0x20, 0x10), (2, 0x20, 0x10))
+
+def dst_table(bits):
+	# record bytes (b1, b2, b3) for every move -121..121 along one axis
+	table = []
+	for v in range(-dst_max_move, dst_max_move + 1):
+		record = [0, 0, 0]
+		for (digit, (byte, plus, minus)) in zip(balanced_ternary(v), bits):
+			if digit > 0:
+				record[byte] |= plus
+			elif digit < 0:
+				record[byte] |= minus
+		table.append(tuple(record))
+	return table
+
+DST_X_TABLE = dst_table(DST_X_BITS)
+DST_Y_TABLE = dst_table(DST_Y_BITS)
+
+def dst_decode_table(bits):
+	# move contributed by every value of each of the three record bytes
+	table = [[0] * 256 for byte in range(3)]
+	for (weight, (byte, plus, minus)) in zip((1, 3, 9, 27, 81), bits):
+		for b in range(256):
+			if b & plus:
+				table[byte][b] += weight
+			if b & minus:
+				table[byte][b] -= weight
+	return table
+
+DST_DX_TABLE = dst_decode_table(DST_X_BITS)
+DST_DY_TABLE = dst_decode_table(DST_Y_BITS)
+
+_dst_arrays = None
+
+def dst_arrays():
+	# the tables as numpy arrays (x, y, dx, dy) - built on first use
+	global _dst_arrays
+	if _dst_arrays is None:
+		_dst_arrays = (numpy.array(DST_X_TABLE, numpy.uint8), 
+			numpy.array(DST_Y_TABLE, numpy.uint8),
+			numpy.array(DST_DX_TABLE, numpy.int64), 
+			numpy.array(DST_DY_TABLE, numpy.int64))
+	return _dst_arrays
+
+def dst_flags(b3):
+	# 0x80 marks a jump, 0x80 together with 0x40 a color change
+	if b3 & 0xC0 == 0xC0:
+		return JUMP | COLOR_CHANGE
+	elif b3 & 0x80:
+		return JUMP
+	return 0
+
+def tajima_records(data):
+	"""decode DST/Tajima stitch data (without the 512 byte header) 
+	record by record, up to the 0xF3 end marker
+
+	Args:
+		data: stitch data (string or bytearray) or a file object
+			positioned after the header, which is read block by block
+	Returns:
+		generator of (dx, dy, flags)
+	"""
+	(source, data) = _record_source(data)
+	(tx1, tx2, tx3) = DST_DX_TABLE
+	(ty1, ty2, ty3) = DST_DY_TABLE
+	while True:
+		for i in range(0, len(data) - 2, 3):
+			(b1, b2, b3) = (data[i], data[i+1], data[i+2])
+			if b3 == 0xF3:
+				return
+			yield (tx1[b1] + tx2[b2] + tx3[b3], ty1[b1] + ty2[b2] + ty3[b3], dst_flags(b3))
+		if source is None:
+			return
+		(source, data) = _refill(source, data, len(data) // 3 * 3)
+
+def decode_tajima(data):
+	"""decode DST/Tajima stitch data (without the 512 byte header) in bulk
+
+	Args:
+		data: stitch data (string or numpy uint8 array)
+	Returns:
+		(dx, dy, flags) arrays of all records before the 0xF3 end marker
+	"""
+	if not isinstance(data, numpy.ndarray):
+		data = numpy.frombuffer(data, numpy.uint8)
+	records = data[:len(data) // 3 * 3].reshape(-1, 3)
+	end = numpy.flatnonzero(records[:,2] == 0xF3)
+	if len(end):
+		records = records[:end[0]]
+	(b1, b2, b3) = (records[:,0], records[:,1], records[:,2])
+	(tx, ty) = dst_arrays()[2:]
+	dx = tx[0][b1] + tx[1][b2] + tx[2][b3]
+	dy = ty[0][b1] + ty[1][b2] + ty[2][b3]
+	flags = numpy.where(b3 & 0x80, JUMP, 0).astype(numpy.uint8)
+	flags[(b3 & 0xC0) == 0xC0] |= COLOR_CHANGE
+	return (dx, dy, flags)
+
+
+def melco_records(data):
+	"""decode EXP/Melco data record by record
+
+	Args:
+		data: file contents (string or bytearray) or a file object, 
+			which is read block by block
+	Returns:
+		generator of (dx, dy, flags) - flags is JUMP or COLOR_CHANGE 
+		for records preceded by a 0x80 control escape
+	"""
+	(source, data) = _record_source(data)
+	n = len(data)
+	i = 0
+	while True:
+		if source is not None and n - i < 4:
+			(source, data) = _refill(source, data, i)
+			(n, i) = (len(data), 0)
+		if i + 1 >= n:
+			break
+		flags = 0
+		if data[i] == 0x80:
+			ctl = data[i+1]
+			if ctl == 0x04 or ctl == 0x02 or ctl == 0x00:
+				flags = JUMP
+			elif ctl == 0x01:
+				flags = COLOR_CHANGE
+			i += 2
+			if i + 1 >= n:
+				break
+		dx = data[i]
+		if dx > 127:
+			dx = dx - 256
+		dy = data[i+1]
+		if dy > 127:
+			dy = dy - 256
+		i += 2
+		yield (dx, dy, flags)
+
+
+def _record_source(data):
+	# (file or None, buffer) for the record decoders
+	if hasattr(data, "read"):
+		return (data, bytearray())
+	return (None, bytearray(data))
+
+def _refill(source, data, used):
+	# drop the used part of the buffer and append the next block
+	block = source.read(stream_block_size)
+	if not block:
+		return (None, data[used:])
+	return (source, data[used:] + bytearray(block))
+
+def melco_escapes(first):
+	# mask of the control escapes among byte pairs, given their first bytes
+	is80 = first == 0x80
+	run_start = is80.copy()
+	run_start[1:] &= ~is80[:-1]
+	index = numpy.arange(len(first))
+	start = numpy.maximum.accumulate(numpy.where(run_start, index, 0))
+	return is80 & ((index - start) % 2 == 0)
+
+def decode_melco(data):
+	"""decode EXP/Melco data in bulk - same results as melco_records.
+
+	Every record is an even number of bytes, so the data is viewed as 
+	byte pairs. A pair starting with 0x80 is a control escape, unless 
+	it directly follows one (then it is the move of value -128). 
+
+	Args:
+		data: file contents (string or numpy uint8 array)
+	Returns:
+		(dx, dy, flags, color_changes) - int arrays of all move records,
+		a uint8 flags array and the number of color changes
+	"""
+	if not isinstance(data, numpy.ndarray):
+		data = numpy.frombuffer(data, numpy.uint8)
+	n = len(data) // 2
+	pairs = data[:2*n].reshape(n, 2)
+	first = pairs[:,0]
+
+	# escapes: every second pair of a run of pairs starting with 0x80
+	escape = melco_escapes(first)
+
+	moves = numpy.flatnonzero(~escape)
+	ctl = numpy.full(len(moves), 0xFF, numpy.uint8)
+	after_escape = moves > 0
+	after_escape[after_escape] = escape[moves[after_escape] - 1]
+	ctl[after_escape] = pairs[moves[after_escape] - 1, 1]
+	flags = numpy.zeros(len(moves), numpy.uint8)
+	flags[(ctl == 0x04) | (ctl == 0x02) | (ctl == 0x00)] = JUMP
+	flags[ctl == 0x01] = COLOR_CHANGE
+
+	dx = pairs[moves, 0].view(numpy.int8).astype(numpy.int64)
+	dy = pairs[moves, 1].view(numpy.int8).astype(numpy.int64)
+	return (dx, dy, flags, int(numpy.count_nonzero(ctl == 0x01)))
+
+
+def pes_records(f):
+	"""decode PES/PEC stitch data record by record (color changes 
+	are skipped)
+
+	Args:
+		f: file object positioned at the start of the stitch data
+	Returns:
+		generator of (dx, dy, flags)
+	"""
+	# derived from stitchloader.py
+	def readInt8(f):
+		data = f.read(1)
+		if not data:
+			return None
+		return ord(data)
+
+	while 1:
+		val1 = readInt8(f)
+		val2 = readInt8(f)
+		
+		if val1 is None or val2 is None:
+			break
+		elif val1 == 255 and val2 == 0:
+			break
+		elif val1 == 254 and val2 == 176:
+			nn = readInt8(f)
+		else:
+			if val1 & 128 == 128: # 0x80
+				#this is a jump stitch
+				jump = True
+				x = ((val1 & 15) * 256) + val2
+				if x & 2048 == 2048: # 0x0800
+					x = x - 4096
+				#read next byte for Y value
+				val2 = readInt8(f)
+				if val2 is None:
+					break
+			else:
+				#normal stitch
+				jump = False
+				x = val1
+				if x > 63:
+					x = x - 128
+			
+			if val2 & 128 == 128: # 0x80
+				#this is a jump stitch
+				jump = True
+				val3 = readInt8(f)
+				if val3 is None:
+					break
+				y = ((val2 & 15) * 256) + val3
+				if y & 2048 == 2048: # 0x0800
+					y = y - 4096
+			else:
+				#normal stitch
+				jump = False
+				y = val2
+				if y > 63:
+					y = y - 128
+			#flip vertical coordinate 
+			yield (x, -y, jump and JUMP or 0)
+
+# record encoders for the planned moves of the columnar backend -
+# rx, ry and flags are arrays as returned by Embroidery._record_chunks
+
+def _record_offsets(size):
+	# start of every variable length record and the total length
+	end = numpy.cumsum(size)
+	return (end - size, len(end) and int(end[-1]) or 0)
+
+def encode_melco(rx, ry, flags):
+	"""EXP/Melco records - jump records get a 0x80 0x04 escape"""
+	jump = (flags & JUMP) != 0
+	(start, length) = _record_offsets(numpy.where(jump, 4, 2))
+	out = numpy.zeros(length, numpy.uint8)
+	out[start[jump]] = 0x80
+	out[start[jump] + 1] = 0x04
+	pos = start + numpy.where(jump, 2, 0)
+	out[pos] = rx & 0xFF
+	out[pos + 1] = ry & 0xFF
+	return out
+
+def encode_ksm(rx, ry, flags):
+	"""KSM/Pfaff records - absolute y, absolute x, mode byte with the signs"""
+	out = numpy.empty((len(rx), 3), numpy.uint8)
+	out[:,0] = numpy.absolute(ry)
+	out[:,1] = numpy.absolute(rx)
+	out[:,2] = numpy.where(flags & COLOR_CHANGE, 0x99, 0x80) | \
+		numpy.where(ry < 0, 0x20, 0) | numpy.where(rx < 0, 0x40, 0)
+	return out.reshape(-1)
+
+def encode_tajima(rx, ry, flags):
+	"""DST/Tajima records (table lookup)"""
+	(tx, ty) = dst_arrays()[:2]
+	out = tx[rx + dst_max_move] | ty[ry + dst_max_move]
+	out[:,2] |= 0x03
+	out[(flags & JUMP) != 0, 2] |= 0x80
+	return out.reshape(-1)
+
+def encode_pes(rx, ry, flags):
+	"""PEC records - 7 bit short form for stitches, 12 bit long form
+	(0x80 set) for jumps, y pointing down"""
+	jump = (flags & JUMP) != 0
+	ry = -ry
+	(start, length) = _record_offsets(numpy.where(jump, 4, 2))
+	out = numpy.empty(length, numpy.uint8)
+	s = start[~jump]
+	out[s] = rx[~jump] & 0x7F
+	out[s + 1] = ry[~jump] & 0x7F
+	s = start[jump]
+	(x, y) = (rx[jump], ry[jump])
+	out[s] = 0x80 | ((x >> 8) & 0x0F)
+	out[s + 1] = x & 0xFF
+	out[s + 2] = 0x80 | ((y >> 8) & 0x0F)
+	out[s + 3] = y & 0xFF
+	return out
+
+
+############################################
+#### LAZY READERS
+############################################
+
+def _open_stitch_data(filename):
+	# opens a design file and seeks to its stitch data
+	# returns (format, file)
+	ext = (filename[-3:]).lower()
+	f = open(filename, "rb")
+	if ext == "dst":
+		f.seek(512)
+	elif ext == "pes":
+		if f.read(4) != "#PES":
+			f.close()
+			raise IOError("not a PES file: %s" % filename)
+		f.seek(8)
+		pecstart = unpack('<I', f.read(4))[0]
+		f.seek(pecstart + 532)
+	elif ext != "exp":
+		f.close()
+		raise IOError("can not read stitches from: %s" % filename)
+	return (ext, f)
+
+def _move_blocks(format, f):
+	# blocks of (dx, dy, flags) arrays read with constant memory
+	if format == "exp":
+		carry = ""
+		while True:
+			block = f.read(stream_block_size)
+			data = numpy.frombuffer(carry + block, numpy.uint8)
+			if not block:
+				if len(data):
+					yield decode_melco(data)[:3]
+				return
+			# keep an escape at the end for the next block 
+			# together with an odd trailing byte
+			end = len(data) // 2 * 2
+			if end and melco_escapes(data[0:end:2])[-1]:
+				end -= 2
+			carry = (carry + block)[end:]
+			yield decode_melco(data[:end])[:3]
+	elif format == "dst":
+		carry = ""
+		while True:
+			block = f.read(stream_block_size)
+			data = carry + block
+			end = len(data) // 3 * 3
+			carry = data[end:]
+			if not end:
+				return
+			records = numpy.frombuffer(data[:end], numpy.uint8)
+			yield decode_tajima(records)
+			if not block or numpy.any(records[2::3] == 0xF3):
+				return
+	else:
+		records = []
+		for record in pes_records(f):
+			records.append(record)
+			if len(records) == stream_block_size:
+				yield tuple(numpy.array(c) for c in zip(*records))
+				records = []
+		if records:
+			yield tuple(numpy.array(c) for c in zip(*records))
+
+def iter_stitch_chunks(filename, chunk_size=None):
+	"""reads a design file (EXP, DST, PES) in chunks of stitches with
+	constant memory, however large the file is. The stitches are the 
+	ones Embroidery.load would read, but not translated to the origin.
+
+	Args:
+		filename
+		chunk_size: number of stitches per chunk, the last one may be 
+			shorter (default = stream_chunk_size)
+	Returns:
+		generator of (x, y, flags, color) numpy arrays
+	"""
+	if numpy is None:
+		raise ImportError("iter_stitch_chunks requires numpy")
+	chunk_size = chunk_size or stream_chunk_size
+	(format, f) = _open_stitch_data(filename)
+	(lastx, lasty, lastcolor) = (0, 0, 0)
+	pending = []
+	n = 0
+	if format == "exp":
+		# the EXP reader starts with a stitch at the origin
+		pending.append((numpy.zeros(1), numpy.zeros(1), 
+			numpy.zeros(1, numpy.uint8), numpy.zeros(1, numpy.uint16)))
+		n = 1
+	for (dx, dy, flags) in _move_blocks(format, f):
+		flags = numpy.asarray(flags, numpy.uint8)
+		x = lastx + numpy.cumsum(dx)
+		y = lasty + numpy.cumsum(dy)
+		color = lastcolor + numpy.cumsum((flags & COLOR_CHANGE) != 0)
+		if len(x):
+			(lastx, lasty, lastcolor) = (x[-1], y[-1], color[-1])
+		if format == "exp":
+			# zero moves are dropped (and so is their jump flag)
+			keep = (dx != 0) | (dy != 0)
+			(x, y, flags) = (x[keep], y[keep], flags[keep] & JUMP)
+			color = numpy.zeros(len(x), numpy.uint16)
+		pending.append((x, y, flags, color))
+		n += len(x)
+		while n >= chunk_size:
+			columns = [numpy.concatenate(c) for c in zip(*pending)]
+			yield (columns[0][:chunk_size].astype(numpy.float64), 
+				columns[1][:chunk_size].astype(numpy.float64),
+				columns[2][:chunk_size], columns[3][:chunk_size].astype(numpy.uint16))
+			pending = [tuple(c[chunk_size:] for c in columns)]
+			n -= chunk_size
+	f.close()
+	if n:
+		columns = [numpy.concatenate(c) for c in zip(*pending)]
+		yield (columns[0].astype(numpy.float64), columns[1].astype(numpy.float64),
+			columns[2], columns[3].astype(numpy.uint16))
+
+def iter_stitches(filename):
+	"""reads a design file (EXP, DST, PES) stitch by stitch with 
+	constant memory - for analysis jobs (stitch counts, extents, ...) 
+	that do not need the whole design. The stitches are the ones 
+	Embroidery.load would read, but not translated to the origin.
+
+	Args:
+		filename
+	Returns:
+		generator of Points
+	"""
+	if numpy is not None:
+		for columns in iter_stitch_chunks(filename):
+			for p in points_from_columns(*columns):
+				yield p
+		return
+
+	(format, f) = _open_stitch_data(filename)
+	if format == "exp":
+		records = melco_records(f)
+		yield Point(0, 0)
+	elif format == "dst":
+		records = tajima_records(f)
+	else:
+		records = pes_records(f)
+	(lastx, lasty, color) = (0, 0, 0)
+	for (dx, dy, flags) in records:
+		lastx = lastx + dx
+		lasty = lasty + dy
+		if format == "exp":
+			if dx != 0 or dy != 0:
+				yield Point(lastx, lasty, bool(flags & JUMP))
+		else:
+			if flags & COLOR_CHANGE:
+				color += 1
+			yield Point(lastx, lasty, bool(flags & JUMP), color)
+	f.close()
+
+
+############################################
+#### PROBING
+############################################
+
+def probe(filename, scan=True):
+	"""reads the metadata of a design file without loading it - from
+	the header (DST, PES, native) and one streaming pass over the 
+	stitch records for what the header does not tell (EXP has no header)
+
+	Args:
+		filename
+		scan: count stitches and jumps by a pass over the records, 
+			otherwise only headers are read and what they do not 
+			tell is None (default = True)
+	Returns:
+		dict with format, stitches, jumps, colors, width and height
+		(in 0.1 mm), source ("header", "scan" or "load")
+	"""
+	ext = (filename[-3:]).lower()
+	info = {"format": ext, "stitches": None, "jumps": None, "colors": None,
+		"width": None, "height": None, "source": "header"}
+	with stage("probe") as st:
+		st.count("files")
+		if ext == "dst":
+			_probe_tajima(filename, info, scan)
+		elif ext == "pes":
+			_probe_pes(filename, info, scan)
+		elif ext == "exp":
+			_probe_melco(filename, info)
+		elif ext == "stc":
+			_probe_native(filename, info)
+		elif ext == "svg":
+			# no header to read - load it
+			emb = Embroidery()
+			emb.load(filename)
+			stats = emb.getStats()
+			info.update(stitches=len(emb), jumps=stats["jumps"], colors=len(emb) and 1 or 0,
+				width=stats["maxx"] - stats["minx"], height=stats["maxy"] - stats["miny"],
+				source="load")
+		else:
+			raise IOError("unknown input file extension: %s" % filename)
+	return info
+
+def _probe_tajima(filename, info, scan):
+	import re
+	f = open(filename, "rb")
+	header = f.read(512)
+	# fields end with "\r" - or "\n" and 0x1A, padded with NULs
+	fields = {}
+	for field in re.split("[\r\n\x1a]", header):
+		field = field.strip(" \0")
+		if len(field) > 3 and field[2] == ":":
+			fields[field[:2]] = field[3:].strip(" \0")
+	try:
+		info["stitches"] = int(fields["ST"])
+		info["colors"] = int(fields["CO"]) + 1
+		info["width"] = int(float(fields["+X"])) + abs(int(float(fields["-X"])))
+		info["height"] = int(float(fields["+Y"])) + abs(int(float(fields["-Y"])))
+	except (KeyError, ValueError):
+		pass
+	if scan:
+		# one pass over the records for counts and extents
+		data = f.read()
+		if numpy is not None:
+			(dx, dy, flags) = decode_tajima(data)
+			(records, jumps, colors) = (len(dx), int(numpy.count_nonzero(flags & JUMP)),
+				int(numpy.count_nonzero(flags & COLOR_CHANGE)))
+			if records:
+				(x, y) = (numpy.cumsum(dx), numpy.cumsum(dy))
+				info.update(width=int(x.max() - x.min()), height=int(y.max() - y.min()))
+		else:
+			(records, jumps, colors) = (0, 0, 0)
+			(x, y, minx, miny, maxx, maxy) = (0, 0, None, None, None, None)
+			for (dx, dy, flags) in tajima_records(bytearray(data)):
+				(x, y) = (x + dx, y + dy)
+				records += 1
+				if flags & JUMP:
+					jumps += 1
+				if flags & COLOR_CHANGE:
+					colors += 1
+				if minx is None:
+					(minx, miny, maxx, maxy) = (x, y, x, y)
+				(minx, maxx) = (min(minx, x), max(maxx, x))
+				(miny, maxy) = (min(miny, y), max(maxy, y))
+			if records:
+				info.update(width=maxx - minx, height=maxy - miny)
+		info.update(stitches=records, jumps=jumps, colors=colors + 1, source="scan")
+	f.close()
+
+def _probe_pes(filename, info, scan):
+	f = open(filename, "rb")
+	if f.read(4) != "#PES":
+		f.close()
+		raise IOError("not a PES file: %s" % filename)
+	f.seek(8)
+	pecstart = unpack('<I', f.read(4))[0]
+	f.seek(77)
+	(info["width"], info["height"]) = unpack('<HH', f.read(4))
+	f.seek(pecstart + 48)
+	info["colors"] = ord(f.read(1)) + 1
+	if scan:
+		f.seek(pecstart + 532)
+		(stitches, jumps) = (0, 0)
+		for (dx, dy, flags) in pes_records(f):
+			stitches += 1
+			if flags & JUMP:
+				jumps += 1
+		info.update(stitches=stitches, jumps=jumps, source="scan")
+	f.close()
+
+def _probe_melco(filename, info):
+	# no header - one pass over the records, the same stitches as
+	# import_melco reads: one at the origin plus every non zero move
+	f = open(filename, "rb")
+	(stitches, jumps, colors) = (1, 0, 0)
+	(x, y, minx, miny, maxx, maxy) = (0, 0, 0, 0, 0, 0)
+	if numpy is not None:
+		for (dx, dy, flags) in _move_blocks("exp", f):
+			if not len(dx):
+				continue
+			keep = (dx != 0) | (dy != 0)
+			stitches += int(numpy.count_nonzero(keep))
+			jumps += int(numpy.count_nonzero(flags[keep] & JUMP))
+			colors += int(numpy.count_nonzero(flags & COLOR_CHANGE))
+			px = x + numpy.cumsum(dx)
+			py = y + numpy.cumsum(dy)
+			(minx, maxx) = (min(minx, px.min()), max(maxx, px.max()))
+			(miny, maxy) = (min(miny, py.min()), max(maxy, py.max()))
+			(x, y) = (px[-1], py[-1])
+	else:
+		for (dx, dy, flags) in melco_records(f):
+			if flags & COLOR_CHANGE:
+				colors += 1
+			if dx == 0 and dy == 0:
+				continue
+			(x, y) = (x + dx, y + dy)
+			stitches += 1
+			if flags & JUMP:
+				jumps += 1
+			(minx, maxx) = (min(minx, x), max(maxx, x))
+			(miny, maxy) = (min(miny, y), max(maxy, y))
+	f.close()
+	info.update(stitches=stitches, jumps=jumps, colors=colors + 1, 
+		width=int(maxx - minx), height=int(maxy - miny), source="scan")
+
+def _probe_native(filename, info):
+	f = open(filename, "rb")
+	size = calcsize(native_header)
+	head = f.read(size)
+	if len(head) < size or head[:4] != native_magic:
+		f.close()
+		raise IOError("not a native stitchcode file: %s" % filename)
+	(magic, version, offset, n, minx, miny, maxx, maxy, jumps, longest,
+		too_long) = unpack(native_header, head)
+	# colors from the color column
+	f.seek(offset + 16 * n)
+	color = array.array("H")
+	color.fromfile(f, n)
+	f.close()
+	changes = len([i for i in range(1, n) if color[i] != color[i-1]])
+	info.update(stitches=n, jumps=jumps, colors=n and changes + 1 or 0,
+		width=maxx - minx, height=maxy - miny)
+
+
+############################################
+#### CONVERSION CACHE
+############################################
+
+cache_max_size = 256 * 1024 * 1024	# bytes kept in a conversion cache
+cache_version = 1					# change when the output of a conversion changes
+
+class ConversionCache:
+	"""on-disk cache of converted files, keyed by the input bytes and
+	the conversion options. Entries are written to a temporary file and
+	renamed, so several processes can share one cache directory. When
+	the cache grows over max_size the least recently used entries go.
+	"""
+	def __init__(self, directory, max_size=cache_max_size):
+		self.directory = directory
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._size = None
+		if not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError:
+				# made by another process in the meantime
+				if not os.path.isdir(directory):
+					raise
+
+	def input_hash(self, filename):
+		"""hash of the content of filename"""
+		import hashlib
+		h = hashlib.sha1()
+		f = open(filename, "rb")
+		block = f.read(1 << 20)
+		while block:
+			h.update(block)
+			block = f.read(1 << 20)
+		f.close()
+		return h.hexdigest()
+
+	def key(self, input_hash, format, options):
+		"""cache key of one conversion
+
+		Args:
+			input_hash: input_hash() of the input file
+			format: output format (file extension)
+			options: dict of the options that change the output
+		Returns:
+			hex string
+		"""
+		import hashlib
+		h = hashlib.sha1()
+		h.update("%d %s %s %s" % (cache_version, input_hash, format.lower(),
+			repr(sorted(options.items()))))
+		return h.hexdigest()
+
+	def _path(self, key):
+		return os.path.join(self.directory, key[:2], key)
+
+	def fetch(self, key, filename):
+		"""copies the entry stored under key to filename
+		Returns:
+			True if the entry was found
+		"""
+		import shutil
+		path = self._path(key)
+		try:
+			shutil.copyfile(path, filename)
+			os.utime(path, None)
+		except (IOError, OSError):
+			# not cached - or evicted by another process meanwhile
+			self.misses += 1
+			return False
+		self.hits += 1
+		return True
+
+	def lookup(self, key):
+		"""returns the path of the entry stored under key, to be read
+		in place - None if there is none
+		"""
+		path = self._path(key)
+		try:
+			os.utime(path, None)
+		except OSError:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return path
+
+	def store(self, key, filename):
+		"""stores a copy of filename under key"""
+		import shutil
+		self._add(key, lambda tmp: shutil.copyfile(filename, tmp))
+
+	def store_design(self, key, emb):
+		"""stores Embroidery emb in the native format under key"""
+		self._add(key, emb.save_native)
+
+	def _add(self, key, write):
+		# write(filename) fills a temporary file, renamed to the entry
+		import tempfile
+		path = self._path(key)
+		directory = os.path.dirname(path)
+		if not os.path.isdir(directory):
+			try:
+				os.mkdir(directory)
+			except OSError:
+				pass
+		(fd, tmp) = tempfile.mkstemp(".tmp", "", directory)
+		os.close(fd)
+		try:
+			write(tmp)
+			os.rename(tmp, path)
+		except:
+			os.remove(tmp)
+			raise
+		if self._size is not None:
+			self._size += os.path.getsize(path)
+		if self._size is None or self._size > self.max_size:
+			self.evict()
+
+	def _entries(self):
+		# (mtime, size, path) of every entry, oldest first
+		entries = []
+		for sub in os.listdir(self.directory):
+			directory = os.path.join(self.directory, sub)
+			if len(sub) != 2 or not os.path.isdir(directory):
+				continue
+			for name in os.listdir(directory):
+				if name.endswith(".tmp"):
+					continue
+				path = os.path.join(directory, name)
+				try:
+					st = os.stat(path)
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, path))
+		entries.sort()
+		return entries
+
+	def evict(self):
+		"""removes least recently used entries until the cache is
+		smaller than max_size
+		"""
+		entries = self._entries()
+		size = sum(e[1] for e in entries)
+		for (mtime, length, path) in entries:
+			if size <= self.max_size:
+				break
+			try:
+				os.remove(path)
+				self.evictions += 1
+			except OSError:
+				pass
+			size -= length
+		self._size = size
+
+	def stats(self):
+		"""returns a dict with hits, misses and evictions"""
+		return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
 ############################################
 #### Turtle and Test classes
 ############################################		
@@ -11,22 +11,40 @@
 #######################################
 
 import stitchcode
+import BaseHTTPServer
+import SocketServer
+import collections
 import getopt
+import glob
+import json
+import multiprocessing
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import urlparse
 
 def usage():
 	print """
-usage: stitchconv.py [options] -i INPUT-FILE -o OUTPUT-FILE
+usage: stitchconv.py [options] -i INPUT-FILE -o OUTPUT-FILE [-o OUTPUT-FILE...]
+       stitchconv.py [options] -b OUTPUT INPUT...
+       stitchconv.py [options] -P ADDRESS
+       stitchconv.py --probe INPUT...
 
 Embroidery file conversion and manipulation.
-input supported: Melco/EXP, Brother/PES, SVG (partly)
-output supported: Melco/EXP, PNG, SVG, Brother/PES (partly)
+input supported: Melco/EXP, Tajima/DST, Brother/PES, native/STC, SVG (partly)
+output supported: Melco/EXP, Tajima/DST, Pfaff/KSM, native/STC, PNG, SVG,
+    Brother/PES (partly)
 
 options:
     -h, --help              print usage
     -i, --input=FILE        input file
-    -o, --output=FILE       output file
+    -o, --output=FILE       output file, repeat for more formats from one load
     -z, --zoom=FACTOR       zoom in/out
+    -a, --rotate=DEGREES    rotate counter-clockwise
+    -m, --mirror            mirror (flip left and right)
     -t, --to-triples        convert to triple stitches
     -r, --to-red-work       convert to red work stitches
     -s, --show-stitches     show stitches (PNG only)
@@ -34,33 +52,87 @@ options:
     -x, --show-info         show image info on commandline (size, etc..)
     -d, --distance=VALUES   distance of triple/redwork stitches in mm
     -f, --flatten           flatten embroidery (clamp too long stitches)
+    -O, --optimize-jumps    reorder the parts between jumps to shorten jumps
+    -S, --simplify=MM       drop stitches off the path by less than MM
+    -M, --min-stitch=MM     merge stitches shorter than MM (with --simplify)
+    -b, --batch=OUTPUT      batch mode: convert every INPUT (files, globs or
+                            directories) - OUTPUT is a directory or a 
+                            template like out/{name}.dst - inputs that
+                            would write the same output file fail
+    -F, --format=EXT        output format for a batch directory (default: exp)
+    -w, --workers=COUNT     number of batch worker processes (default: cpus)
+    --tiles=DIR             write a pyramid of PNG tiles DIR/z/x/y.png
+    --max-zoom=LEVEL        deepest tile level (default: 20 pixels per mm)
+    --mark-zoom=LEVEL       tile level from which on --show-stitches and
+                            --show-jumps apply, negative levels count from
+                            the deepest (default: -1)
+    -P, --serve=ADDRESS     server mode: convert files posted to
+                            /convert?format=EXT&input=EXT&OPTION=VALUE...
+                            on HOST:PORT (HTTP) or a Unix socket path,
+                            metrics at /metrics
+    --max-jobs=COUNT        jobs running or waiting in server mode, more
+                            are refused (default: 2 * workers)
+    --probe                 print stitches, jumps, colors and size of every
+                            INPUT from the file headers, without loading
+    -c, --cache=DIR         reuse earlier conversions stored in DIR
+    -C, --cache-size=MB     size limit of the cache (default: 256)
+    -p, --profile           print the time spent per stage
+    --log=FORMAT            progress messages: text (default), json or none
     -v, --verbose           be verbose
 """
 
 infile = "";
-outfile = "";
+outfiles = []
 zoom = 1
+rotate = 0
+mirror = False
 distance = 0.3
 to_triple_stitches = False
 to_red_work = False
 show_stitches = False
 flatten = False
+optimize_jumps = False
+simplify = 0
+min_stitch = 0
 show_info = False
 show_jumps = False
 verbose  = False
+profile = False
+log_format = "text"
+batch = ""
+batch_format = "exp"
+workers = 0
+inputs = []
+cache_dir = ""
+cache_size = 256
+cache = None
+serve = ""
+max_jobs = 0
+server_timeout = 600
+probe = False
+tiles = ""
+max_zoom = None
+mark_zoom = -1
 
 def process_args():
-	global infile, outfile, zoom
+	global infile, outfiles, zoom, rotate, mirror
 	global to_triple_stitches
 	global to_red_work
 	global distance, show_stitches, show_jumps
-	global flatten, show_info
-	global verbose
+	global flatten, show_info, optimize_jumps
+	global simplify, min_stitch
+	global verbose, profile, log_format
+	global batch, batch_format, workers, inputs
+	global cache_dir, cache_size
+	global serve, max_jobs, probe
+	global tiles, max_zoom, mark_zoom
 	
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], "hi:o:z:trd:sfxjv",
-			["help", "input=","output=","zoom=","to-triples","to-red-work","show-stitches",
-			"distance", "flatten", "show-info", "show-jumps","verbose"])
+		opts, args = getopt.getopt(sys.argv[1:], "hi:o:z:a:mtrd:sfOS:M:xjvpb:F:w:c:C:P:",
+			["help", "input=","output=","zoom=","rotate=","mirror","to-triples","to-red-work","show-stitches",
+			"distance", "flatten", "optimize-jumps", "simplify=", "min-stitch=", "show-info", "show-jumps","verbose", "profile", "log=",
+			"batch=", "format=", "workers=", "cache=", "cache-size=",
+			"serve=", "max-jobs=", "probe", "tiles=", "max-zoom=", "mark-zoom="])
 	except getopt.GetoptError, err:
 		# print help information and exit:
 		print str(err) # will print something like "option -a not recognized"
@@ -72,11 +144,15 @@ def process_args():
 			usage()
 			sys.exit()
 		elif o in ("-o", "--output"):
-			outfile = a
+			outfiles.append(a)
 		elif o in ("-i", "--input"):
 			infile = a
 		elif o in ("-z", "--zoom"):
 			zoom = float(a)
+		elif o in ("-a", "--rotate"):
+			rotate = float(a)
+		elif o in ("-m", "--mirror"):
+			mirror = True
 		elif o in ("-t", "--to-triples"):
 			to_triple_stitches = True
 		elif o in ("-r", "--to-red_work"):
@@ -87,29 +163,120 @@ def process_args():
 			show_stitches = True						
 		elif o in ("-f", "--flatten"):
 			flatten = True		
+		elif o in ("-O", "--optimize-jumps"):
+			optimize_jumps = True
+		elif o in ("-S", "--simplify"):
+			simplify = float(a)
+		elif o in ("-M", "--min-stitch"):
+			min_stitch = float(a)
 		elif o in ("-x", "--show-info"):
 			show_info = True	
 		elif o in ("-j", "--show-jumps"):
 			show_jumps = True	
 		elif o in ("-v", "--verbose"):
 			verbose = True	
+		elif o in ("-p", "--profile"):
+			profile = True
+		elif o == "--log":
+			log_format = a.lower()
+			if log_format not in ("text", "json", "none"):
+				print "unknown log format: %s" % a
+				usage()
+				sys.exit(2)
+		elif o in ("-b", "--batch"):
+			batch = a
+		elif o in ("-F", "--format"):
+			batch_format = a.lower().lstrip(".")
+		elif o in ("-w", "--workers"):
+			workers = int(a)
+		elif o in ("-c", "--cache"):
+			cache_dir = a
+		elif o in ("-C", "--cache-size"):
+			cache_size = float(a)
+		elif o in ("-P", "--serve"):
+			serve = a
+		elif o == "--max-jobs":
+			max_jobs = int(a)
+		elif o == "--probe":
+			probe = True
+		elif o == "--tiles":
+			tiles = a
+		elif o == "--max-zoom":
+			max_zoom = int(a)
+		elif o == "--mark-zoom":
+			mark_zoom = int(a)
 		else:
 			usage();
 			sys.exit()
 
-	if len(infile) == 0:
+	inputs = args
+	if probe:
+		if infile:
+			inputs.insert(0, infile)
+		if len(inputs) == 0:
+			print "probe needs input files."
+			usage()
+			sys.exit(2)
+	elif batch:
+		if len(inputs) == 0:
+			print "batch mode needs input files."
+			usage()
+			sys.exit(2)
+	elif len(infile) == 0 and not serve:
 		print "options required."
 		usage()
 		sys.exit(2)	
 
-if __name__ == '__main__':
-	process_args()
+input_formats = ("exp", "dst", "pes", "stc", "svg")
 
+def convert(infile, outfiles):
+	"""loads infile, applies the options and saves it as every
+	one of outfiles - outputs found in the cache are copied from there
+	Returns:
+		the converted Embroidery, None if all outputs were cached
+	"""
+	pending = outfiles
+	if cache:
+		digest = cache.input_hash(infile)
+		keys = dict((outfile, cache.key(digest, outfile[-3:], cache_options(outfile[-3:])))
+			for outfile in outfiles)
+		pending = [outfile for outfile in outfiles if not cache.fetch(keys[outfile], outfile)]
+		if not pending:
+			return None
+
+	emb = load_design(infile)
+	save_outputs(emb, pending)
+	if cache:
+		for outfile in pending:
+			if os.path.exists(outfile):
+				cache.store(keys[outfile], outfile)
+	return emb
+
+def load_design(infile):
+	"""loads infile and applies the options
+	Returns:
+		the Embroidery
+	"""
 	emb = stitchcode.Embroidery()
-	emb.load(infile)
+	# a partly cached conversion still skips decoding the input
+	emb.load(infile, cache)
 	emb.scale(zoom)
+	if rotate:
+		emb.rotate(rotate)
+	if mirror:
+		emb.mirror()
 	emb.translate_to_origin()
 	
+	if optimize_jumps:
+		(before, after) = emb.optimize_jumps()
+		if (verbose):
+			print "jump distance: %0.1fmm -> %0.1fmm" % (before / 10.0, after / 10.0)
+
+	if simplify:
+		count = len(emb)
+		emb.simplify(simplify*10, min_stitch*10)
+		if (verbose):
+			print "simplify: %d -> %d stitches" % (count, len(emb))
 
 	if to_triple_stitches:
 		if (verbose): 
@@ -123,13 +290,512 @@ if __name__ == '__main__':
 	
 	if flatten:
 		emb.flatten()
-	
-	if outfile:
-		if show_stitches and (outfile[-3:]).lower() == "png":
-			emb.save_as_png(outfile, show_stitches)
+	return emb
+
+def cache_options(format):
+	# the options that change an output in format
+	options = {"zoom": zoom, "rotate": rotate, "mirror": mirror,
+		"optimize_jumps": optimize_jumps, "simplify": simplify,
+		"to_triple_stitches": to_triple_stitches, "to_red_work": to_red_work,
+		"flatten": flatten}
+	if simplify:
+		options["min_stitch"] = min_stitch
+	if to_triple_stitches or to_red_work:
+		options["distance"] = distance
+	if format.lower() == "png":
+		options["show_stitches"] = show_stitches
+		options["show_jumps"] = show_jumps
+	return options
+
+def open_cache():
+	global cache
+	if cache_dir:
+		cache = stitchcode.ConversionCache(cache_dir, int(cache_size * 1024 * 1024))
+
+def open_sink():
+	# where stitchcode sends messages and stage timings
+	if log_format == "none":
+		sink = stitchcode.NullSink()
+	elif log_format == "json":
+		sink = stitchcode.JSONLinesSink(sys.stderr)
+	else:
+		# stage timings only when profiling
+		sink = stitchcode.StreamSink(timed=profile)
+	if profile:
+		sink = stitchcode.ProfileSink(sink.enabled and sink or None)
+	stitchcode.set_sink(sink)
+
+def profile_stages():
+	# the stages profiled since the last call - for worker processes
+	if not profile:
+		return None
+	stages = stitchcode.sink.stages
+	stitchcode.sink.stages = {}
+	return stages
+
+def print_profile():
+	print "time per stage:"
+	print stitchcode.sink.report(),
+
+def print_cache_stats(stats):
+	print "cache: %d hits, %d misses, %d evicted" % (
+		stats["hits"], stats["misses"], stats["evictions"])
+
+############################################
+#### OUTPUTS
+############################################
+
+def save_output(emb, outfile):
+	if (show_stitches or show_jumps) and (outfile[-3:]).lower() == "png":
+		emb.save_as_png(outfile, show_stitches, show_jumps)
+	else:
+		emb.save(outfile)
+
+def save_outputs(emb, outfiles):
+	"""saves the design in all outfiles - each output from its own
+	copy of the design, several outputs in parallel processes
+	"""
+	if len(outfiles) < 2 or multiprocessing.current_process().daemon:
+		# batch workers can not start processes of their own
+		for outfile in outfiles:
+			save_output(emb.copy(), outfile)
+		return
+	pool = multiprocessing.Pool(min(len(outfiles), multiprocessing.cpu_count()),
+		output_init, (emb, worker_settings()))
+	try:
+		for stages in pool.map(output_save, outfiles):
+			if stages:
+				stitchcode.sink.merge(stages)
+		pool.close()
+	except KeyboardInterrupt:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+def output_init(emb, settings):
+	global design
+	globals().update(settings)
+	open_sink()
+	design = emb
+
+def output_save(outfile):
+	save_output(design.copy(), outfile)
+	return profile_stages()
+
+############################################
+#### PROBE MODE
+############################################
+
+def run_probe():
+	"""prints the metadata of all inputs, read by stitchcode.probe
+	Returns:
+		number of files that could not be read
+	"""
+	failed = 0
+	for infile in batch_inputs(inputs):
+		try:
+			info = stitchcode.probe(infile)
+		except Exception, err:
+			failed += 1
+			print "FAILED %s: %s: %s" % (infile, err.__class__.__name__, err)
+			continue
+		def show(value):
+			return value is None and "?" or str(value)
+		size = "?"
+		if info["width"] is not None:
+			size = "%.1f x %.1f mm" % (info["width"] / 10.0, info["height"] / 10.0)
+		print "%s: %s, %s stitches, %s jumps, %s colors, %s (%s)" % (infile,
+			info["format"].upper(), show(info["stitches"]), show(info["jumps"]),
+			show(info["colors"]), size, info["source"])
+	if profile:
+		print_profile()
+	return failed
+
+############################################
+#### BATCH MODE
+############################################
+
+def batch_inputs(patterns):
+	# files, globs and directories -> sorted list of design files
+	files = []
+	for pattern in patterns:
+		if os.path.isdir(pattern):
+			names = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+			files += sorted(name for name in names if os.path.isfile(name)
+				and name[-3:].lower() in input_formats)
+		elif os.path.exists(pattern):
+			files.append(pattern)
+		else:
+			matches = sorted(glob.glob(pattern))
+			if not matches:
+				print "no input files match: %s" % pattern
+			files += matches
+	# each file once, in the order given
+	seen = set()
+	return [f for f in files if not (f in seen or seen.add(f))]
+
+def batch_output(template, infile, format):
+	# output filename for infile - template is a directory or contains {name}
+	name = os.path.splitext(os.path.basename(infile))[0]
+	if "{" in template:
+		return template.format(name=name)
+	return os.path.join(template, "%s.%s" % (name, format))
+
+def worker_settings():
+	# the options, handed to worker processes
+	return dict((name, globals()[name]) for name in ("zoom", "rotate", "mirror",
+		"distance", "to_triple_stitches", "to_red_work", "show_stitches", "show_jumps",
+		"flatten", "optimize_jumps", "simplify", "min_stitch", "verbose",
+		"cache_dir", "cache_size", "profile", "log_format"))
+
+def batch_init(settings):
+	global log_format
+	globals().update(settings)
+	if not verbose:
+		# messages of many workers would only slow the batch down
+		log_format = "none"
+	open_sink()
+	open_cache()
+
+def batch_convert(job):
+	# runs in a worker: returns (infile, outfile, error message or None,
+	# cache stats and profiled stages of this job)
+	(infile, outfile) = job
+	before = cache and cache.stats()
+	error = None
+	try:
+		convert(infile, [outfile])
+	except Exception, err:
+		error = "%s: %s" % (err.__class__.__name__, err)
+	stats = None
+	if cache:
+		stats = dict((k, v - before[k]) for (k, v) in cache.stats().iteritems())
+	return (infile, outfile, error, stats, profile_stages())
+
+def run_batch():
+	"""converts all batch inputs with a pool of worker processes
+	Returns:
+		number of failed files
+	"""
+	files = batch_inputs(inputs)
+	jobs = [(f, batch_output(batch, f, batch_format)) for f in files]
+	total_jobs = len(jobs)
+	# inputs with the same name (a.exp, a.dst) would overwrite each
+	# other's output - none of them is converted
+	sources = {}
+	for (infile, outfile) in jobs:
+		sources.setdefault(os.path.normpath(outfile), []).append(infile)
+	failed = 0
+	for (infile, outfile) in jobs:
+		others = [f for f in sources[os.path.normpath(outfile)] if f != infile]
+		if others:
+			failed += 1
+			print "FAILED %s: output %s is also the output of %s" % (infile, 
+				outfile, ", ".join(others))
+	jobs = [(f, outfile) for (f, outfile) in jobs if len(sources[os.path.normpath(outfile)]) == 1]
+	for directory in set(os.path.dirname(outfile) for (f, outfile) in jobs):
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+	pool = multiprocessing.Pool(workers or None, batch_init, (worker_settings(),))
+	total = {"hits": 0, "misses": 0, "evictions": 0}
+	try:
+		for (infile, outfile, error, stats, stages) in pool.imap(batch_convert, jobs):
+			if stages:
+				stitchcode.sink.merge(stages)
+			if stats:
+				for k in total:
+					total[k] += stats[k]
+			if error:
+				failed += 1
+				print "FAILED %s: %s" % (infile, error)
+			elif verbose:
+				print "ok     %s -> %s" % (infile, outfile)
+		pool.close()
+	except KeyboardInterrupt:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+	print "converted %d of %d files, %d failed" % (total_jobs - failed, total_jobs, failed)
+	if cache_dir and verbose:
+		print_cache_stats(total)
+	if profile:
+		print_profile()
+	return failed
+
+############################################
+#### SERVER MODE
+############################################
+
+# request parameters - the long option names
+server_flags = {"mirror": "mirror", "to-triples": "to_triple_stitches",
+	"to-red-work": "to_red_work", "show-stitches": "show_stitches", "show-jumps": "show_jumps",
+	"flatten": "flatten", "optimize-jumps": "optimize_jumps"}
+server_values = {"zoom": "zoom", "rotate": "rotate", "distance": "distance",
+	"simplify": "simplify", "min-stitch": "min_stitch"}
+
+def server_options(query):
+	# request query string -> dict of option settings
+	options = {}
+	for (name, values) in urlparse.parse_qs(query, keep_blank_values=True).iteritems():
+		value = values[-1]
+		if name in server_flags:
+			options[server_flags[name]] = value.lower() not in ("0", "false", "no")
+		elif name in server_values:
+			options[server_values[name]] = float(value)
+		elif name not in ("input", "format"):
+			raise ValueError("unknown option: %s" % name)
+	return options
+
+def server_init(settings):
+	global server_defaults
+	settings["profile"] = False
+	batch_init(settings)
+	server_defaults = settings
+
+def server_convert(data, input_format, output_format, options):
+	# runs in a worker: returns (output bytes or None, error message or None,
+	# start time, end time)
+	start = time.time()
+	globals().update(server_defaults)
+	globals().update(options)
+	directory = tempfile.mkdtemp()
+	infile = os.path.join(directory, "input." + input_format)
+	outfile = os.path.join(directory, "output." + output_format)
+	try:
+		try:
+			f = open(infile, "wb")
+			f.write(data)
+			f.close()
+			convert(infile, [outfile])
+			if not os.path.exists(outfile):
+				raise ValueError("can not write format: %s" % output_format)
+			f = open(outfile, "rb")
+			output = f.read()
+			f.close()
+		except Exception, err:
+			return (None, "%s: %s" % (err.__class__.__name__, err), start, time.time())
+	finally:
+		shutil.rmtree(directory, True)
+	return (output, None, start, time.time())
+
+class ServerMetrics:
+	"""request counters and recent latencies of the server"""
+	def __init__(self, workers, max_jobs, history=1000):
+		self.lock = threading.Lock()
+		self.workers = workers
+		self.max_jobs = max_jobs
+		self.requests = 0
+		self.completed = 0
+		self.failed = 0
+		self.rejected = 0
+		self.active = 0
+		self.latency = collections.deque(maxlen=history)
+		self.queued = collections.deque(maxlen=history)
+
+	def begin(self):
+		"""counts a new job - returns False if max_jobs are running"""
+		self.lock.acquire()
+		try:
+			self.requests += 1
+			if self.active >= self.max_jobs:
+				self.rejected += 1
+				return False
+			self.active += 1
+			return True
+		finally:
+			self.lock.release()
+
+	def release(self):
+		"""frees the slot of a job - when its worker is done with it,
+		which may be long after a timed out request was answered
+		"""
+		self.lock.acquire()
+		try:
+			self.active -= 1
+		finally:
+			self.lock.release()
+
+	def record(self, ok, latency, queued):
+		"""counts the answer to a job"""
+		self.lock.acquire()
+		try:
+			if ok:
+				self.completed += 1
+			else:
+				self.failed += 1
+			self.latency.append(latency)
+			self.queued.append(queued)
+		finally:
+			self.lock.release()
+
+	def report(self):
+		"""returns the metrics as a dict - times in ms"""
+		def summary(values):
+			values = sorted(values)
+			if not values:
+				return {"mean": 0, "p50": 0, "p95": 0, "max": 0}
+			def pick(q):
+				return values[min(int(q * len(values)), len(values) - 1)] * 1000
+			return {"mean": sum(values) / len(values) * 1000, "p50": pick(0.5),
+				"p95": pick(0.95), "max": values[-1] * 1000}
+		self.lock.acquire()
+		try:
+			return {"workers": self.workers, "max_jobs": self.max_jobs,
+				"requests": self.requests, "completed": self.completed,
+				"failed": self.failed, "rejected": self.rejected,
+				"active": self.active, "queued": max(self.active - self.workers, 0),
+				"latency_ms": summary(self.latency), "queue_ms": summary(self.queued)}
+		finally:
+			self.lock.release()
+
+class ServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""POST /convert?format=EXT&input=EXT&OPTION=VALUE... with the input
+	file as body returns the converted file, GET /metrics the metrics
+	as JSON
+	"""
+	def do_GET(self):
+		if urlparse.urlparse(self.path).path != "/metrics":
+			self.reply(404, "not found\n")
+			return
+		self.reply(200, json.dumps(self.server.metrics.report(), indent=1) + "\n",
+			"application/json")
+
+	def do_POST(self):
+		url = urlparse.urlparse(self.path)
+		if url.path != "/convert":
+			self.reply(404, "not found\n")
+			return
+		query = urlparse.parse_qs(url.query)
+		output_format = query.get("format", ["png"])[-1].lower()
+		input_format = query.get("input", ["exp"])[-1].lower()
+		try:
+			options = server_options(url.query)
+		except ValueError, err:
+			self.reply(400, "%s\n" % err)
+			return
+		if input_format not in input_formats:
+			self.reply(400, "unknown input format: %s\n" % input_format)
+			return
+		data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+		metrics = self.server.metrics
+		if not metrics.begin():
+			self.reply(503, "too many jobs\n")
+			return
+		submitted = time.time()
+		(output, error, start, end) = (None, "worker failed", submitted, submitted)
+		try:
+			# the slot is freed by the pool when the worker is done,
+			# a timed out job still occupies its worker
+			job = self.server.pool.apply_async(server_convert,
+				(data, input_format, output_format, options),
+				callback=lambda result: metrics.release())
+		except:
+			metrics.release()
+			raise
+		try:
+			try:
+				(output, error, start, end) = job.get(server_timeout)
+			except multiprocessing.TimeoutError:
+				error = "timed out after %ds" % server_timeout
+		finally:
+			metrics.record(error is None, time.time() - submitted, start - submitted)
+		if error:
+			self.reply(422, error + "\n")
 		else:
-			emb.save(outfile)
+			self.reply(200, output, "application/octet-stream")
+
+	def reply(self, code, body, content_type="text/plain"):
+		self.send_response(code)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def address_string(self):
+		if not isinstance(self.client_address, tuple):
+			return "local"
+		return BaseHTTPServer.BaseHTTPRequestHandler.address_string(self)
+
+	def log_message(self, format, *args):
+		if verbose:
+			BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	request_queue_size = 64
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+	request_queue_size = 64
+
+def make_server(address):
+	"""the conversion server on address with its worker pool, not yet
+	serving - see run_server
+	"""
+	if ":" in address:
+		(host, port) = address.rsplit(":", 1)
+		server = ThreadingHTTPServer((host or "localhost", int(port)), ServerHandler)
+	else:
+		if os.path.exists(address):
+			os.remove(address)
+		server = ThreadingUnixServer(address, ServerHandler)
+	count = workers or multiprocessing.cpu_count()
+	server.pool = multiprocessing.Pool(count, server_init, (worker_settings(),))
+	server.metrics = ServerMetrics(count, max_jobs or 2 * count)
+	return server
+
+def run_server(address):
+	"""serves conversions on address - HOST:PORT or :PORT for HTTP on
+	localhost, a path for a Unix domain socket
+	"""
+	server = make_server(address)
+	print "serving on %s with %d workers" % (address, server.metrics.workers)
+	try:
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+	finally:
+		server.server_close()
+		server.pool.terminate()
+		server.pool.join()
+		if ":" not in address and os.path.exists(address):
+			os.remove(address)
+
+if __name__ == '__main__':
+	process_args()
+	open_sink()
+
+	if serve:
+		run_server(serve)
+		sys.exit()
+
+	if probe:
+		sys.exit(run_probe() and 1 or 0)
+
+	if batch:
+		sys.exit(run_batch() and 1 or 0)
+
+	open_cache()
+	emb = convert(infile, outfiles)
+	if cache and verbose:
+		print_cache_stats(cache.stats())
+
+	if tiles:
+		if emb is None:
+			emb = load_design(infile)
+		count = emb.save_tiles(tiles, max_zoom, show_stitches and mark_zoom, 
+			show_jumps and mark_zoom, workers or None)
+		if verbose:
+			print "%d tiles written to %s" % (count, tiles)
 
 	if show_info:
+		if emb is None:
+			emb = load_design(infile)
 		print emb.info()
-	
+
+	if profile:
+		print_profile()
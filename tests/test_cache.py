@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# ------------------------------------------------------------------
+# tests: the conversion cache on Embroidery.load and save
+# run with: python -m unittest discover -s tests
+# ------------------------------------------------------------------
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+# ------------------------------------------------------------------
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import stitchcode
+from stitchcode import ConversionCache, Embroidery, Point
+
+stitchcode.set_sink(stitchcode.NullSink())
+
+def backends():
+	# columnar=True only if numpy is installed
+	if stitchcode.numpy is None:
+		return [False]
+	return [True, False]
+
+def stitches(emb):
+	return [(p.x, p.y, bool(p.jump), p.color) for p in emb.coords]
+
+class CacheTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.cache = ConversionCache(os.path.join(self.directory, "cache"))
+		emb = Embroidery()
+		for (x, y, jump) in ((0, 0, False), (200, 0, False), (200, 150, True), (0, 150, False)):
+			emb.addStitch(Point(x, y, jump))
+		self.input = self.path("design.dst")
+		emb.save(self.input)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory, True)
+
+	def path(self, name):
+		return os.path.join(self.directory, name)
+
+	def test_load(self):
+		for columnar in backends():
+			plain = Embroidery(columnar=columnar)
+			plain.load(self.input)
+			for run in range(2):
+				emb = Embroidery(columnar=columnar)
+				emb.load(self.input, self.cache)
+				self.assertEqual(stitches(emb), stitches(plain))
+				self.assertEqual(emb.getExtents(), plain.getExtents())
+		# decoded once, read from the cache after that
+		self.assertEqual((self.cache.misses, self.cache.hits), (1, 2 * len(backends()) - 1))
+
+	def test_save(self):
+		emb = Embroidery()
+		emb.load(self.input)
+		for format in ("exp", "dst", "ksm", "stc"):
+			emb.save(self.path("plain." + format))
+			emb.save(self.path("first." + format), self.cache)
+			emb.save(self.path("second." + format), self.cache)
+			expected = open(self.path("plain." + format), "rb").read()
+			for name in ("first.", "second."):
+				self.assertEqual(open(self.path(name + format), "rb").read(), expected, format)
+		self.assertEqual((self.cache.misses, self.cache.hits), (4, 4))
+
+	def test_changed_design_misses(self):
+		emb = Embroidery()
+		emb.load(self.input)
+		emb.save(self.path("first.exp"), self.cache)
+		emb.scale(2)
+		emb.save(self.path("second.exp"), self.cache)
+		self.assertEqual(self.cache.hits, 0)
+		self.assertNotEqual(open(self.path("first.exp"), "rb").read(),
+			open(self.path("second.exp"), "rb").read())
+
+	def test_content_hash(self):
+		hashes = set()
+		for columnar in backends():
+			emb = Embroidery(columnar=columnar)
+			emb.load(self.input)
+			hashes.add(emb.content_hash())
+		self.assertEqual(len(hashes), 1)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# ------------------------------------------------------------------
+# tests: file formats - exports against known-good files, round trips
+# run with: python -m unittest discover -s tests
+#
+# data/design.* hold one small design (no move needs splitting).
+# The EXP and KSM files and the DST records are byte for byte what
+# the original exporters wrote; the DST header and the native STC
+# file come from the current writers.
+# ------------------------------------------------------------------
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+# ------------------------------------------------------------------
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import stitchcode
+from stitchcode import Embroidery, Point
+
+stitchcode.set_sink(stitchcode.NullSink())
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+STITCHES = ((0, 0, False), (50, 0, False), (50, 50, False), (-20, 60, False),
+	(100, 60, True), (100, 120, False), (120, 40, False), (20, -60, True),
+	(25, -50, False), (-30, -50, False))
+
+def backends():
+	# columnar=True only if numpy is installed
+	if stitchcode.numpy is None:
+		return [False]
+	return [True, False]
+
+def design(columnar):
+	emb = Embroidery(columnar=columnar)
+	for (x, y, jump) in STITCHES:
+		emb.addStitch(Point(x, y, jump))
+	return emb
+
+def stitches(emb):
+	return [(p.x, p.y, bool(p.jump)) for p in emb.coords]
+
+def known_good(format):
+	return open(os.path.join(DATA, "design." + format), "rb").read()
+
+class FormatTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory, True)
+
+	def saved(self, emb, format):
+		filename = os.path.join(self.directory, "out." + format)
+		emb.save(filename)
+		return open(filename, "rb").read()
+
+	def test_export(self):
+		for columnar in backends():
+			for format in ("exp", "dst", "ksm", "stc"):
+				self.assertEqual(self.saved(design(columnar), format), known_good(format), format)
+
+	def test_write(self):
+		for columnar in backends():
+			for format in ("exp", "dst", "ksm"):
+				for chunk_size in (None, 3):
+					out = StringIO()
+					design(columnar).write(out, format, chunk_size)
+					self.assertEqual(out.getvalue(), known_good(format), format)
+
+	def test_dst_header(self):
+		header = known_good("dst")[:512].split("\r")
+		for field in ("ST:     10", "+X:  120", "-X:   30", "+Y:  120", "-Y:   60",
+				"AX:-   30", "AY:-   50"):
+			self.assertTrue(field in header, field)
+
+	def test_import_export(self):
+		# the importers move the design to the origin, the moves stay
+		expected = [(x + 30, y + 60, jump) for (x, y, jump) in STITCHES]
+		for columnar in backends():
+			for format in ("exp", "dst"):
+				emb = Embroidery(columnar=columnar)
+				emb.load(os.path.join(DATA, "design." + format))
+				self.assertEqual(stitches(emb), expected, format)
+				for output in ("exp", "dst"):
+					self.assertEqual(self.saved(emb, output), known_good(output),
+						"%s to %s" % (format, output))
+
+	def test_native_round_trip(self):
+		for columnar in backends():
+			emb = Embroidery(columnar=columnar)
+			emb.load(os.path.join(DATA, "design.stc"))
+			self.assertEqual(stitches(emb), list(STITCHES))
+			for format in ("exp", "dst", "ksm", "stc"):
+				self.assertEqual(self.saved(emb, format), known_good(format), format)
+
+	def test_long_moves(self):
+		# long moves are split into even records within the format limit
+		for columnar in backends():
+			emb = Embroidery(columnar=columnar)
+			emb.addStitch(Point(0, 0))
+			emb.addStitch(Point(320, 0, True))
+			emb.addStitch(Point(320, 127))
+			self.assertEqual(emb.export_melco(), "\x00\x00"
+				"\x80\x04\x6a\x00\x80\x04\x6b\x00\x80\x04\x6b\x00"
+				"\x00\x7f")
+			records = emb.export_tajima()[512:]
+			self.assertEqual(len(records), 3 * (1 + 3 + 2 + 1))
+
+if __name__ == "__main__":
+	unittest.main()
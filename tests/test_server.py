@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# ------------------------------------------------------------------
+# tests: stitchconv.py server mode - answers, job limit and timeouts
+# run with: python -m unittest discover -s tests
+# ------------------------------------------------------------------
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+# ------------------------------------------------------------------
+
+import httplib
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import stitchcode
+import stitchconv
+from stitchcode import Embroidery, Point
+
+stitchcode.set_sink(stitchcode.NullSink())
+
+def slow_convert(data, input_format, output_format, options):
+	# stands in for server_convert in the workers
+	start = time.time()
+	time.sleep(2)
+	return ("done", None, start, time.time())
+
+def exp_design():
+	emb = Embroidery()
+	for (x, y) in ((0, 0), (100, 0), (100, 100), (0, 100)):
+		emb.addStitch(Point(x, y))
+	return emb.export_melco()
+
+class ServerTest(unittest.TestCase):
+	convert = None
+
+	def setUp(self):
+		self.saved = dict((name, getattr(stitchconv, name)) for name in
+			("workers", "max_jobs", "server_timeout", "server_convert"))
+		stitchconv.workers = 1
+		stitchconv.max_jobs = 1
+		if self.convert:
+			stitchconv.server_convert = self.convert
+		self.server = stitchconv.make_server("localhost:0")
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.server.pool.terminate()
+		self.server.pool.join()
+		for (name, value) in self.saved.items():
+			setattr(stitchconv, name, value)
+
+	def request(self, method, path, body=None):
+		connection = httplib.HTTPConnection("localhost", self.server.server_address[1], timeout=30)
+		connection.request(method, path, body)
+		response = connection.getresponse()
+		result = (response.status, response.read())
+		connection.close()
+		return result
+
+	def metrics(self):
+		return json.loads(self.request("GET", "/metrics")[1])
+
+class ConvertTest(ServerTest):
+	def test_convert(self):
+		(status, body) = self.request("POST", "/convert?input=exp&format=dst", exp_design())
+		self.assertEqual(status, 200)
+		self.assertTrue(body.startswith("LA:"))
+		self.assertEqual((len(body) - 512) % 3, 0)
+
+	def test_errors(self):
+		self.assertEqual(self.request("POST", "/convert?input=exp&format=dst&nonsense=1",
+			exp_design())[0], 400)
+		self.assertEqual(self.request("POST", "/convert?input=svg&format=dst",
+			"not a svg file")[0], 422)
+		self.assertEqual(self.request("GET", "/elsewhere")[0], 404)
+		metrics = self.metrics()
+		self.assertEqual((metrics["completed"], metrics["failed"], metrics["active"]), (0, 1, 0))
+
+class TimeoutTest(ServerTest):
+	convert = staticmethod(slow_convert)
+
+	def test_timed_out_job_keeps_its_slot(self):
+		stitchconv.server_timeout = 0.5
+		(status, body) = self.request("POST", "/convert?input=exp&format=dst", exp_design())
+		self.assertEqual(status, 422)
+		self.assertTrue("timed out" in body)
+		# the worker is still busy with the job
+		self.assertEqual(self.metrics()["active"], 1)
+		self.assertEqual(self.request("POST", "/convert?input=exp&format=dst", exp_design())[0], 503)
+		time.sleep(2.5)
+		metrics = self.metrics()
+		self.assertEqual((metrics["active"], metrics["failed"], metrics["rejected"]), (0, 1, 1))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# ------------------------------------------------------------------
+# tests: stitchconv.py on the command line - several outputs, batches
+# run with: python -m unittest discover -s tests
+# ------------------------------------------------------------------
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+# ------------------------------------------------------------------
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DATA = os.path.join(ROOT, "tests", "data")
+
+sys.path.insert(0, ROOT)
+import stitchcode
+from stitchcode import Embroidery
+
+stitchcode.set_sink(stitchcode.NullSink())
+
+def known_good(format):
+	return open(os.path.join(DATA, "design." + format), "rb").read()
+
+class StitchconvTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory, True)
+
+	def path(self, name):
+		return os.path.join(self.directory, name)
+
+	def run_stitchconv(self, *args):
+		process = subprocess.Popen([sys.executable, os.path.join(ROOT, "stitchconv.py"),
+			"--log=none"] + list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		output = process.communicate()[0]
+		return (process.returncode, output)
+
+	def test_several_outputs(self):
+		(status, output) = self.run_stitchconv("-i", os.path.join(DATA, "design.exp"),
+			"-o", self.path("a.exp"), "-o", self.path("b.dst"), "-o", self.path("c.png"))
+		self.assertEqual(status, 0, output)
+		self.assertEqual(open(self.path("a.exp"), "rb").read(), known_good("exp"))
+		self.assertEqual(open(self.path("b.dst"), "rb").read(), known_good("dst"))
+		self.assertTrue(open(self.path("c.png"), "rb").read().startswith("\x89PNG"))
+
+	def test_native_round_trip(self):
+		# stitchconv moves the design to the origin, the moves stay
+		(status, output) = self.run_stitchconv("-i", os.path.join(DATA, "design.stc"),
+			"-o", self.path("a.exp"), "-o", self.path("b.stc"))
+		self.assertEqual(status, 0, output)
+		self.assertEqual(open(self.path("a.exp"), "rb").read(), known_good("exp"))
+		(expected, emb) = (Embroidery(), Embroidery())
+		expected.load(os.path.join(DATA, "design.exp"))
+		emb.load(self.path("b.stc"))
+		self.assertEqual([p.as_tuple() for p in emb.coords],
+			[p.as_tuple() for p in expected.coords])
+
+	def test_batch(self):
+		(status, output) = self.run_stitchconv("-w", "1", "-F", "dst",
+			"-b", self.directory, os.path.join(DATA, "design.exp"))
+		self.assertEqual(status, 0, output)
+		self.assertEqual(open(self.path("design.dst"), "rb").read(), known_good("dst"))
+
+	def test_missing_input(self):
+		(status, output) = self.run_stitchconv("-i", self.path("missing.exp"),
+			"-o", self.path("a.dst"))
+		self.assertNotEqual(status, 0)
+		self.assertFalse(os.path.exists(self.path("a.dst")))
+
+if __name__ == "__main__":
+	unittest.main()
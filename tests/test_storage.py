@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# ------------------------------------------------------------------
+# tests: stitch storage - the coords list, columns and exports
+# run with: python -m unittest discover -s tests
+# ------------------------------------------------------------------
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+# ------------------------------------------------------------------
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import stitchcode
+from stitchcode import Embroidery, Point
+
+stitchcode.set_sink(stitchcode.NullSink())
+
+def backends():
+	# columnar=True only if numpy is installed
+	if stitchcode.numpy is None:
+		return [False]
+	return [True, False]
+
+def design(columnar):
+	emb = Embroidery(columnar=columnar)
+	for (x, y, jump) in ((0, 0, False), (50, 0, False), (50, 50, False),
+			(300, 50, True), (300, 100, False)):
+		emb.addStitch(Point(x, y, jump))
+	return emb
+
+class CoordsTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory, True)
+
+	def saved(self, emb, name):
+		filename = os.path.join(self.directory, name)
+		emb.save(filename)
+		return open(filename, "rb").read()
+
+	def test_coords_stay_live_after_export(self):
+		for columnar in backends():
+			emb = design(columnar)
+			coords = emb.coords
+			first = self.saved(emb, "first.exp")
+			coords.append(Point(400, 100))
+			coords[1].x = 60
+			emb.invalidateStats()
+			second = self.saved(emb, "second.exp")
+			self.assertNotEqual(first, second)
+
+			expected = design(columnar)
+			expected.addStitch(Point(400, 100))
+			expected.coords[1].x = 60
+			expected.invalidateStats()
+			self.assertEqual(second, self.saved(expected, "expected.exp"))
+			self.assertTrue(emb.coords is coords)
+
+	def test_add_stitches_keeps_coords(self):
+		for columnar in backends():
+			emb = design(columnar)
+			coords = emb.coords
+			emb.addStitches([310, 320], [100, 100])
+			self.assertTrue(emb.coords is coords)
+			self.assertEqual([(p.x, p.y) for p in coords[-2:]], [(310, 100), (320, 100)])
+			self.assertEqual(len(emb), 7)
+
+	def test_stats_cached_after_coords(self):
+		for columnar in backends():
+			emb = design(columnar)
+			scans = []
+			reset = emb._reset_stats
+			emb._reset_stats = lambda: (scans.append(1), reset())
+			coords = emb.coords
+			coords[0].x = -20
+			self.assertEqual(emb.getExtents(), (-20, 0, 300, 100))
+			emb.getSize()
+			emb.getExtents()
+			emb.scale(2)
+			self.assertEqual(emb.getExtents(), (-40, 0, 600, 200))
+			self.assertEqual(len(scans), 1)
+			self.assertEqual(coords[0].x, -40)
+			# changes through a kept list need invalidateStats()
+			coords[0].x = -100
+			emb.invalidateStats()
+			self.assertEqual(emb.getExtents(), (-100, 0, 600, 200))
+			self.assertEqual(len(scans), 2)
+			density = emb.density
+			self.assertTrue(emb.density is density)
+
+	def test_write_keeps_storage(self):
+		# writing to a stream does not move the Points back to columns
+		for columnar in backends():
+			for format in ("exp", "dst", "ksm", "pes", "svg"):
+				emb = design(columnar)
+				coords = emb.coords
+				first = StringIO()
+				emb.write(first, format)
+				self.assertTrue(emb.coords is coords)
+				self.assertTrue(emb._stitches is None)
+				coords.append(Point(400, 100))
+				emb.invalidateStats()
+				second = StringIO()
+				emb.write(second, format)
+				self.assertNotEqual(first.getvalue(), second.getvalue(), format)
+
+				expected = design(columnar)
+				expected.addStitch(Point(400, 100))
+				out = StringIO()
+				expected.write(out, format)
+				self.assertEqual(second.getvalue(), out.getvalue(), format)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# ------------------------------------------------------------------
+# tests: composed (lazy) transforms against known results
+# run with: python -m unittest discover -s tests
+# ------------------------------------------------------------------
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+# ------------------------------------------------------------------
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import stitchcode
+from stitchcode import Embroidery, Point
+
+stitchcode.set_sink(stitchcode.NullSink())
+
+def backends():
+	# columnar=True only if numpy is installed
+	if stitchcode.numpy is None:
+		return [False]
+	return [True, False]
+
+def rounded(values):
+	return [round(v, 9) for v in values]
+
+class TransformTest(unittest.TestCase):
+	def test_translation_after_scale(self):
+		for columnar in backends():
+			emb = Embroidery(columnar=columnar)
+			emb.addStitch(Point(10, 0))
+			emb.addStitch(Point(20, 0))
+			emb.scale(2)
+			emb.translate(5, 0)
+			emb.scale(0.5)
+			emb.scale(3)
+			self.assertEqual(emb.getExtents(), (37.5, 0, 67.5, 0))
+			self.assertEqual([(p.x, p.y) for p in emb.coords], [(37.5, 0), (67.5, 0)])
+
+	def test_translation_between_rotations(self):
+		for columnar in backends():
+			emb = Embroidery(columnar=columnar)
+			emb.addStitch(Point(10, 0))
+			emb.rotate(180)
+			emb.translate(100, 0)
+			emb.rotate(180)
+			emb.mirror()
+			self.assertEqual(rounded(emb.coords[0].as_tuple()), [90, 0])
+			self.assertEqual(rounded(emb.getExtents()), [90, 0, 90, 0])
+
+	def test_lazy_matches_step_by_step(self):
+		# applying every transform right away (coords taken) gives the
+		# same stitches as composing them
+		rnd = random.Random(1)
+		steps = [lambda emb: emb.scale(rnd.choice((0.5, 2, 3))),
+			lambda emb: emb.rotate(rnd.choice((30, 90, 180))),
+			lambda emb: emb.translate(rnd.randint(-50, 50), rnd.randint(-50, 50)),
+			lambda emb: emb.mirror()]
+		for columnar in backends():
+			for run in range(50):
+				sequence = [rnd.choice(steps) for i in range(6)]
+				state = rnd.getstate()
+				(lazy, eager) = (Embroidery(columnar=columnar), Embroidery(columnar=columnar))
+				for emb in (lazy, eager):
+					for (x, y) in ((0, 0), (10, 0), (10, 20)):
+						emb.addStitch(Point(x, y))
+				eager.coords
+				for emb in (lazy, eager):
+					rnd.setstate(state)
+					for step in sequence:
+						step(emb)
+				self.assertEqual([rounded(p.as_tuple()) for p in lazy.coords],
+					[rounded(p.as_tuple()) for p in eager.coords])
+
+if __name__ == "__main__":
+	unittest.main()